@@ -0,0 +1,53 @@
+'''Compare requests per second and tail latency of the sync (pg8000 on the
+threadpool) and async (asyncpg) data-access paths.
+
+Run from the repository root against a seeded database:
+
+    python -m benchmarks.bench_db_modes --requests 2000
+
+The response cache is off unless --response-cache is given, since the
+same few paths would otherwise be served from memory in either mode.
+'''
+
+from benchmarks.load import run_load, serve_app
+import argparse
+import asyncio
+import json
+
+
+PATHS = [
+    '/api/treasures',
+    '/api/treasures?sort_by=cost_at_auction&order=desc&limit=10',
+    '/api/treasures?colour=gold',
+    '/api/treasures?min_age=10&max_age=500&page=2',
+    '/api/shops',
+]
+
+
+async def get_mixed(client, n):
+    return await client.get(PATHS[n % len(PATHS)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--response-cache', action='store_true', help='Serve repeated GETs from the response cache')
+    args = parser.parse_args()
+
+    env = {} if args.response_cache else {'RESPONSE_CACHE_TTL': '0'}
+
+    results = {}
+    for mode in ['sync', 'async']:
+        with serve_app(args.port, DB_MODE=mode, **env) as base_url:
+            for concurrency in args.concurrency:
+                summary = asyncio.run(run_load(base_url, get_mixed, concurrency, args.requests))
+                results[f'{mode}/{concurrency}'] = summary
+                print(f"{mode:>5} c={concurrency:<4} {summary['rps']:>8} req/s  p99 {summary['p99_ms']:>8} ms"
+                      f"  errors {summary['errors']}")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+'''Measure throughput, latency and database time of every API route.
+
+Restores `--scale` copies of the `--env` data through `db/seed.py` (seeding
+them the first time), serves the
+app with SERVER_TIMING=1 and drives each scenario with `--concurrency`
+workers. Results are saved as JSON; with `--baseline` the run fails when a
+scenario's requests per second drop, or its p95/p99 latency or database
+time rise, by more than `--threshold` percent.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_routes --scale 2000 --output bench.json
+    python -m benchmarks.bench_routes --scale 2000 --baseline bench.json
+'''
+
+from benchmarks.load import run_load, serve_app
+from db.seed import restore_db, iter_json_array
+import argparse
+import asyncio
+import datetime
+import random
+import json
+import sys
+
+
+SORTS = [(sort_by, order) for sort_by in ['age', 'cost_at_auction', 'treasure_name', 'treasure_id']
+         for order in ['asc', 'desc']]
+
+# lower is better for these, higher is better for rps
+LATENCY_METRICS = ['p95_ms', 'p99_ms', 'db_ms_per_request']
+
+
+def make_scenarios(colours, ages, row_count):
+    '''Return {name: make_request(client, n)}, each drawing its parameters from a seeded RNG.'''
+    last_page = max(1, row_count // 10)
+
+    async def treasures_default(client, n):
+        return await client.get('/api/treasures')
+
+    async def treasures_sorted(client, n):
+        sort_by, order = SORTS[n % len(SORTS)]
+        return await client.get('/api/treasures', params={'sort_by': sort_by, 'order': order, 'limit': 10})
+
+    async def treasures_colour(client, n):
+        rng = random.Random(n)
+        sort_by, order = rng.choice(SORTS)
+        return await client.get('/api/treasures', params={'colour': rng.choice(colours), 'sort_by': sort_by,
+                                                          'order': order, 'limit': 10})
+
+    async def treasures_age_range(client, n):
+        rng = random.Random(n)
+        min_age = rng.choice(ages)
+        return await client.get('/api/treasures', params={'min_age': min_age, 'max_age': min_age + 200,
+                                                          'sort_by': 'cost_at_auction', 'limit': 10})
+
+    async def treasures_deep_page(client, n):
+        rng = random.Random(n)
+        return await client.get('/api/treasures', params={'page': rng.randint(last_page // 2, last_page),
+                                                          'limit': 10, 'sort_by': rng.choice(SORTS)[0]})
+
+    async def treasures_stream(client, n):
+        rng = random.Random(n)
+        sort_by, order = rng.choice(SORTS)
+        return await client.get('/api/treasures', params={'stream': 'true', 'sort_by': sort_by, 'order': order,
+                                                          'limit': 1000})
+
+    # each request continues one of the walks started before it, or starts a new one
+    cursors = []
+
+    async def treasures_cursor(client, n):
+        params = {'sort_by': 'cost_at_auction', 'limit': 10}
+        if cursors:
+            params['cursor'] = cursors.pop()
+        response = await client.get('/api/treasures', params=params)
+        if response.status_code == 200 and response.json().get('next_cursor'):
+            cursors.append(response.json()['next_cursor'])
+        return response
+
+    async def treasures_total(client, n):
+        rng = random.Random(n)
+        return await client.get('/api/treasures', params={'colour': rng.choice(colours), 'limit': 10,
+                                                          'include_total': 'true'})
+
+    async def treasures_search(client, n):
+        rng = random.Random(n)
+        return await client.get('/api/treasures', params={'q': f'treasure-{rng.choice("abcdefghij")}',
+                                                          'match': rng.choice(['prefix', 'substring']), 'limit': 10})
+
+    async def treasures_facets(client, n):
+        rng = random.Random(n)
+        return await client.get('/api/treasures/facets', params={'colour': rng.choice(colours)} if n % 2 else {})
+
+    async def treasures_export(client, n):
+        return await client.get('/api/treasures/export')
+
+    async def treasures_batch_get(client, n):
+        rng = random.Random(n)
+        ids = rng.sample(range(1, row_count + 1), min(50, row_count))
+        return await client.get('/api/treasures/batch', params={'ids': ','.join(map(str, ids))})
+
+    async def treasures_batch_post(client, n):
+        rng = random.Random(n)
+        return await client.post('/api/treasures/batch', json={'ids': rng.sample(range(1, row_count + 1),
+                                                                                 min(500, row_count))})
+
+    async def shops(client, n):
+        return await client.get('/api/shops')
+
+    async def catalogue_treasures(client, n):
+        rng = random.Random(n)
+        sort_by, order = rng.choice(SORTS)
+        return await client.get('/treasures', params={'sort_by': sort_by, 'order': order, 'limit': 10,
+                                                      'page': rng.randint(1, min(last_page, 20))})
+
+    async def catalogue_shops(client, n):
+        return await client.get('/shops')
+
+    created = []
+
+    async def writes(client, n):
+        # 2 posts : 1 patch : 1 delete of a treasure posted earlier in the run
+        rng = random.Random(n)
+        if n % 4 == 2:
+            return await client.patch(f'/api/treasures/{rng.randint(1, row_count)}',
+                                      json={'cost_at_auction': rng.randint(1, 1000)})
+        if n % 4 == 3 and created:
+            return await client.delete(f'/api/treasures/{created.pop()}')
+        response = await client.post('/api/treasures', json={
+            'treasure_name': f'benchmark treasure {n}', 'colour': rng.choice(colours),
+            'age': rng.randint(1, 1000), 'cost_at_auction': round(rng.uniform(1, 1000), 2), 'shop_id': 1})
+        if response.status_code == 201:
+            created.append(response.json()['treasure']['treasure_id'])
+        return response
+
+    async def bulk_insert(client, n):
+        rng = random.Random(n)
+        return await client.post('/api/treasures/bulk', json=[
+            {'treasure_name': f'bulk benchmark treasure {n}.{i}', 'colour': rng.choice(colours),
+             'age': rng.randint(1, 1000), 'cost_at_auction': round(rng.uniform(1, 1000), 2), 'shop_id': 1}
+            for i in range(100)])
+
+    async def bulk_update(client, n):
+        # consecutive blocks, so concurrent requests do not wait on each other's row locks
+        rng = random.Random(n)
+        start = n * 100 % max(row_count - 100, 1) + 1
+        return await client.patch('/api/treasures/bulk', json={'updates': [
+            {'treasure_id': treasure_id, 'cost_at_auction': rng.randint(1, 1000)}
+            for treasure_id in range(start, min(start + 100, row_count + 1))]})
+
+    async def bulk_delete(client, n):
+        # blocks past the seeded rows, i.e. those posted by the write scenarios; ids already gone are not_found
+        start = row_count + n * 100 + 1
+        return await client.request('DELETE', '/api/treasures/bulk',
+                                    json={'ids': list(range(start, start + 100))})
+
+    async def changes(client, n):
+        # subscribe, wait briefly for live changes and close; the replay of old ones is left out
+        return await client.get('/api/changes', params={'timeout': 0.05})
+
+    async def metrics(client, n):
+        return await client.get('/metrics')
+
+    async def stats(client, n):
+        route = ['pool', 'statements', 'replicas', 'cache', 'changes'][n % 5]
+        return await client.get(f'/api/stats/{route}')
+
+    return {
+        'treasures_default': treasures_default,
+        'treasures_sorted': treasures_sorted,
+        'treasures_colour': treasures_colour,
+        'treasures_age_range': treasures_age_range,
+        'treasures_deep_page': treasures_deep_page,
+        'treasures_stream': treasures_stream,
+        'treasures_cursor': treasures_cursor,
+        'treasures_total': treasures_total,
+        'treasures_search': treasures_search,
+        'treasures_facets': treasures_facets,
+        'treasures_export': treasures_export,
+        'treasures_batch_get': treasures_batch_get,
+        'treasures_batch_post': treasures_batch_post,
+        'shops': shops,
+        'catalogue_treasures': catalogue_treasures,
+        'catalogue_shops': catalogue_shops,
+        'writes': writes,
+        'bulk_insert': bulk_insert,
+        'bulk_update': bulk_update,
+        'bulk_delete': bulk_delete,
+        'changes': changes,
+        'metrics': metrics,
+        'stats': stats,
+    }
+
+
+def compare(results, baseline, threshold):
+    '''Return a message for every scenario metric more than `threshold` percent worse than the baseline.'''
+    regressions = []
+    for name, summary in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        if before['rps'] and summary['rps'] < before['rps'] * (1 - threshold / 100):
+            regressions.append(f"{name}: rps {before['rps']} -> {summary['rps']}")
+        for metric in LATENCY_METRICS:
+            # tiny absolute values are mostly noise, so allow them a millisecond
+            if metric in before and metric in summary and \
+                    summary[metric] > max(before[metric] * (1 + threshold / 100), before[metric] + 1):
+                regressions.append(f'{name}: {metric} {before[metric]} -> {summary[metric]}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--env', default='test', help='Database to seed and serve (test or dev)')
+    parser.add_argument('--scale', type=int, default=1000, help='Copies of the treasures to seed')
+    parser.add_argument('--no-seed', action='store_true', help='Use the database as it is')
+    parser.add_argument('--mode', default='async', choices=['async', 'sync'])
+    parser.add_argument('--requests', type=int, default=1000, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--scenarios', nargs='+', help='Only run these scenarios')
+    parser.add_argument('--no-response-cache', action='store_true', help='Measure every GET against the database')
+    parser.add_argument('--output', help='Save the results as JSON here')
+    parser.add_argument('--baseline', help='Fail on regressions against these saved results')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Allowed regression in percent')
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+
+    if not args.no_seed:
+        restore_db(args.env, scale=args.scale)
+    treasures = list(iter_json_array(f'data/{args.env}-data/treasures.json', 'treasures'))
+    colours = sorted({row['colour'] for row in treasures if row.get('colour')})
+    ages = sorted({row['age'] for row in treasures if row.get('age') is not None})
+    scenarios = make_scenarios(colours, ages, len(treasures) * args.scale)
+    if args.scenarios:
+        scenarios = {name: scenarios[name] for name in args.scenarios}
+
+    env = {'TESTING': args.env, 'DB_MODE': args.mode, 'SERVER_TIMING': '1'}
+    if args.no_response_cache:
+        env['RESPONSE_CACHE_TTL'] = '0'
+    results = {
+        'meta': {
+            'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'env': args.env, 'scale': args.scale, 'mode': args.mode, 'requests': args.requests,
+            'concurrency': args.concurrency, 'response_cache': not args.no_response_cache,
+        },
+        'scenarios': {},
+    }
+    with serve_app(args.port, **env) as base_url:
+        for name, make_request in scenarios.items():
+            summary = asyncio.run(run_load(base_url, make_request, args.concurrency, args.requests))
+            results['scenarios'][name] = summary
+            print(f"{name:<20} {summary['rps']:>8} req/s  p50 {summary['p50_ms']:>7} ms  p95 {summary['p95_ms']:>7} ms"
+                  f"  p99 {summary['p99_ms']:>7} ms  db {summary.get('db_ms_per_request', '-'):>7} ms"
+                  f"  errors {summary['errors']}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions beyond {args.threshold}% against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
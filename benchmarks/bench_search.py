@@ -0,0 +1,91 @@
+'''Measure `q` name search latency as the treasures table grows.
+
+Each size restores the test database with scaled copies of the test data
+(seeding them the first time), then adds a few needle treasures. The needle searches match the same rows
+at every size, so their latency should stay flat; the broad search matches
+1 in 26 treasures and grows with the table:
+
+    python -m benchmarks.bench_search --rows 10000 100000 1000000 5000000
+
+The test database is restored to the plain test data at the end.
+'''
+
+from db.connection import connect_to_db
+from db.settings import Settings
+from db.seed import restore_db
+from db.utils import get_treasures_filters, build_treasures_query
+import argparse
+import json
+import time
+
+
+NEEDLES = ['Lapis Astrolabe', 'Lapis Astrolabe (cracked)', 'Brass Astrolabe', 'Lapis Lazuli Orrery']
+
+SEARCHES = {
+    'prefix': ('lapis astro', 'prefix'),
+    'substring': ('strolab', 'substring'),
+    'fuzzy': ('astrolabe', 'fuzzy'),
+    'fuzzy_typo': ('astrolabbe', 'fuzzy'),
+    'broad_substring': ('treasure-q', 'substring'),
+}
+
+
+def search_query(q, match, sort_by, colour=None):
+    conditions, params = get_treasures_filters(colour=colour, q=q, match=match)
+    if sort_by == 'relevance':
+        params['q'] = q
+    params['limit'] = 20
+    order = 'DESC' if sort_by == 'relevance' else 'ASC'
+    return build_treasures_query(conditions, sort_by, order, 20, check_colour=bool(colour)).rstrip(';'), params
+
+
+def measure(conn, query_str, params, repeat):
+    statement = conn.prepare(query_str)
+    rows = statement.run(**params)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        statement.run(**params)
+        timings.append(time.perf_counter() - started)
+    statement.close()
+    timings.sort()
+    return {
+        'matches_on_page': len(rows),
+        'p50_ms': round(timings[len(timings) // 2] * 1000, 3),
+        'p95_ms': round(timings[int(len(timings) * 0.95)] * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    settings = Settings.load('test')
+    results = {}
+    try:
+        for rows in args.rows:
+            restore_db('test', scale=max(rows // 26, 1))
+            conn = connect_to_db(settings)
+            try:
+                for name in NEEDLES:
+                    conn.run("INSERT INTO treasures (treasure_name, colour, age, cost_at_auction, shop_id) "
+                             "VALUES (:name, 'gold', 100, 10.0, 1)", name=name)
+                conn.run('ANALYZE treasures')
+                [[total]] = conn.run('SELECT COUNT(*) FROM treasures')
+                for search, (q, match) in SEARCHES.items():
+                    for sort_by in ['relevance', 'age']:
+                        summary = measure(conn, *search_query(q, match, sort_by), args.repeat)
+                        results[f'{total}/{search}/{sort_by}'] = summary
+                        print(f"{total:>9} rows {search:>16} by {sort_by:<9} {summary['p50_ms']:>9} ms p50"
+                              f"  {summary['p95_ms']:>9} ms p95  {summary['matches_on_page']:>3} on page")
+            finally:
+                conn.close()
+    finally:
+        restore_db('test')
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
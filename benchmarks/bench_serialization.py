@@ -0,0 +1,78 @@
+'''Compare the time and memory it takes to turn a page of result rows into
+a JSON response body.
+
+Rows are synthetic treasure tuples, so no database is needed:
+
+    python -m benchmarks.bench_serialization --rows 10000 --repeat 20
+'''
+
+from db.utils import format_data_list_to_dict, format_rows
+from db.serialization import FastJSONResponse
+from fastapi.responses import JSONResponse
+import tracemalloc
+import argparse
+import json
+import time
+
+
+KEY_LIST = ['treasure_id', 'treasure_name', 'colour', 'age', 'cost_at_auction', 'shop_name']
+COLOURS = ['gold', 'silver', 'bronze', 'onyx', 'saffron', 'magenta', 'cobalt', 'ivory']
+
+
+def make_rows(n):
+    return [(i, f'treasure-{i}', COLOURS[i % len(COLOURS)], i % 1000, round(i * 1.37 % 5000, 2), f'shop-{i % 50}')
+            for i in range(1, n + 1)]
+
+
+def legacy(rows):
+    return JSONResponse(format_data_list_to_dict(rows, 'treasures', KEY_LIST)).body
+
+
+def objects(rows):
+    return FastJSONResponse(format_rows(rows, 'treasures', KEY_LIST)).body
+
+
+def columnar(rows):
+    return FastJSONResponse(format_rows(rows, 'treasures', KEY_LIST, columnar=True)).body
+
+
+PATHS = {'json_dicts': legacy, 'orjson_rows': objects, 'orjson_columnar': columnar}
+
+
+def measure(encode, rows, repeat):
+    encode(rows)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        encode(rows)
+        timings.append(time.perf_counter() - started)
+    tracemalloc.start()
+    body = encode(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    timings.sort()
+    per_10k = 10_000 / len(rows) * 1000
+    return {
+        'ms_per_10k_rows': round(timings[len(timings) // 2] * per_10k, 3),
+        'best_ms_per_10k_rows': round(timings[0] * per_10k, 3),
+        'peak_kib': round(peak / 1024, 1),
+        'body_kib': round(len(body) / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    results = {name: measure(encode, rows, args.repeat) for name, encode in PATHS.items()}
+    for name, summary in results.items():
+        print(f"{name:>16} {summary['ms_per_10k_rows']:>8} ms/10k rows  peak {summary['peak_kib']:>9} KiB"
+              f"  body {summary['body_kib']:>8} KiB")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
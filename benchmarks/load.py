@@ -0,0 +1,91 @@
+'''This module contains the shared load-generation helpers for the
+`Cat's Rare Treasures` benchmarks.'''
+
+from db.timing import parse_server_timing
+from contextlib import contextmanager
+import subprocess
+import asyncio
+import httpx
+import time
+import sys
+import os
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarise(latencies, elapsed, errors, db_times=None):
+    summary = {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+    if db_times:
+        # only present when the app runs with SERVER_TIMING=1
+        summary['db_ms_per_request'] = round(sum(db_times) / len(db_times), 3)
+        summary['db_p95_ms'] = round(percentile(db_times, 95), 3)
+    return summary
+
+
+async def run_load(base_url, make_request, concurrency, total_requests):
+    '''Fire `total_requests` requests from `concurrency` workers.
+
+    `make_request(client, n)` performs the n-th request and returns the response.
+    '''
+    latencies = []
+    db_times = []
+    errors = 0
+    counter = iter(range(total_requests))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def worker():
+            nonlocal errors
+            for n in counter:
+                started = time.perf_counter()
+                try:
+                    response = await make_request(client, n)
+                    if response.status_code >= 500:
+                        errors += 1
+                    timings = parse_server_timing(response.headers.get('server-timing'))
+                    if 'db' in timings:
+                        db_times.append(timings['db'])
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return summarise(latencies, elapsed, errors, db_times)
+
+
+@contextmanager
+def serve_app(port, **env):
+    '''Run the app under uvicorn in a subprocess for the duration of the block.'''
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port), '--log-level', 'warning'],
+        env={**os.environ, **env},
+    )
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                httpx.get(f'http://127.0.0.1:{port}/api/shops', timeout=1)
+                break
+            except httpx.HTTPError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError('The app did not start')
+                time.sleep(0.2)
+        yield f'http://127.0.0.1:{port}'
+    finally:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,130 @@
+'''This module renders the HTML catalogue of the `Cat's Rare Treasures` app.
+
+Templates are compiled once, when the app starts, and are not checked for
+changes after that. The table of a page is rendered as a fragment that is
+cached like a JSON response, so a cached page only renders the page
+around it. Large pages are rendered chunk by chunk as the rows are read.
+
+Static files are also served under names that carry a hash of their
+content, e.g. `/static/styles.3f2a9c1e0b7d.css`, cached for a year. A
+changed file gets a new name, so a cached copy never has to be checked.
+'''
+
+from fastapi.staticfiles import StaticFiles
+from urllib.parse import urlencode, parse_qsl
+import hashlib
+import jinja2
+import os
+
+
+TEMPLATE_DIRECTORY = 'templates'
+STATIC_DIRECTORY = 'static'
+STATIC_PATH = '/static'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# streamed pages are sent in pieces of about this many bytes
+FLUSH_BYTES = 16 * 1024
+
+
+class HashedStaticFiles(StaticFiles):
+    '''StaticFiles that also serve every file under a name with its content hash.
+
+    The hashes are taken once, so files must not change while the app runs.
+    '''
+
+    def __init__(self, directory, **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        self.hashed_names = {}  # path -> hashed path
+        self.paths = {}  # hashed path -> path
+        for root, _, names in os.walk(directory):
+            for name in names:
+                full_path = os.path.join(root, name)
+                with open(full_path, 'rb') as f:
+                    digest = hashlib.blake2b(f.read(), digest_size=6).hexdigest()
+                path = os.path.relpath(full_path, directory)
+                stem, extension = os.path.splitext(path)
+                hashed = f'{stem}.{digest}{extension}'
+                self.hashed_names[path] = hashed
+                self.paths[hashed] = path
+
+    def url(self, path):
+        return f"{STATIC_PATH}/{self.hashed_names[path].replace(os.sep, '/')}"
+
+    async def get_response(self, path, scope):
+        original = self.paths.get(path)
+        response = await super().get_response(original or path, scope)
+        # the plain name still works, but its content can change
+        response.headers['Cache-Control'] = IMMUTABLE if original else 'no-cache'
+        return response
+
+
+static_files = HashedStaticFiles(directory=STATIC_DIRECTORY)
+
+templates = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIRECTORY), autoescape=True,
+                               enable_async=True, auto_reload=False, trim_blocks=True, lstrip_blocks=True)
+templates.globals['static_url'] = static_files.url
+
+
+def get_catalogue_version():
+    '''A hash of the templates and static files, which every rendered page depends on.'''
+    digest = hashlib.blake2b(digest_size=6)
+    for name in sorted(templates.list_templates()):
+        source, _, _ = templates.loader.get_source(templates, name)
+        digest.update(name.encode() + source.encode())
+    for hashed in sorted(static_files.paths):
+        digest.update(hashed.encode())
+    return digest.hexdigest()
+
+
+catalogue_version = get_catalogue_version()
+
+
+def precompile_templates():
+    '''Compile every template now, so no request pays for it; returns their names.'''
+    names = templates.list_templates(extensions=['html'])
+    for name in names:
+        templates.get_template(name)
+    return names
+
+
+def page_etag(fragment_etag):
+    '''The ETag of a page built around a cached fragment.'''
+    return '"' + fragment_etag.strip('"') + '-' + catalogue_version + '"'
+
+
+def page_link(params, **changes):
+    '''A relative link to the current page with `changes` to its query parameters.'''
+    params = {**params, **changes}
+    return '?' + urlencode({name: value for name, value in params.items() if value is not None and value != ''})
+
+
+async def buffered(pieces, flush_bytes=FLUSH_BYTES):
+    '''Join the small strings a streamed template yields into bodies of about `flush_bytes`.'''
+    buffer, size = [], 0
+    async for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= flush_bytes:
+            yield ''.join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer).encode()
+
+
+class BlankQueryParamsMiddleware:
+    '''Drop empty query parameters from requests for `paths`.
+
+    A submitted search form sends every field, e.g. `max_age=` for a blank
+    one, which would fail validation as an int.
+    '''
+
+    def __init__(self, app, paths):
+        self.app = app
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] in self.paths and scope['query_string']:
+            params = parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True)
+            if any(value == '' for _, value in params):
+                query_string = urlencode([(name, value) for name, value in params if value != ''])
+                scope = {**scope, 'query_string': query_string.encode('latin-1')}
+        await self.app(scope, receive, send)
@@ -0,0 +1,256 @@
+'''This module contains the asyncpg-backed counterparts of the helpers in
+`db/utils.py`, used when the app runs with `DB_MODE=async`.'''
+
+from db.settings import get_settings, on_reload
+from db.timing import timed_phase, timed_query
+from db.statements import StatementCache
+from db.routing import ReplicaUnavailable, is_unavailable
+from db.utils import format_rows, format_rows_as_csv, split_colour_check, TREASURE_COLUMNS
+from fastapi import HTTPException
+import asyncio
+import asyncpg
+import io
+import time
+import re
+
+
+PLACEHOLDER_PATTERN = re.compile(r'(?<![:\w]):([A-Za-z_]\w*)')
+
+
+def to_asyncpg_query(query_str, value_keys):
+    '''Rewrite the `:name` placeholders used with pg8000 into asyncpg's `$n`.'''
+    names = []
+    def replace(match):
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+        return f'${names.index(name) + 1}'
+    query_str = PLACEHOLDER_PATTERN.sub(replace, query_str)
+    return query_str, [value_keys[name] for name in names]
+
+
+class StatementCachingConnection(asyncpg.Connection):
+    # asyncpg connections use slots, so the cache needs one of its own
+    __slots__ = ('statement_cache',)
+
+
+def _count_statement(conn, query_str):
+    '''Mirror asyncpg's statement cache for `conn` to count its hits and misses.
+
+    asyncpg already prepares each query once per connection and keeps the
+    statements in an LRU of `statement_cache_size`, re-preparing them itself
+    after schema changes. Its PreparedStatement objects cannot be kept past
+    a release back to the pool, so the app relies on that cache and only
+    tracks it here.
+    '''
+    cache = conn.statement_cache
+    if cache.lookup(query_str) is None:
+        cache.add(query_str, True)
+
+
+async def _init_connection(conn, settings):
+    # decode REAL columns from their text form so values match the sync path
+    # (binary float4 would come back as e.g. 19.989999771118164)
+    await conn.set_type_codec('float4', schema='pg_catalog', encoder=str, decoder=float, format='text')
+    conn.statement_cache = StatementCache(settings.prepared_statement_cache_size)
+
+
+# asyncpg pools are bound to the event loop they were created in, so they
+# are keyed by (loop, replica name), with None as the name of the primary
+_pools = {}
+_checkout_stats = {'checkouts': 0, 'timeouts': 0, 'total_wait': 0.0, 'max_wait': 0.0}
+
+
+async def get_async_pool(endpoint=None):
+    loop = asyncio.get_running_loop()
+    for stale_key in [key for key in _pools if key[0].is_closed()]:
+        stale = _pools.pop(stale_key)
+        if stale.done() and not stale.exception():
+            stale.result().terminate()
+    key = (loop, endpoint.name if endpoint is not None else None)
+    if key not in _pools:
+        settings = get_settings()
+        _pools[key] = asyncio.ensure_future(asyncpg.create_pool(
+            user=settings.pg_user,
+            password=settings.pg_password,
+            database=settings.pg_database,
+            host=settings.pg_host if endpoint is None else endpoint.host,
+            port=settings.pg_port if endpoint is None else endpoint.port,
+            min_size=settings.pool_min_size,
+            max_size=settings.pool_max_size,
+            max_inactive_connection_lifetime=settings.pool_idle_timeout,
+            init=lambda conn: _init_connection(conn, settings),
+            connection_class=StatementCachingConnection,
+            statement_cache_size=settings.prepared_statement_cache_size,
+        ))
+    try:
+        return await _pools[key]
+    except Exception:
+        _pools.pop(key, None)
+        raise
+
+
+async def close_async_pool():
+    loop = asyncio.get_running_loop()
+    for key in [key for key in _pools if key[0] is loop]:
+        pool = _pools.pop(key)
+        try:
+            await (await pool).close()
+        except Exception:
+            # a replica that was never reachable has no pool to close
+            pass
+
+
+async def _retire_pool(pool):
+    # waits for the connections still in use to be released
+    await (await pool).close()
+
+
+@on_reload
+def retire_async_pools(new, old):
+    '''Let new requests open pools with the new settings, closing the old ones on their own loops.'''
+    if not new.connection_changed(old):
+        return
+    for (loop, name), pool in list(_pools.items()):
+        _pools.pop((loop, name), None)
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(asyncio.ensure_future, _retire_pool(pool))
+
+
+async def async_pool_stats():
+    pool = await get_async_pool()
+    checkouts = _checkout_stats['checkouts']
+    return {
+        'min_size': pool.get_min_size(),
+        'max_size': pool.get_max_size(),
+        'size': pool.get_size(),
+        'in_use': pool.get_size() - pool.get_idle_size(),
+        'idle': pool.get_idle_size(),
+        'checkouts': checkouts,
+        'timeouts': _checkout_stats['timeouts'],
+        'total_wait_ms': round(_checkout_stats['total_wait'] * 1000, 3),
+        'avg_wait_ms': round(_checkout_stats['total_wait'] * 1000 / checkouts, 3) if checkouts else 0.0,
+        'max_wait_ms': round(_checkout_stats['max_wait'] * 1000, 3),
+    }
+
+
+async def _fetch(query_str, endpoint=None, **value_keys):
+    pool = await get_async_pool(endpoint)
+    query_str, args = to_asyncpg_query(query_str, value_keys)
+    started = time.monotonic()
+    try:
+        with timed_phase('connect'):
+            conn = await pool.acquire(timeout=get_settings().pool_checkout_timeout)
+    except asyncio.TimeoutError:
+        _checkout_stats['timeouts'] += 1
+        raise
+    waited = time.monotonic() - started
+    _checkout_stats['checkouts'] += 1
+    _checkout_stats['total_wait'] += waited
+    _checkout_stats['max_wait'] = max(_checkout_stats['max_wait'], waited)
+    try:
+        _count_statement(conn, query_str)
+        with timed_query(query_str, value_keys):
+            rows = await conn.fetch(query_str, *args)
+        key_list = list(rows[0].keys()) if rows else []
+    finally:
+        await pool.release(conn)
+    with timed_phase('fetch'):
+        return [tuple(row) for row in rows], key_list
+
+
+async def async_connect_to_db_and_get_formatted_result(query_str, key, columnar=False, endpoint=None, **value_keys):
+    try:
+        result, key_list = await _fetch(query_str, endpoint, **value_keys)
+        with timed_phase('format'):
+            key_list, result = split_colour_check(key_list, result)
+            formatted_result = format_rows(result, key, key_list, columnar)
+        return formatted_result
+    except HTTPException as http_err:
+        print(http_err)
+        raise http_err
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail='Could not get a database connection in time')
+    except Exception as e:
+        if endpoint is not None and is_unavailable(e):
+            raise ReplicaUnavailable(endpoint, e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def async_iter_query_rows(query_str, chunk_size, endpoint=None, **value_keys):
+    pool = await get_async_pool(endpoint)
+    query_str, args = to_asyncpg_query(query_str, value_keys)
+    with timed_phase('connect'):
+        conn = await pool.acquire(timeout=get_settings().pool_checkout_timeout)
+    try:
+        # asyncpg cursors only live inside a transaction
+        async with conn.transaction(readonly=True):
+            _count_statement(conn, query_str)
+            with timed_query(query_str, value_keys):
+                cursor = await conn.cursor(query_str, *args)
+            while True:
+                with timed_phase('fetch'):
+                    rows = await cursor.fetch(chunk_size)
+                    if not rows:
+                        break
+                    key_list = list(rows[0].keys())
+                    rows = [tuple(row) for row in rows]
+                yield key_list, rows
+    finally:
+        await pool.release(conn)
+
+
+async def async_get_shop_ids_from_db():
+    shop_ids, _ = await _fetch('''SELECT shop_id FROM shops;''')
+    return {row[0] for row in shop_ids}
+
+
+async def async_run_chunked_transactions(query_str, chunks):
+    '''The asyncpg counterpart of `run_chunked_transactions`.'''
+    results = []
+    try:
+        pool = await get_async_pool()
+        with timed_phase('connect'):
+            conn = await pool.acquire(timeout=get_settings().pool_checkout_timeout)
+        try:
+            for params in chunks:
+                asyncpg_query, args = to_asyncpg_query(query_str, params)
+                try:
+                    async with conn.transaction():
+                        _count_statement(conn, asyncpg_query)
+                        with timed_query(query_str, {'rows': len(params['ids'])}):
+                            rows = await conn.fetch(asyncpg_query, *args)
+                except asyncpg.PostgresError as e:
+                    results.append((None, str(e)))
+                else:
+                    results.append(([row[0] for row in rows], None))
+        finally:
+            await pool.release(conn)
+        return results
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail='Could not get a database connection in time')
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def async_bulk_insert_treasures(rows, batch_size):
+    try:
+        pool = await get_async_pool()
+        with timed_phase('connect'):
+            conn = await pool.acquire(timeout=get_settings().pool_checkout_timeout)
+        try:
+            async with conn.transaction():
+                for start in range(0, len(rows), batch_size):
+                    # text COPY, since REAL is registered with a text-only codec
+                    with timed_phase('format'):
+                        csv_batch = format_rows_as_csv(rows[start:start + batch_size]).encode()
+                    with timed_query('COPY treasures FROM STDIN', {'rows': min(batch_size, len(rows) - start)}):
+                        await conn.copy_to_table('treasures', source=io.BytesIO(csv_batch),
+                                                 columns=TREASURE_COLUMNS, format='csv')
+        finally:
+            await pool.release(conn)
+        return len(rows)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail='Could not get a database connection in time')
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,252 @@
+'''This module contains the in-process caches used by the
+`Cat's Rare Treasures` FastAPI app.'''
+
+from db.settings import get_settings, on_reload
+from collections import OrderedDict
+import threading
+import hashlib
+import time
+
+
+def etag_matches(if_none_match, etag):
+    '''Whether an If-None-Match header names `etag`, compared weakly as RFC 9110 asks.'''
+    if not if_none_match:
+        return False
+    etag = etag.removeprefix('W/')
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+class ResponseCache:
+    '''An LRU/TTL cache of serialized GET responses with their ETags.
+
+    Keys combine the resource, its current generation and the normalized
+    query parameters. Writes bump the generation of every resource they
+    affect, so stale entries are never served and simply age out of the LRU.
+    '''
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, ttl=30.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (body, etag, stored_at)
+        self._generations = {}
+        self._clears = 0
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _generation(self, resource):
+        return self._clears, self._generations.get(resource, 0)
+
+    def key(self, resource, **params):
+        with self._lock:
+            generation = self._generation(resource)
+        return resource, generation, tuple(sorted(params.items()))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[2] >= self.ttl:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key, body):
+        etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        with self._lock:
+            # a write bumped the generation while this response was built
+            if key[1] != self._generation(key[0]):
+                return etag
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[key] = (body, etag, time.monotonic())
+            self._bytes += len(body)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, (old_body, _, _) = self._entries.popitem(last=False)
+                self._bytes -= len(old_body)
+                self.evictions += 1
+        return etag
+
+    def bump(self, *resources):
+        with self._lock:
+            for resource in resources:
+                self._generations[resource] = self._generations.get(resource, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._clears += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'generations': dict(self._generations),
+                'ttl': self.ttl,
+            }
+
+
+class RowCache:
+    '''An LRU/TTL cache of treasure rows by treasure_id.
+
+    Writes invalidate the ids they change. Invalidating also bumps a
+    version, and rows read before that are not stored, so a read that
+    raced a write cannot put the old row back.
+    '''
+
+    def __init__(self, max_entries=10000, ttl=30.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._rows = OrderedDict()  # treasure_id -> (row, stored_at)
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self, ids):
+        '''Return ({id: row} for the cached ids, a version to pass to put_many).'''
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for treasure_id in ids:
+                entry = self._rows.get(treasure_id)
+                if entry is None or now - entry[1] >= self.ttl:
+                    self.misses += 1
+                    continue
+                self._rows.move_to_end(treasure_id)
+                found[treasure_id] = entry[0]
+                self.hits += 1
+            return found, self._version
+
+    def put_many(self, rows, version):
+        now = time.monotonic()
+        with self._lock:
+            if version != self._version:
+                return
+            for treasure_id, row in rows.items():
+                self._rows[treasure_id] = (row, now)
+                self._rows.move_to_end(treasure_id)
+            while len(self._rows) > self.max_entries:
+                self._rows.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, ids):
+        with self._lock:
+            self._version += 1
+            for treasure_id in ids:
+                self._rows.pop(treasure_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._rows.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._rows),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'ttl': self.ttl,
+            }
+
+
+class CountCache:
+    '''A short-lived cache of listing totals by filter combination.
+
+    An entry is an exact count or a planner estimate. An exact count
+    answers requests for either, an estimate only requests for an
+    estimate. Writes drop every entry, like RowCache.invalidate.
+    '''
+
+    def __init__(self, max_entries=1024, ttl=5.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._counts = OrderedDict()  # filters -> (total, exact, stored_at)
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filters, exact):
+        '''Return ((total, exact) or None, a version to pass to put).'''
+        with self._lock:
+            entry = self._counts.get(filters)
+            if entry is None or time.monotonic() - entry[2] >= self.ttl or (exact and not entry[1]):
+                self.misses += 1
+                return None, self._version
+            self._counts.move_to_end(filters)
+            self.hits += 1
+            return entry[:2], self._version
+
+    def put(self, filters, total, exact, version):
+        with self._lock:
+            if version != self._version:
+                return
+            entry = self._counts.get(filters)
+            # keep a fresh exact count rather than replacing it with an estimate
+            if entry is not None and entry[1] and not exact and time.monotonic() - entry[2] < self.ttl:
+                return
+            self._counts[filters] = (total, exact, time.monotonic())
+            self._counts.move_to_end(filters)
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+            self._counts.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._counts),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'ttl': self.ttl,
+            }
+
+
+response_cache = ResponseCache(
+    max_entries=get_settings().response_cache_max_entries,
+    max_bytes=get_settings().response_cache_max_bytes,
+    ttl=get_settings().response_cache_ttl,
+)
+row_cache = RowCache(max_entries=get_settings().row_cache_max_entries, ttl=get_settings().row_cache_ttl)
+count_cache = CountCache(ttl=get_settings().count_cache_ttl)
+
+
+@on_reload
+def apply_cache_settings(new, old):
+    # smaller limits take effect as new entries push the oldest out
+    response_cache.ttl = new.response_cache_ttl
+    response_cache.max_entries = new.response_cache_max_entries
+    response_cache.max_bytes = new.response_cache_max_bytes
+    row_cache.ttl = new.row_cache_ttl
+    row_cache.max_entries = new.row_cache_max_entries
+    count_cache.ttl = new.count_cache_ttl
@@ -0,0 +1,332 @@
+'''This module publishes the feed of changes to `treasures` served by
+GET /api/changes.
+
+Triggers on `treasures` write one row per changed treasure to the
+`treasure_changes` outbox and NOTIFY once per statement. Every app process
+has one ChangeFeed: a single connection that LISTENs, reads the new outbox
+rows once per notification and hands them to all of its subscribers.
+
+Change ids are taken when the triggers run, and writers do not wait for
+each other, so a transaction can commit after one that took a higher id.
+Writes to the same treasure still get their ids in commit order, because
+the triggers run after the row lock is taken. The listener only publishes
+up to a frontier: it reads the id sequence, then a snapshot, and the ids
+it read are settled once every transaction running at that snapshot has
+ended. Changes are therefore always published in id order, and a long
+write transaction delays the changes committed after it.
+
+Subscribers resume from the last change id they saw. Changes older than
+CHANGE_FEED_RETENTION seconds are pruned. A subscriber that resumes from
+before that is sent a `reset` event and should reload.
+'''
+
+from db.settings import get_settings
+from db.async_utils import to_asyncpg_query
+import collections
+import asyncio
+import asyncpg
+import logging
+import time
+
+
+log = logging.getLogger('cats_rare_treasures.changes')
+
+CHANNEL = 'treasure_changes'
+
+CHANGES_TABLE = '''CREATE TABLE treasure_changes (
+            change_id BIGSERIAL PRIMARY KEY,
+            changed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            operation VARCHAR(6) NOT NULL,
+            treasure_id INT NOT NULL,
+            shop_id INT,
+            treasure JSONB
+            )'''
+
+# an UPDATE that leaves a row as it was is not a change
+PUBLISH_FUNCTION = f'''CREATE OR REPLACE FUNCTION publish_treasure_changes() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    PERFORM 1 FROM old_rows LIMIT 1;
+                ELSE
+                    PERFORM 1 FROM new_rows LIMIT 1;
+                END IF;
+                IF NOT FOUND THEN
+                    RETURN NULL;
+                END IF;
+                IF TG_OP = 'INSERT' THEN
+                    INSERT INTO treasure_changes (operation, treasure_id, shop_id, treasure)
+                    SELECT 'insert', treasure_id, shop_id, to_jsonb(new_rows) FROM new_rows ORDER BY treasure_id;
+                ELSIF TG_OP = 'DELETE' THEN
+                    INSERT INTO treasure_changes (operation, treasure_id, shop_id)
+                    SELECT 'delete', treasure_id, shop_id FROM old_rows ORDER BY treasure_id;
+                ELSE
+                    INSERT INTO treasure_changes (operation, treasure_id, shop_id, treasure)
+                    SELECT 'update', new_rows.treasure_id, new_rows.shop_id, to_jsonb(new_rows)
+                    FROM new_rows JOIN old_rows ON old_rows.treasure_id = new_rows.treasure_id
+                    WHERE new_rows IS DISTINCT FROM old_rows
+                    ORDER BY new_rows.treasure_id;
+                END IF;
+                IF FOUND THEN
+                    PERFORM pg_notify('{CHANNEL}', '');
+                END IF;
+                RETURN NULL;
+            END;
+            $$'''
+
+# transition tables need one trigger per event
+TRIGGERS = [
+    f'''CREATE TRIGGER treasures_publish_{event.lower()}
+            AFTER {event} ON treasures
+            REFERENCING {transition}
+            FOR EACH STATEMENT EXECUTE FUNCTION publish_treasure_changes()'''
+    for event, transition in [
+        ('INSERT', 'NEW TABLE AS new_rows'),
+        ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+        ('DELETE', 'OLD TABLE AS old_rows'),
+    ]
+]
+
+def create_change_feed(db):
+    '''Create the outbox and attach the triggers; call after loading `treasures`.'''
+    db.run(CHANGES_TABLE)
+    db.run(PUBLISH_FUNCTION)
+    for trigger in TRIGGERS:
+        db.run(trigger)
+
+
+def get_changes_query():
+    # the event is built as JSON text here, so it is sent on without being decoded
+    return '''
+            SELECT change_id, operation, json_build_object('change_id', change_id, 'operation', operation,
+                'treasure_id', treasure_id, 'shop_id', shop_id, 'treasure', treasure, 'changed_at', changed_at)::TEXT
+                AS data
+            FROM treasure_changes
+            WHERE change_id > :after AND change_id <= :through
+            ORDER BY change_id
+            LIMIT :limit;'''
+
+
+def get_last_change_id_query():
+    # read outside any transaction's snapshot, so it counts ids not yet committed
+    return '''SELECT CASE WHEN is_called THEN last_value ELSE last_value - 1 END AS change_id
+            FROM treasure_changes_change_id_seq;'''
+
+
+def get_snapshot_bounds_query():
+    # xmin: every older transaction has ended; xmax: every transaction that has started is older
+    return '''SELECT pg_snapshot_xmin(snapshot)::TEXT::BIGINT AS xmin, pg_snapshot_xmax(snapshot)::TEXT::BIGINT AS xmax
+            FROM pg_current_snapshot() AS snapshot;'''
+
+
+def get_change_kept_query():
+    return 'SELECT EXISTS (SELECT 1 FROM treasure_changes WHERE change_id = :change_id) AS kept;'
+
+
+def get_prune_changes_query():
+    return 'DELETE FROM treasure_changes WHERE changed_at < now() - make_interval(secs => :retention);'
+
+
+class Subscription:
+    '''The changes passed on to one subscriber, from `position` on.'''
+
+    def __init__(self, queue_size, position):
+        self.queue = asyncio.Queue(queue_size)
+        self.position = position
+        self.closed = False
+
+
+class ChangeFeed:
+    '''One listening connection per process, fanning the outbox out to its subscribers.
+
+    The connection is opened by the first subscriber and kept until `stop()`.
+    It reconnects after an error, catching up on what it missed from the
+    outbox. A subscriber too slow to take its changes is closed, and can
+    resume from the last change it got.
+    '''
+
+    FETCH_SIZE = 1000
+    # first retry while waiting for a frontier to settle, doubled up to CHANGE_FEED_POLL_INTERVAL
+    SETTLE_DELAY = 0.01
+
+    def __init__(self):
+        self.subscriptions = set()
+        # the last change passed on to the subscribers
+        self.position = None
+        self.notifications = 0
+        self.fetches = 0
+        self.published = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self._loop = None
+        self._task = None
+        self._ready = None
+        self._wakeup = None
+        self._conn = None
+        self._pruned_at = 0.0
+        # (last change id, xmax) read by the listener and not yet settled
+        self._checkpoints = collections.deque()
+        self.frontier = None
+
+    async def subscribe(self, queue_size):
+        await self._start()
+        subscription = Subscription(queue_size, self.position)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.discard(subscription)
+
+    async def _start(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._reset()
+            self._loop = loop
+            self._ready = loop.create_future()
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._listen())
+        await asyncio.shield(self._ready)
+
+    def _reset(self):
+        for subscription in self.subscriptions:
+            subscription.closed = True
+        self.subscriptions = set()
+        self.position = None
+        self.frontier = None
+        self._checkpoints.clear()
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None and self._loop is asyncio.get_running_loop():
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._reset()
+
+    async def _connect(self):
+        settings = get_settings()
+        conn = await asyncpg.connect(user=settings.pg_user, password=settings.pg_password,
+                                     database=settings.pg_database, host=settings.pg_host, port=settings.pg_port)
+        await conn.add_listener(CHANNEL, self._notified)
+        return conn
+
+    def _notified(self, conn, pid, channel, payload):
+        self.notifications += 1
+        self._wakeup.set()
+
+    async def _listen(self):
+        delay = 0.1
+        while True:
+            try:
+                self._conn = await self._connect()
+                delay = 0.1
+                settle_delay = self.SETTLE_DELAY
+                while True:
+                    # anything committed while not listening is read now
+                    frontier, unsettled = await self._advance_frontier()
+                    if frontier is not None and self.position is None:
+                        # earlier changes are history, replayed from the outbox
+                        self.position = frontier
+                        self._ready.set_result(None)
+                    if self.position is not None:
+                        await self._fetch(frontier)
+                        await self._prune()
+                    poll_interval = get_settings().change_feed_poll_interval
+                    if unsettled:
+                        # a transaction that ends without writing treasures sends no notification
+                        timeout, settle_delay = settle_delay, min(settle_delay * 2, poll_interval)
+                    else:
+                        # polling too notices a lost connection
+                        timeout, settle_delay = poll_interval, self.SETTLE_DELAY
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._wakeup.clear()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not self._ready.done():
+                    self._ready.set_exception(e)
+                    return
+                log.warning('Change feed lost its connection, reconnecting: %s', e)
+                self.reconnects += 1
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+            finally:
+                if self._conn is not None:
+                    self._conn.terminate()
+                    self._conn = None
+
+    async def _advance_frontier(self):
+        '''Return the highest change id all earlier changes are settled at, and whether later ones are not.
+
+        Ids are only taken by transactions that have written to `treasures`,
+        so any transaction holding an id up to `change_id` had started before
+        the snapshot read after it. Once the oldest running transaction is
+        newer than every transaction of that snapshot, each of those ids has
+        committed or rolled back.
+        '''
+        change_id = await self._conn.fetchval(get_last_change_id_query())
+        xmin, xmax = await self._conn.fetchrow(get_snapshot_bounds_query())
+        latest = self._checkpoints[-1][0] if self._checkpoints else self.frontier
+        if latest is None or latest < change_id:
+            self._checkpoints.append((change_id, xmax))
+        while self._checkpoints and self._checkpoints[0][1] <= xmin:
+            self.frontier = self._checkpoints.popleft()[0]
+        return self.frontier, bool(self._checkpoints)
+
+    async def _fetch(self, through):
+        while self.position < through:
+            query_str, args = to_asyncpg_query(get_changes_query(), {'after': self.position, 'through': through,
+                                                                     'limit': self.FETCH_SIZE})
+            rows = await self._conn.fetch(query_str, *args)
+            self.fetches += 1
+            for change in rows:
+                self._publish(tuple(change))
+            if len(rows) < self.FETCH_SIZE:
+                return
+
+    def _publish(self, change):
+        self.position = change[0]
+        self.published += 1
+        for subscription in list(self.subscriptions):
+            try:
+                subscription.queue.put_nowait(change)
+            except asyncio.QueueFull:
+                subscription.closed = True
+                self.subscriptions.discard(subscription)
+                self.dropped += 1
+
+    async def _prune(self):
+        retention = get_settings().change_feed_retention
+        if retention <= 0 or time.monotonic() - self._pruned_at < min(retention, 60.0):
+            return
+        query_str, args = to_asyncpg_query(get_prune_changes_query(), {'retention': float(retention)})
+        await self._conn.execute(query_str, *args)
+        self._pruned_at = time.monotonic()
+
+    def stats(self):
+        return {
+            'listening': self._conn is not None and not self._conn.is_closed(),
+            'subscribers': len(self.subscriptions),
+            'position': self.position,
+            'frontier': self.frontier,
+            'unsettled': len(self._checkpoints),
+            'notifications': self.notifications,
+            'fetches': self.fetches,
+            'published': self.published,
+            'dropped': self.dropped,
+            'reconnects': self.reconnects,
+        }
+
+
+change_feed = ChangeFeed()
+
+
+def format_event(change):
+    '''A change as a server-sent event.'''
+    change_id, operation, data = change
+    return f'id: {change_id}\nevent: {operation}\ndata: {data}\n\n'.encode()
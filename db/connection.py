@@ -1,22 +1,21 @@
 from pg8000.native import Connection
-from dotenv import load_dotenv
-import os
+from db.settings import get_settings
+import socket
 
-#TESTING = os.getenv('TESTING')
 
-def load_enviroment(env):
-    if env == 'test':
-        load_dotenv('.env.test')
-    else:
-        load_dotenv('.env.dev')
-
-
-def connect_to_db():
-    print(os.getenv("PG_DATABASE"))
-    return Connection(
-        user=os.getenv("PG_USER"),
-        password=os.getenv("PG_PASSWORD"),
-        database=os.getenv("PG_DATABASE"),
-        host=os.getenv("PG_HOST"),
-        port=int(os.getenv("PG_PORT"))
-    )
+def connect_to_db(settings=None):
+    settings = settings or get_settings()
+    # pg8000 leaves Nagle's algorithm on, which holds the small trailing
+    # messages of a COPY back until the server's delayed ACK (~40ms)
+    sock = socket.create_connection((settings.pg_host, settings.pg_port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        return Connection(
+            user=settings.pg_user,
+            password=settings.pg_password,
+            database=settings.pg_database,
+            sock=sock
+        )
+    except Exception:
+        sock.close()
+        raise
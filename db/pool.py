@@ -0,0 +1,271 @@
+'''This module contains a bounded, thread-safe pool of pg8000 connections
+for the `Cat's Rare Treasures` FastAPI app.'''
+
+from db.connection import connect_to_db
+from db.settings import get_settings, on_reload
+from db.timing import timed_phase
+from db.statements import StatementCache
+from contextlib import contextmanager
+from dataclasses import replace
+from collections import deque
+from pg8000 import InterfaceError
+import threading
+import time
+
+
+# pg8000 reports the backend transaction status with these bytes
+IDLE = b'I'
+IN_FAILED_TRANSACTION = b'E'
+
+
+class PoolTimeout(Exception):
+    '''Raised when no connection could be checked out within the timeout.'''
+
+
+class ConnectionPool:
+    '''A bounded LIFO pool of connections.
+
+    Connections are created lazily up to `max_size`, and `min_size` of them
+    are kept open even when idle. Anything idle for longer than
+    `idle_timeout` seconds beyond the minimum is closed. A connection that
+    has been idle for more than `health_check_after` seconds is pinged with
+    `SELECT 1` before it is handed out, and dropped if the ping fails.
+    '''
+
+    def __init__(self, connect, min_size=1, max_size=10, idle_timeout=300.0,
+                 checkout_timeout=5.0, health_check_after=30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1')
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check_after = health_check_after
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, released_at), most recently used on the right
+        self._in_use = set()
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def open(self):
+        with self._cond:
+            missing = self.min_size - self._size
+            self._size += missing
+        for _ in range(missing):
+            conn = self._new_connection()
+            self.release(conn)
+        return self
+
+    def _new_connection(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created += 1
+            self._in_use.add(conn)
+        return conn
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, idle_for):
+        if getattr(conn, '_usock', True) is None:
+            return False
+        if idle_for < self.health_check_after:
+            return True
+        try:
+            conn.run('SELECT 1')
+            return True
+        except Exception:
+            return False
+
+    def _reap_idle(self, now):
+        '''Pop connections that outlived the idle timeout; call with the lock held.'''
+        expired = []
+        while self._idle and self._size > self.min_size:
+            conn, released_at = self._idle[0]
+            if now - released_at < self.idle_timeout:
+                break
+            self._idle.popleft()
+            self._size -= 1
+            self._discarded += 1
+            expired.append(conn)
+        return expired
+
+    def acquire(self, timeout=None):
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            expired = []
+            conn = None
+            create = False
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeout('The connection pool is closed')
+                expired = self._reap_idle(time.monotonic())
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    self._in_use.add(conn)
+                elif self._size < self.max_size:
+                    self._size += 1
+                    create = True
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(f'Could not get a database connection within {timeout}s')
+                    self._waiting += 1
+                    self._cond.wait(remaining)
+                    self._waiting -= 1
+                    continue
+            for stale in expired:
+                self._close_quietly(stale)
+
+            if create:
+                conn = self._new_connection()
+            elif not self._is_healthy(conn, time.monotonic() - released_at):
+                self.release(conn, discard=True)
+                continue
+
+            waited = time.monotonic() - started
+            with self._cond:
+                self._checkouts += 1
+                self._total_wait += waited
+                self._max_wait = max(self._max_wait, waited)
+            return conn
+
+    def release(self, conn, discard=False):
+        status = getattr(conn, '_transaction_status', IDLE)
+        if not discard and status == IN_FAILED_TRANSACTION:
+            try:
+                conn.run('ROLLBACK')
+                status = IDLE
+            except Exception:
+                discard = True
+        if status not in (IDLE, None):
+            discard = True
+        with self._cond:
+            self._in_use.discard(conn)
+            if discard or self._closed:
+                self._size -= 1
+                self._discarded += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            self._close_quietly(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        with timed_phase('connect'):
+            conn = self.acquire(timeout)
+        try:
+            yield conn
+        except BaseException as e:
+            # Errors reported by the server leave the connection usable,
+            # socket-level failures leave it in an unknown state. BaseException
+            # also covers GeneratorExit, from a generator closed mid-stream
+            self.release(conn, discard=isinstance(e, (InterfaceError, OSError)))
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'discarded': self._discarded,
+                'total_wait_ms': round(self._total_wait * 1000, 3),
+                'avg_wait_ms': round(self._total_wait * 1000 / self._checkouts, 3) if self._checkouts else 0.0,
+                'max_wait_ms': round(self._max_wait * 1000, 3),
+            }
+
+
+# one pool per server, keyed by replica name (None for the primary)
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def connect_with_statement_cache(settings):
+    conn = connect_to_db(settings)
+    conn.statement_cache = StatementCache(settings.prepared_statement_cache_size)
+    return conn
+
+
+def get_pool(endpoint=None):
+    '''The pool of the primary, or of the replica `endpoint`.'''
+    name = endpoint.name if endpoint is not None else None
+    pool = _pools.get(name)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(name)
+            if pool is None:
+                settings = get_settings()
+                if endpoint is not None:
+                    settings = replace(settings, pg_host=endpoint.host, pg_port=endpoint.port)
+                pool = _pools[name] = ConnectionPool(
+                    lambda: connect_with_statement_cache(settings),
+                    min_size=settings.pool_min_size,
+                    max_size=settings.pool_max_size,
+                    idle_timeout=settings.pool_idle_timeout,
+                    checkout_timeout=settings.pool_checkout_timeout,
+                    health_check_after=settings.pool_health_check_after,
+                ).open()
+    return pool
+
+
+def close_pool():
+    with _pool_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        # connections still in use are closed as they are released
+        pool.close()
+
+
+@on_reload
+def apply_pool_settings(new, old):
+    if new.connection_changed(old):
+        close_pool()
+        return
+    for pool in list(_pools.values()):
+        pool.idle_timeout = new.pool_idle_timeout
+        pool.checkout_timeout = new.pool_checkout_timeout
+        pool.health_check_after = new.pool_health_check_after
@@ -0,0 +1,231 @@
+'''This module decides which server each query goes to.
+
+Writes always go to the primary (PG_HOST). Reads of the listing endpoints
+are spread across the replicas in PG_REPLICAS, round-robin or to the
+replica with the fewest reads in flight. If none is usable, they go to
+the primary.
+
+A replica that cannot be reached, or that is shutting down or restarting,
+is left out for `replica_retry_after` seconds and then tried again.
+
+Replicas lag behind the primary. After a write the client gets the
+primary's WAL position in an `X-Session-Token` header. A read that sends
+the token back only uses a replica that has replayed at least that far.
+The replica gets up to `replica_wait_timeout` seconds to catch up,
+otherwise the read goes to the primary.
+'''
+
+from db.settings import get_settings, on_reload
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pg8000 import InterfaceError
+import itertools
+import threading
+import time
+
+
+SESSION_TOKEN_HEADER = 'x-session-token'
+
+# connection failures (08, including asyncpg's lost connections), server
+# shutting down or starting up (57P), and queries cancelled by a conflict
+# with WAL replay (40001)
+UNAVAILABLE_SQLSTATES = ('08', '57P', '40001')
+
+
+class ReplicaUnavailable(Exception):
+    '''Raised when a replica could not serve a read it was sent.'''
+
+    def __init__(self, endpoint, error):
+        super().__init__(f'Replica {endpoint.name} is unavailable: {error}')
+        self.endpoint = endpoint
+        self.error = error
+
+
+def is_unavailable(error):
+    '''True if `error` means the server could not serve the query, not that the query was wrong.'''
+    if isinstance(error, (OSError, InterfaceError)):
+        return True
+    sqlstate = getattr(error, 'sqlstate', None)
+    if sqlstate is None and error.args and isinstance(error.args[0], dict):
+        sqlstate = error.args[0].get('C')
+    return bool(sqlstate) and sqlstate.startswith(UNAVAILABLE_SQLSTATES)
+
+
+def parse_lsn(text):
+    '''Turn a WAL position such as `0/4F000060` into an int, or None if it is not one.'''
+    try:
+        high, low = text.split('/')
+        return (int(high, 16) << 32) + int(low, 16)
+    except (AttributeError, ValueError):
+        return None
+
+
+class Endpoint:
+    '''A replica and what the router knows about it.'''
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.name = f'{host}:{port}'
+        self.in_flight = 0
+        self.reads = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self.replayed_lsn = 0
+        self.last_error = None
+
+
+class ReplicaRouter:
+    '''Pick the replica for each read and track which replicas are healthy.'''
+
+    STRATEGIES = ('round_robin', 'least_connections')
+
+    def __init__(self, replicas, strategy='round_robin', retry_after=10.0, wait_timeout=0.5):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f'REPLICA_STRATEGY must be one of {", ".join(self.STRATEGIES)}, got {strategy!r}')
+        self.replicas = [Endpoint(host, port) for host, port in replicas]
+        self.strategy = strategy
+        self.retry_after = retry_after
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        self.primary_reads = 0
+        self.fallbacks = 0
+
+    def candidates(self):
+        '''The healthy replicas in the order they should be tried.'''
+        now = time.monotonic()
+        with self._lock:
+            healthy = [endpoint for endpoint in self.replicas if endpoint.down_until <= now]
+            if not healthy:
+                return []
+            start = next(self._turn) % len(healthy)
+            healthy = healthy[start:] + healthy[:start]
+            if self.strategy == 'least_connections':
+                # the sort is stable, so ties still take turns
+                healthy.sort(key=lambda endpoint: endpoint.in_flight)
+            return healthy
+
+    @contextmanager
+    def reading_from(self, endpoint):
+        '''Count a read in flight on `endpoint` (None is the primary).'''
+        with self._lock:
+            if endpoint is None:
+                self.primary_reads += 1
+            else:
+                endpoint.in_flight += 1
+                endpoint.reads += 1
+        try:
+            yield
+        finally:
+            if endpoint is not None:
+                with self._lock:
+                    endpoint.in_flight -= 1
+
+    def mark_down(self, endpoint, error):
+        with self._lock:
+            endpoint.failures += 1
+            endpoint.down_until = time.monotonic() + self.retry_after
+            endpoint.last_error = str(error)
+            self.fallbacks += 1
+
+    def note_replayed(self, endpoint, lsn):
+        with self._lock:
+            endpoint.replayed_lsn = max(endpoint.replayed_lsn, lsn)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'strategy': self.strategy,
+                'primary_reads': self.primary_reads,
+                'fallbacks': self.fallbacks,
+                'replicas': [{
+                    'name': endpoint.name,
+                    'healthy': endpoint.down_until <= now,
+                    'in_flight': endpoint.in_flight,
+                    'reads': endpoint.reads,
+                    'failures': endpoint.failures,
+                    'last_error': endpoint.last_error,
+                } for endpoint in self.replicas],
+            }
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                settings = get_settings()
+                _router = ReplicaRouter(settings.replica_addresses(), settings.replica_strategy,
+                                        settings.replica_retry_after, settings.replica_wait_timeout)
+    return _router
+
+
+@on_reload
+def apply_routing_settings(new, old):
+    global _router
+    if (new.pg_replicas, new.replica_strategy) != (old.pg_replicas, old.replica_strategy):
+        with _router_lock:
+            _router = None
+        return
+    router = _router
+    if router is not None:
+        router.retry_after = new.replica_retry_after
+        router.wait_timeout = new.replica_wait_timeout
+
+
+class Session:
+    __slots__ = ('read_after', 'issued')
+
+    def __init__(self, read_after=None):
+        self.read_after = read_after
+        self.issued = None
+
+
+_session = ContextVar('session', default=None)
+
+
+def session_read_after():
+    '''The WAL position this request's reads must see, from its X-Session-Token.'''
+    session = _session.get()
+    return session.read_after if session is not None else None
+
+
+def issue_session_token(lsn):
+    '''Send `lsn` back to the client as its X-Session-Token.'''
+    session = _session.get()
+    if session is not None:
+        session.issued = lsn
+
+
+class SessionTokenMiddleware:
+    '''Read the client's X-Session-Token and return the one a write issued.
+
+    A token that is not a WAL position is ignored.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        token = dict(scope['headers']).get(SESSION_TOKEN_HEADER.encode())
+        session = Session(parse_lsn(token.decode('latin-1')) if token else None)
+        context_token = _session.set(session)
+
+        async def send_with_token(message):
+            if message['type'] == 'http.response.start' and session.issued:
+                message = {**message, 'headers': [*message.get('headers', []),
+                                                  (SESSION_TOKEN_HEADER.encode(), session.issued.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_token)
+        finally:
+            _session.reset(context_token)
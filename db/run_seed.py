@@ -4,12 +4,14 @@ from seed import seed_db
 import os
 
 TESTING = os.getenv('TESTING')
+# SEED_SCALE=N loads N synthetic copies of the treasures, for load testing
+SEED_SCALE = int(os.getenv('SEED_SCALE', 1))
 
 try:
     if TESTING:
-        seed_db(TESTING.lower())
+        seed_db(TESTING.lower(), scale=SEED_SCALE)
     else:
-        seed_db('dev')
+        seed_db('dev', scale=SEED_SCALE)
 except Exception as e:
     print(e)
     raise e
@@ -1,84 +1,293 @@
-from db.connection import connect_to_db, load_enviroment
+from db.connection import connect_to_db
+from db.settings import Settings
+from db.utils import format_rows_as_csv
+from db.shop_summary import create_shop_summary
+from db import shop_summary
+from db.changes import create_change_feed
+from db import changes
+from pg8000 import DatabaseError, InterfaceError
+import hashlib
 import json
+import glob
 
 
-def seed_db(env='test'):
-    load_enviroment(env)
-    print("\U0001FAB4", "Seeding Database...")
-    db = connect_to_db()
-    db.run("DROP TABLE if exists treasures")
-    db.run("DROP TABLE if exists shops")
-
-    db.run(
-        'CREATE TABLE shops (\
-        shop_id SERIAL PRIMARY KEY, \
-        shop_name VARCHAR(42) NOT NULL, \
-        owner VARCHAR(42), \
-        slogan VARCHAR (256)\
-        )'
-    )
-    db.run(
-        'CREATE TABLE treasures (\
-        treasure_id SERIAL PRIMARY KEY,\
-        treasure_name VARCHAR(256) NOT NULL,\
-        colour VARCHAR (42),\
-        age INT,\
-        cost_at_auction FLOAT(2),\
-        shop_id INT REFERENCES shops(shop_id)\
-        )'
-    )
-
-    with open(f'data/{env}-data/shops.json', 'r') as file:
-        SHOPS_DATA = json.load(file)
-        ROWS = SHOPS_DATA['shops']
-        row_count = 0
-        for row in ROWS:
-            db.run(
-                'INSERT INTO shops (shop_name, owner, slogan)\
-                VALUES (:shop_name, :owner, :slogan)',
-                shop_name=row['shop_name'],
-                owner=row['owner'],
-                slogan=row['slogan']
+CHUNK_SIZE = 1 << 16
+COPY_BATCH_ROWS = 10000
+
+SORT_COLUMNS = ['age', 'cost_at_auction', 'treasure_name']
+
+# One index per sort order `get_treasures` allows, alone and behind the
+# colour filter, each ending in treasure_id to match its tie-breaker and
+# keyset cursor. age ranges are served by the age indexes; treasure_id
+# sorts use the primary key. shop_id serves the shops join and aggregate.
+INDEXES = {
+    'treasures_shop_id_idx': ['shop_id'],
+    'treasures_colour_treasure_id_idx': ['colour', 'treasure_id'],
+    **{f'treasures_{column}_idx': [column, 'treasure_id'] for column in SORT_COLUMNS},
+    **{f'treasures_colour_{column}_idx': ['colour', column, 'treasure_id'] for column in SORT_COLUMNS},
+}
+
+# A pg_trgm GIN index for the `q` name search. It serves prefix and
+# substring ILIKE patterns and the fuzzy word similarity match; relevance
+# is computed only for the rows it finds.
+SEARCH_INDEXES = {
+    'treasures_treasure_name_trgm_idx': 'gin (treasure_name gin_trgm_ops)',
+}
+
+
+def create_indexes(db):
+    '''Create any missing index from INDEXES and SEARCH_INDEXES, e.g. on a database seeded before it changed.'''
+    for name, columns in INDEXES.items():
+        db.run(f'CREATE INDEX IF NOT EXISTS {name} ON treasures ({", ".join(columns)})')
+    db.run('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, definition in SEARCH_INDEXES.items():
+        db.run(f'CREATE INDEX IF NOT EXISTS {name} ON treasures USING {definition}')
+
+
+# the tables a seed fills, in the order their snapshots are restored
+# the outbox is emptied but its sequence is not reset, so a running change feed
+# never sees a change id again
+SEEDED_TABLES = ['shops', 'treasures', 'shop_stock_summary', 'treasure_changes']
+SERIAL_COLUMNS = {'shops': 'shop_id', 'treasures': 'treasure_id'}
+SNAPSHOT_SCHEMA = 'seed_snapshot'
+# past this many rows a table's indexes are dropped for the restore and
+# built again afterwards, which beats updating them row by row
+BULK_RESTORE_ROWS = 10000
+
+
+def seed_fingerprint(env, scale):
+    '''Identify what seeding `env` at `scale` loads: the data files and the code that loads them.'''
+    digest = hashlib.blake2b(f'{env}:{scale}'.encode(), digest_size=16)
+    for path in sorted(glob.glob(f'data/{env}-data/*.json')) + [__file__, shop_summary.__file__, changes.__file__]:
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def take_snapshot(db, fingerprint):
+    '''Copy the seeded rows into SNAPSHOT_SCHEMA; call inside the seed's transaction.'''
+    db.run(f'DROP SCHEMA IF EXISTS {SNAPSHOT_SCHEMA} CASCADE')
+    db.run(f'CREATE SCHEMA {SNAPSHOT_SCHEMA}')
+    db.run(f'CREATE TABLE {SNAPSHOT_SCHEMA}.tables (table_name TEXT PRIMARY KEY, row_count BIGINT NOT NULL)')
+    for table in SEEDED_TABLES:
+        db.run(f'CREATE TABLE {SNAPSHOT_SCHEMA}.{table} AS TABLE public.{table}')
+        db.run(f'INSERT INTO {SNAPSHOT_SCHEMA}.tables VALUES (:table, :row_count)', table=table,
+               row_count=db.row_count)
+    db.run(f'CREATE TABLE {SNAPSHOT_SCHEMA}.fingerprint AS SELECT CAST(:fingerprint AS TEXT) AS fingerprint',
+           fingerprint=fingerprint)
+
+
+def snapshot_fingerprint(db):
+    [[exists]] = db.run(f"SELECT to_regclass('{SNAPSHOT_SCHEMA}.fingerprint') IS NOT NULL")
+    if not exists:
+        return None
+    [[fingerprint]] = db.run(f'SELECT fingerprint FROM {SNAPSHOT_SCHEMA}.fingerprint')
+    return fingerprint
+
+
+def get_index_definitions(db, table):
+    # constraint indexes (the primary key) stay; they go with their constraint
+    return db.run('''SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index
+            WHERE indrelid = CAST(:table AS regclass)
+            AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = indexrelid)''', table=table)
+
+
+def restore_snapshot(db):
+    db.run('START TRANSACTION')
+    try:
+        row_counts = dict(db.run(f'SELECT table_name, row_count FROM {SNAPSHOT_SCHEMA}.tables'))
+        db.run(f'TRUNCATE {", ".join(SEEDED_TABLES)}')
+        # the summary comes back as it was seeded, so its triggers must not add the treasures again;
+        # a superuser can also skip the foreign key checks, the snapshot was consistent when taken
+        [[superuser]] = db.run('SELECT rolsuper FROM pg_roles WHERE rolname = current_user')
+        triggers = 'ALL' if superuser else 'USER'
+        db.run(f'ALTER TABLE treasures DISABLE TRIGGER {triggers}')
+        for table in SEEDED_TABLES:
+            indexes = get_index_definitions(db, table) if row_counts[table] > BULK_RESTORE_ROWS else []
+            for name, _ in indexes:
+                db.run(f'DROP INDEX {name}')
+            db.run(f'INSERT INTO {table} SELECT * FROM {SNAPSHOT_SCHEMA}.{table}')
+            for _, definition in indexes:
+                db.run(definition)
+        db.run(f'ALTER TABLE treasures ENABLE TRIGGER {triggers}')
+        for table, column in SERIAL_COLUMNS.items():
+            db.run(f"SELECT setval(pg_get_serial_sequence('{table}', '{column}'), COALESCE(MAX({column}), 1), "
+                   f"MAX({column}) IS NOT NULL) FROM {table}")
+        db.run('COMMIT')
+    except Exception:
+        db.run('ROLLBACK')
+        raise
+    # TRUNCATE forgets the row counts the planner estimates from
+    for table in SEEDED_TABLES:
+        db.run(f'ANALYZE {table}')
+
+
+# one per env, kept open: starting a backend costs more than a small restore
+_restore_connections = {}
+
+
+def get_restore_connection(env):
+    db = _restore_connections.get(env)
+    if db is not None:
+        try:
+            db.run('SELECT 1')
+            return db
+        except (InterfaceError, OSError):
+            pass
+    db = _restore_connections[env] = connect_to_db(Settings.load(env))
+    return db
+
+
+def restore_db(env='test', scale=1):
+    '''Put `env` back to a fresh seed at `scale`, from the snapshot the last seed took.
+
+    Seeding reads the data files, recreates the tables and builds every
+    index. Restoring only truncates the seeded tables and copies the
+    snapshot back into them, so tables, indexes and the app's prepared
+    statements stay in place. Without a snapshot of the same data files,
+    scale and seeding code, it seeds and takes one.
+    '''
+    db = get_restore_connection(env)
+    if snapshot_fingerprint(db) == seed_fingerprint(env, scale):
+        try:
+            restore_snapshot(db)
+            return
+        except DatabaseError as e:
+            # e.g. the tables were changed by hand since the snapshot
+            print(f'Could not restore the seed snapshot, seeding instead: {e}')
+    seed_db(env, scale, snapshot=True)
+
+
+def iter_json_array(path, key):
+    '''Yield the items of the top-level `key` array without loading the whole file.'''
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as file:
+        buffer = ''
+        position = -1
+        while position < 0:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                raise ValueError(f'No "{key}" array in {path}')
+            buffer += chunk
+            key_position = buffer.find(f'"{key}"')
+            if key_position >= 0:
+                position = buffer.find('[', key_position)
+        buffer = buffer[position + 1:]
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                chunk = file.read(CHUNK_SIZE)
+                if not chunk:
+                    raise
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield item
+            position = end
+
+
+def iter_csv_batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == COPY_BATCH_ROWS:
+            yield format_rows_as_csv(batch)
+            batch = []
+    if batch:
+        yield format_rows_as_csv(batch)
+
+
+def iter_treasure_rows(env, shop_ids, scale, counter):
+    for copy in range(scale):
+        for row in iter_json_array(f'data/{env}-data/treasures.json', 'treasures'):
+            treasure_name = row.get('treasure_name')
+            # synthetic copies keep every value but the name
+            if copy and treasure_name is not None:
+                treasure_name = f'{treasure_name} #{copy}'
+            counter[0] += 1
+            yield (
+                treasure_name,
+                row.get('colour'),
+                row.get('age'),
+                row.get('cost_at_auction'),
+                shop_ids[row['shop']] if 'shop' in row else None,
             )
-            row_count += 1
+
+
+def seed_db(env='test', scale=1, snapshot=False):
+    '''Recreate and load the tables for `env`, with `scale` copies of the treasures.
+
+    With `snapshot`, also keep a copy of the rows for restore_db.
+    '''
+    print("\U0001FAB4", "Seeding Database...")
+    db = connect_to_db(Settings.load(env))
+    try:
+        db.run('START TRANSACTION')
+        db.run("DROP TABLE if exists shop_stock_summary")
+        db.run("DROP TABLE if exists treasure_changes")
+        db.run("DROP TABLE if exists treasures")
+        db.run("DROP TABLE if exists shops")
+
+        db.run(
+            'CREATE TABLE shops (\
+            shop_id SERIAL PRIMARY KEY, \
+            shop_name VARCHAR(42) NOT NULL, \
+            owner VARCHAR(42), \
+            slogan VARCHAR (256)\
+            )'
+        )
+        db.run(
+            'CREATE TABLE treasures (\
+            treasure_id SERIAL PRIMARY KEY,\
+            treasure_name VARCHAR(256) NOT NULL,\
+            colour VARCHAR (42),\
+            age INT,\
+            cost_at_auction FLOAT(2),\
+            shop_id INT REFERENCES shops(shop_id)\
+            )'
+        )
+
+        # shop ids are assigned here, in file order, so treasures can be
+        # resolved to them without reading the shops back
+        shop_ids = {}
+        shop_rows = []
+        for row in iter_json_array(f'data/{env}-data/shops.json', 'shops'):
+            shop_ids[row['shop_name']] = len(shop_rows) + 1
+            shop_rows.append((len(shop_rows) + 1, row['shop_name'], row.get('owner'), row.get('slogan')))
+        db.run('COPY shops (shop_id, shop_name, owner, slogan) FROM STDIN WITH (FORMAT csv)',
+               stream=iter_csv_batches(shop_rows))
+        db.run("SELECT setval(pg_get_serial_sequence('shops', 'shop_id'), :last_id, :is_called)",
+               last_id=max(len(shop_rows), 1), is_called=bool(shop_rows))
         print(
-            f'\U0001F4BE Successfully seeded {row_count} rows to \
+            f'\U0001F4BE Successfully seeded {len(shop_rows)} rows to \
 `shops` table in the database. \U0001F44D')
 
-    SHOPS = db.run('SELECT * FROM shops')
-    SHOP_IDS = {shop[1]: shop[0] for shop in SHOPS}
-
-    with open(f'data/{env}-data/treasures.json', 'r') as file:
-        TREASURES_DATA = json.load(file)
-        ROWS = TREASURES_DATA['treasures']
-        row_count = 0
-        for row in ROWS:
-            ROW_VALUES = {
-                "treasure_name": row['treasure_name']
-                if 'treasure_name' in row else None,
-                "colour": row['colour']
-                if 'colour' in row else None,
-                "age": row['age']
-                if 'age' in row else None,
-                "cost_at_auction": row['cost_at_auction']
-                if 'cost_at_auction' in row else None,
-                "shop_id": SHOP_IDS[row['shop']] if 'shop' in row else None,
-            }
-            db.run(
-                'INSERT INTO treasures (treasure_name, colour, age, \
-                cost_at_auction, shop_id)\
-                VALUES (:treasure_name, :colour, :age,:cost_at_auction, \
-                :shop_id)',
-                treasure_name=ROW_VALUES['treasure_name'],
-                colour=ROW_VALUES['colour'],
-                age=ROW_VALUES['age'],
-                cost_at_auction=ROW_VALUES['cost_at_auction'],
-                shop_id=ROW_VALUES['shop_id']
-            )
-
-            row_count += 1
+        counter = [0]
+        db.run('COPY treasures (treasure_name, colour, age, cost_at_auction, shop_id) FROM STDIN WITH (FORMAT csv)',
+               stream=iter_csv_batches(iter_treasure_rows(env, shop_ids, scale, counter)))
         print(
-            f'\U0001F4BE Successfully seeded {row_count} rows to `treasures` \
+            f'\U0001F4BE Successfully seeded {counter[0]} rows to `treasures` \
 table in the database. \U0001F44D')
 
-    db.close()
+        # built after the data is loaded, which is much cheaper than
+        # maintaining them row by row during the COPY
+        create_indexes(db)
+        create_shop_summary(db)
+        create_change_feed(db)
+        if snapshot:
+            take_snapshot(db, seed_fingerprint(env, scale))
+        db.run('COMMIT')
+        db.run('ANALYZE shops')
+        db.run('ANALYZE treasures')
+        db.run('ANALYZE shop_stock_summary')
+    except Exception:
+        db.run('ROLLBACK')
+        raise
+    finally:
+        db.close()
@@ -0,0 +1,59 @@
+'''This module contains the compact result rows and the orjson-backed JSON
+encoding used for API responses.'''
+
+from fastapi.responses import JSONResponse
+import orjson
+
+
+class Rows:
+    '''Result rows kept as the driver's tuples under one shared column header.
+
+    Rows become objects only while they are encoded, so a result is never
+    held as a list of dicts.
+    '''
+
+    __slots__ = ('columns', 'rows')
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return dict(zip(self.columns, self.rows[index]))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.columns == other.columns and self.rows == other.rows
+
+    def to_json_value(self):
+        columns = self.columns
+        return [dict(zip(columns, row)) for row in self.rows]
+
+
+class ColumnarRows(Rows):
+    '''Rows encoded as {"columns": [...], "rows": [[...], ...]}.'''
+
+    __slots__ = ()
+
+    def to_json_value(self):
+        # orjson writes the tuples as arrays without visiting them in Python
+        return {'columns': self.columns, 'rows': self.rows}
+
+
+def encode_default(value):
+    if isinstance(value, Rows):
+        return value.to_json_value()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps(content):
+    return orjson.dumps(content, default=encode_default)
+
+
+class FastJSONResponse(JSONResponse):
+    '''A JSONResponse rendered by orjson that also understands Rows.'''
+
+    def render(self, content):
+        return dumps(content)
@@ -0,0 +1,200 @@
+'''This module holds the typed settings of the `Cat's Rare Treasures` app.
+
+Settings are read once, from `.env.test` or `.env.dev` (chosen by TESTING).
+Environment variables override the file. Modules read the current values
+through `get_settings()` instead of calling `getenv` on the hot path.
+
+`reload_settings()` re-reads them and hands the old and new settings to every
+listener registered with `on_reload`. The app calls it on SIGHUP and when
+the env file changes. A settings file that fails to parse is logged and the
+current settings are kept.
+'''
+
+from dataclasses import dataclass, field, fields
+from dotenv import dotenv_values
+import threading
+import logging
+import signal
+import os
+
+
+log = logging.getLogger('cats_rare_treasures.settings')
+
+
+def setting(env_name, default=None):
+    return field(default=default, metadata={'env': env_name})
+
+
+@dataclass(frozen=True)
+class Settings:
+    env: str = 'dev'
+
+    pg_user: str = setting('PG_USER')
+    pg_password: str = setting('PG_PASSWORD')
+    pg_database: str = setting('PG_DATABASE')
+    pg_host: str = setting('PG_HOST', 'localhost')
+    pg_port: int = setting('PG_PORT', 5432)
+    # read replicas as comma-separated host:port pairs; empty sends reads to the primary
+    pg_replicas: str = setting('PG_REPLICAS', '')
+    replica_strategy: str = setting('REPLICA_STRATEGY', 'round_robin')
+    replica_retry_after: float = setting('REPLICA_RETRY_AFTER', 10.0)
+    replica_wait_timeout: float = setting('REPLICA_WAIT_TIMEOUT', 0.5)
+
+    db_mode: str = setting('DB_MODE', 'async')
+    pool_min_size: int = setting('PG_POOL_MIN_SIZE', 1)
+    pool_max_size: int = setting('PG_POOL_MAX_SIZE', 10)
+    pool_idle_timeout: float = setting('PG_POOL_IDLE_TIMEOUT', 300.0)
+    pool_checkout_timeout: float = setting('PG_POOL_CHECKOUT_TIMEOUT', 5.0)
+    pool_health_check_after: float = setting('PG_POOL_HEALTH_CHECK_AFTER', 30.0)
+    prepared_statement_cache_size: int = setting('PREPARED_STATEMENT_CACHE_SIZE', 128)
+
+    response_cache_ttl: float = setting('RESPONSE_CACHE_TTL', 30.0)
+    response_cache_max_entries: int = setting('RESPONSE_CACHE_MAX_ENTRIES', 1024)
+    response_cache_max_bytes: int = setting('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+    row_cache_ttl: float = setting('ROW_CACHE_TTL', 30.0)
+    row_cache_max_entries: int = setting('ROW_CACHE_MAX_ENTRIES', 10000)
+    # ids per GET /api/treasures/batch, and per query when a POST is split up
+    batch_max_ids: int = setting('BATCH_MAX_IDS', 1000)
+    batch_post_max_ids: int = setting('BATCH_POST_MAX_IDS', 50000)
+    count_cache_ttl: float = setting('COUNT_CACHE_TTL', 5.0)
+    count_exact_threshold: int = setting('COUNT_EXACT_THRESHOLD', 10000)
+
+    bulk_batch_size: int = setting('BULK_BATCH_SIZE', 5000)
+    stream_chunk_size: int = setting('STREAM_CHUNK_SIZE', 1000)
+    # catalogue pages of more rows than this, or with no limit, are streamed and not cached
+    html_stream_rows: int = setting('HTML_STREAM_ROWS', 500)
+    # seconds between keepalive comments on an idle /api/changes stream
+    change_feed_heartbeat: float = setting('CHANGE_FEED_HEARTBEAT', 15.0)
+    # the change listener also reads the outbox this often, in case a notification was lost
+    change_feed_poll_interval: float = setting('CHANGE_FEED_POLL_INTERVAL', 5.0)
+    change_feed_queue_size: int = setting('CHANGE_FEED_QUEUE_SIZE', 1000)
+    # seconds changes are kept for subscribers to resume from; 0 keeps them all
+    change_feed_retention: float = setting('CHANGE_FEED_RETENTION', 86400.0)
+    server_timing: bool = setting('SERVER_TIMING', False)
+    slow_query_ms: float = setting('SLOW_QUERY_MS', 500.0)
+    settings_watch_interval: float = setting('SETTINGS_WATCH_INTERVAL', 2.0)
+
+    @staticmethod
+    def env_file(env):
+        return '.env.test' if env == 'test' else '.env.dev'
+
+    @classmethod
+    def load(cls, env=None):
+        '''Read the settings for `env` (default: TESTING, else dev).'''
+        env = env or os.getenv('TESTING') or 'dev'
+        values = {**dotenv_values(cls.env_file(env)), **os.environ}
+        kwargs = {'env': env}
+        for settings_field in fields(cls):
+            env_name = settings_field.metadata.get('env')
+            raw = values.get(env_name) if env_name else None
+            if raw is None or raw == '':
+                continue
+            kwargs[settings_field.name] = parse_setting(env_name, settings_field.type, raw)
+        return cls(**kwargs)
+
+    # these only take effect on new connections, so changing them replaces the pools
+    CONNECTION_FIELDS = ('pg_user', 'pg_password', 'pg_database', 'pg_host', 'pg_port', 'pg_replicas',
+                         'pool_min_size', 'pool_max_size', 'prepared_statement_cache_size')
+
+    def connection_changed(self, other):
+        return any(getattr(self, name) != getattr(other, name) for name in self.CONNECTION_FIELDS)
+
+    def replica_addresses(self):
+        '''Return [(host, port), ...] from PG_REPLICAS; a missing port means PG_PORT.'''
+        addresses = []
+        for address in filter(None, (part.strip() for part in self.pg_replicas.split(','))):
+            host, _, port = address.partition(':')
+            try:
+                addresses.append((host, int(port) if port else self.pg_port))
+            except ValueError:
+                raise ValueError(f'PG_REPLICAS must be host:port pairs, got {address!r}')
+        return addresses
+
+
+def parse_setting(env_name, setting_type, raw):
+    try:
+        if setting_type is bool:
+            return raw.strip().lower() in ('1', 'true', 'yes', 'on')
+        return setting_type(raw)
+    except ValueError:
+        raise ValueError(f'{env_name} must be {setting_type.__name__}, got {raw!r}')
+
+
+_settings = None
+_listeners = []
+_lock = threading.Lock()
+
+
+def get_settings():
+    global _settings
+    if _settings is None:
+        with _lock:
+            if _settings is None:
+                _settings = Settings.load()
+    return _settings
+
+
+def on_reload(listener):
+    '''Call `listener(new, old)` whenever reloading changes the settings.'''
+    _listeners.append(listener)
+    return listener
+
+
+def reload_settings():
+    '''Re-read the settings and notify the listeners; returns the settings now in effect.'''
+    global _settings
+    with _lock:
+        old = _settings or Settings.load()
+        try:
+            new = Settings.load(old.env)
+        except ValueError as e:
+            log.error('Keeping the current settings: %s', e)
+            return old
+        if new == old:
+            return old
+        _settings = new
+    log.warning('Settings reloaded from %s', Settings.env_file(new.env))
+    for listener in _listeners:
+        listener(new, old)
+    return new
+
+
+def watch_settings_file(interval=None):
+    '''Reload whenever the env file's mtime changes; returns an Event that stops the watcher.'''
+    interval = get_settings().settings_watch_interval if interval is None else interval
+    stop = threading.Event()
+    if interval <= 0:
+        return stop
+
+    def mtime():
+        try:
+            return os.stat(Settings.env_file(get_settings().env)).st_mtime_ns
+        except OSError:
+            return None
+
+    def watch():
+        last = mtime()
+        while not stop.wait(interval):
+            current = mtime()
+            if current != last:
+                last = current
+                reload_settings()
+
+    threading.Thread(target=watch, name='settings-watcher', daemon=True).start()
+    return stop
+
+
+def install_sighup_handler(loop):
+    '''Reload on SIGHUP; returns False where signals cannot be handled (e.g. off the main thread).'''
+    try:
+        loop.add_signal_handler(signal.SIGHUP, reload_settings)
+        return True
+    except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+        return False
+
+
+def remove_sighup_handler(loop):
+    try:
+        loop.remove_signal_handler(signal.SIGHUP)
+    except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+        pass
@@ -0,0 +1,138 @@
+'''This module maintains `shop_stock_summary`, the per-shop stock value and
+treasure count served by GET /api/shops.
+
+Triggers on `treasures` keep the summary current as rows are written, one
+grouped update per statement. The summary can also be rebuilt from scratch
+or checked against the live aggregate from the command line:
+
+    python -m db.shop_summary rebuild [test|dev]
+    python -m db.shop_summary check [test|dev]
+'''
+
+from db.connection import connect_to_db
+from db.settings import Settings
+import sys
+
+
+# priced_count tracks the rows with a cost, so a shop whose treasures are
+# all unpriced still reports a NULL stock_value like SUM() would
+SUMMARY_TABLE = '''CREATE TABLE shop_stock_summary (
+            shop_id INT PRIMARY KEY REFERENCES shops(shop_id) ON DELETE CASCADE,
+            stock_value DOUBLE PRECISION NOT NULL DEFAULT 0,
+            treasure_count INT NOT NULL DEFAULT 0,
+            priced_count INT NOT NULL DEFAULT 0
+            )'''
+
+NEW_ROWS = '''SELECT shop_id, cost_at_auction::DOUBLE PRECISION AS cost, 1 AS n,
+                    (cost_at_auction IS NOT NULL)::INT AS priced FROM new_rows'''
+OLD_ROWS = '''SELECT shop_id, -cost_at_auction::DOUBLE PRECISION AS cost, -1 AS n,
+                    -(cost_at_auction IS NOT NULL)::INT AS priced FROM old_rows'''
+
+def apply_changes(changes):
+    return f'''INSERT INTO shop_stock_summary AS summary (shop_id, stock_value, treasure_count, priced_count)
+                    SELECT shop_id, COALESCE(SUM(cost), 0), SUM(n), SUM(priced)
+                    FROM ({changes}) AS changes
+                    WHERE shop_id IS NOT NULL
+                    GROUP BY shop_id
+                    ORDER BY shop_id
+                    ON CONFLICT (shop_id) DO UPDATE SET
+                        stock_value = summary.stock_value + EXCLUDED.stock_value,
+                        treasure_count = summary.treasure_count + EXCLUDED.treasure_count,
+                        priced_count = summary.priced_count + EXCLUDED.priced_count;'''
+
+APPLY_CHANGES_FUNCTION = f'''CREATE OR REPLACE FUNCTION apply_shop_stock_changes() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    {apply_changes(NEW_ROWS)}
+                    RETURN NULL;
+                ELSIF TG_OP = 'DELETE' THEN
+                    {apply_changes(OLD_ROWS)}
+                ELSE
+                    {apply_changes(NEW_ROWS + ' UNION ALL ' + OLD_ROWS)}
+                END IF;
+                DELETE FROM shop_stock_summary WHERE treasure_count <= 0;
+                RETURN NULL;
+            END;
+            $$'''
+
+# transition tables need one trigger per event
+TRIGGERS = [
+    f'''CREATE TRIGGER treasures_shop_stock_{event.lower()}
+            AFTER {event} ON treasures
+            REFERENCING {transition}
+            FOR EACH STATEMENT EXECUTE FUNCTION apply_shop_stock_changes()'''
+    for event, transition in [
+        ('INSERT', 'NEW TABLE AS new_rows'),
+        ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+        ('DELETE', 'OLD TABLE AS old_rows'),
+    ]
+]
+
+LIVE_AGGREGATE = '''SELECT shop_id, COALESCE(SUM(cost_at_auction::DOUBLE PRECISION), 0) AS stock_value, COUNT(treasure_id) AS treasure_count,
+            COUNT(cost_at_auction) AS priced_count
+            FROM treasures
+            WHERE shop_id IS NOT NULL
+            GROUP BY shop_id'''
+
+
+def create_shop_summary(db):
+    '''Create the summary, fill it and attach the triggers; call after loading `treasures`.'''
+    db.run(SUMMARY_TABLE)
+    db.run(APPLY_CHANGES_FUNCTION)
+    db.run(f'INSERT INTO shop_stock_summary {LIVE_AGGREGATE}')
+    for trigger in TRIGGERS:
+        db.run(trigger)
+
+
+def rebuild_shop_summary(db):
+    db.run('START TRANSACTION')
+    try:
+        # keep writers out so nothing lands between the truncate and the insert
+        db.run('LOCK TABLE treasures IN SHARE MODE')
+        db.run('TRUNCATE shop_stock_summary')
+        db.run(f'INSERT INTO shop_stock_summary {LIVE_AGGREGATE}')
+        row_count = db.row_count
+        db.run('COMMIT')
+    except Exception:
+        db.run('ROLLBACK')
+        raise
+    return row_count
+
+
+def check_shop_summary(db, tolerance=1e-6):
+    '''Return the shops whose summary row differs from the live aggregate.'''
+    rows = db.run(f'''WITH live AS ({LIVE_AGGREGATE})
+            SELECT COALESCE(live.shop_id, summary.shop_id),
+                live.stock_value, summary.stock_value,
+                live.treasure_count, summary.treasure_count,
+                live.priced_count, summary.priced_count
+            FROM live
+            FULL JOIN shop_stock_summary summary ON live.shop_id = summary.shop_id
+            WHERE live.shop_id IS NULL OR summary.shop_id IS NULL
+                OR live.treasure_count <> summary.treasure_count
+                OR live.priced_count <> summary.priced_count
+                OR ABS(live.stock_value - summary.stock_value)
+                    > :tolerance * GREATEST(1, ABS(summary.stock_value))
+            ORDER BY 1''', tolerance=tolerance)
+    keys = ['shop_id', 'live_stock_value', 'summary_stock_value', 'live_treasure_count',
+            'summary_treasure_count', 'live_priced_count', 'summary_priced_count']
+    return [dict(zip(keys, row)) for row in rows]
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    db = connect_to_db(Settings.load(sys.argv[2] if len(sys.argv) > 2 else 'dev'))
+    try:
+        if command == 'rebuild':
+            print(f'Rebuilt shop_stock_summary with {rebuild_shop_summary(db)} shops')
+        elif command == 'check':
+            mismatches = check_shop_summary(db)
+            for mismatch in mismatches:
+                print(mismatch)
+            print(f'{len(mismatches)} shops differ from the live aggregate')
+            sys.exit(1 if mismatches else 0)
+        else:
+            sys.exit(f'Unknown command {command}, expected rebuild or check')
+    finally:
+        db.close()
@@ -0,0 +1,83 @@
+'''This module keeps the statements prepared on each pooled connection.
+
+Every query the app runs comes from a fixed template, and LIMIT/OFFSET
+are bound as parameters, so the query text identifies its shape. The
+first time a connection sees a shape it is prepared and kept. Later runs
+skip parsing, and planning once Postgres settles on a generic plan.
+'''
+
+from db.settings import get_settings
+from collections import OrderedDict
+import threading
+
+
+class StatementStats:
+    '''Hit/miss counters summed over the caches of every connection.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'max_size': get_settings().prepared_statement_cache_size,
+            }
+
+
+statement_stats = StatementStats()
+
+
+class StatementCache:
+    '''An LRU of the statements prepared on one connection, keyed by query text.
+
+    A connection is only used by one request at a time, so this needs no
+    lock. Preparing and closing statements is left to the caller, since the
+    two drivers do it differently.
+    '''
+
+    def __init__(self, max_size, stats=statement_stats):
+        self.max_size = max_size
+        self._stats = stats
+        self._statements = OrderedDict()
+
+    def __len__(self):
+        return len(self._statements)
+
+    def lookup(self, query_str):
+        statement = self._statements.get(query_str)
+        if statement is None:
+            self._stats.count('misses')
+            return None
+        self._statements.move_to_end(query_str)
+        self._stats.count('hits')
+        return statement
+
+    def add(self, query_str, statement):
+        '''Keep `statement` and return the least recently used ones it pushed out.'''
+        self._statements[query_str] = statement
+        evicted = []
+        while len(self._statements) > self.max_size:
+            evicted.append(self._statements.popitem(last=False)[1])
+            self._stats.count('evictions')
+        return evicted
+
+    def discard(self, query_str):
+        '''Forget a statement that failed, e.g. because the schema changed under it.'''
+        statement = self._statements.pop(query_str, None)
+        if statement is not None:
+            self._stats.count('invalidations')
+        return statement
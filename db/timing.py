@@ -0,0 +1,196 @@
+'''This module records where each request spends its time and exports it.
+
+Requests are broken into phases:
+- connect: waiting for a pooled connection.
+- execute: running the statement.
+- fetch: reading rows.
+- format: building the response dict.
+- serialize: encoding the JSON body.
+- render: rendering an HTML page or fragment.
+- db: the total wall time of the database calls.
+
+Both drivers read a whole result while executing the statement, so for
+plain queries `fetch` only covers turning the rows into tuples. For
+streamed results it covers every FETCH from the cursor.
+
+The phases are exported as Prometheus histograms labelled by route and
+query shape. When enabled, they are also reported in a `Server-Timing`
+header. Statements slower than the `slow_query_ms` setting are logged.
+'''
+
+from db.settings import get_settings
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import logging
+import time
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+slow_query_log = logging.getLogger('cats_rare_treasures.slow_queries')
+
+
+class Histogram:
+    '''A labelled, cumulative histogram rendered in the Prometheus text format.'''
+
+    def __init__(self, name, documentation, label_names, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}  # label values -> [bucket counts..., count, sum]
+
+    def observe(self, seconds, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[index] += 1
+            series[-2] += 1
+            series[-1] += seconds
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted(self._series.items())
+        for label_values, values in series:
+            labels = ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(self.label_names, label_values))
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {values[-2]}')
+            lines.append(f'{self.name}_count{{{labels}}} {values[-2]}')
+            lines.append(f'{self.name}_sum{{{labels}}} {values[-1]:.6f}')
+        return lines
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_duration = Histogram('http_request_duration_seconds', 'Time to handle a request.',
+                             ['route', 'method', 'status'])
+phase_duration = Histogram('http_request_phase_seconds', 'Time a request spent in each phase.',
+                           ['route', 'shape', 'phase'])
+
+
+def render_metrics():
+    return '\n'.join(request_duration.render() + phase_duration.render()) + '\n'
+
+
+class RequestTimings:
+    def __init__(self, scope):
+        self.scope = scope
+        self.phases = {}
+        self.shape = ''
+
+    @property
+    def route(self):
+        # the path template, so ids do not each get their own series
+        return getattr(self.scope.get('route'), 'path', 'unmatched')
+
+
+# one per request; the threadpool sees the same object through copied contexts
+_current = ContextVar('request_timings', default=None)
+
+
+@contextmanager
+def timed_phase(phase):
+    '''Add the time spent in the block to `phase` of the current request.'''
+    timings = _current.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings.phases[phase] = timings.phases.get(phase, 0.0) + time.perf_counter() - started
+
+
+def track_db_time():
+    return timed_phase('db')
+
+
+def set_query_shape(shape):
+    '''Label the current request's phases with a normalized description of its query.'''
+    timings = _current.get()
+    if timings is not None:
+        timings.shape = shape
+
+
+@contextmanager
+def timed_query(query_str, params):
+    '''Time the block as the `execute` phase and log the statement if it was slow.'''
+    started = time.perf_counter()
+    with timed_phase('execute'):
+        yield
+    log_if_slow(query_str, time.perf_counter() - started, params)
+
+
+def log_if_slow(query_str, seconds, params):
+    slow_query_ms = get_settings().slow_query_ms
+    if slow_query_ms and seconds * 1000 >= slow_query_ms:
+        timings = _current.get()
+        slow_query_log.warning('slow query %.1f ms route=%s shape=%s params=%r: %s', seconds * 1000,
+                               timings.route if timings else '-', timings.shape if timings else '-',
+                               params, ' '.join(query_str.split()))
+
+
+class TimingMiddleware:
+    '''Time every request into the histograms, adding `Server-Timing` when `server_timing()` is true.
+
+    Streamed bodies are still being read when the headers go out, so the
+    header only covers the work done before the first chunk; the histograms
+    cover the whole response.
+    '''
+
+    def __init__(self, app, server_timing):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        timings = RequestTimings(scope)
+        token = _current.set(timings)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if self.server_timing():
+                    metrics = [f'{phase};dur={seconds * 1000:.3f}' for phase, seconds in timings.phases.items()]
+                    metrics.append(f'app;dur={(time.perf_counter() - started) * 1000:.3f}')
+                    if 'db' not in timings.phases:
+                        metrics.insert(0, 'db;dur=0.000')
+                    message = {**message, 'headers': [*message.get('headers', []),
+                                                      (b'server-timing', ', '.join(metrics).encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            route = timings.route
+            request_duration.observe(time.perf_counter() - started, route, scope['method'], str(status))
+            for phase, seconds in timings.phases.items():
+                phase_duration.observe(seconds, route, timings.shape, phase)
+
+
+def parse_server_timing(header):
+    '''Return {name: milliseconds} from a `Server-Timing` header value.'''
+    metrics = {}
+    for metric in filter(None, (part.strip() for part in (header or '').split(','))):
+        name, *params = [piece.strip() for piece in metric.split(';')]
+        for param in params:
+            if param.startswith('dur='):
+                metrics[name] = float(param[4:])
+    return metrics
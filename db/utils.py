@@ -1,11 +1,17 @@
-from db.connection import connect_to_db, load_enviroment
+from db.pool import get_pool, PoolTimeout
+from db.routing import ReplicaUnavailable, is_unavailable
+from db.timing import timed_phase, timed_query
+from db.serialization import Rows, ColumnarRows
 from pydantic import BaseModel
-from os import getenv
 from fastapi import HTTPException
+from pg8000 import DatabaseError
+import binascii
+import math
+import struct
+import base64
+import json
 
 
-TESTING = getenv('TESTING')
-
 def format_data_list_to_dict(input_list, key, key_list):
     if not input_list:
         raise HTTPException(status_code=404, detail='Page Not Found')
@@ -18,43 +24,333 @@ def format_data_list_to_dict(input_list, key, key_list):
         return{key:dict(zip(key_list, input_list[0]))}
 
 
-def connect_to_db_and_get_formatted_result(query_str, key, **value_keys):
-    conn = None
+def format_rows(input_list, key, key_list, columnar=False):
+    '''Shape a result like format_data_list_to_dict, keeping the rows as tuples.
+
+    A single row is still returned as an object, as the API always has.
+    Columnar results are always a list.
+    '''
+    if not input_list:
+        raise HTTPException(status_code=404, detail='Page Not Found')
+    if columnar:
+        return {key: ColumnarRows(key_list, input_list)}
+    if len(input_list) > 1:
+        return {key: Rows(key_list, input_list)}
+    return {key: dict(zip(key_list, input_list[0]))}
+
+
+def run_prepared(conn, query_str, **value_keys):
+    '''Run `query_str` with the statement prepared for it on `conn`, preparing it on first use.
+
+    Returns the rows and the statement's column descriptions.
+    '''
+    cache = conn.statement_cache
+    statement = cache.lookup(query_str)
+    if statement is not None:
+        try:
+            return statement.run(**value_keys), statement.columns
+        except DatabaseError as e:
+            # 0A000: the table changed shape under the statement, so prepare it again
+            if e.args[0].get('C') != '0A000':
+                raise
+            cache.discard(query_str)
+            statement.close()
+    statement = conn.prepare(query_str)
+    for evicted in cache.add(query_str, statement):
+        evicted.close()
+    return statement.run(**value_keys), statement.columns
+
+
+def connect_to_db_and_get_formatted_result(query_str, key, columnar=False, endpoint=None, **value_keys):
     try:
-        load_enviroment(TESTING)
-        conn = connect_to_db()
-        if value_keys:
-            result = conn.run(query_str, **value_keys)
-        else:
-            result = conn.run(query_str)
-        key_list = [column['name'] for column in conn.columns]
-        formatted_result = format_data_list_to_dict(result, key, key_list)
+        with get_pool(endpoint).connection() as conn:
+            with timed_query(query_str, value_keys):
+                result, columns = run_prepared(conn, query_str, **value_keys)
+            with timed_phase('fetch'):
+                key_list = [column['name'] for column in columns]
+        with timed_phase('format'):
+            key_list, result = split_colour_check(key_list, result)
+            formatted_result = format_rows(result, key, key_list, columnar)
         return formatted_result
     except HTTPException as http_err:
         print(http_err)
         raise http_err
+    except PoolTimeout as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
+        if endpoint is not None and is_unavailable(e):
+            raise ReplicaUnavailable(endpoint, e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if conn:
-            conn.close()
 
-def get_treasures_query():
+def iter_query_rows(query_str, chunk_size, endpoint=None, **value_keys):
+    '''Yield (key_list, rows) chunks of a query read through a server-side cursor.'''
+    with get_pool(endpoint).connection() as conn:
+        conn.run('START TRANSACTION')
+        try:
+            with timed_query(query_str, value_keys):
+                conn.run(f"DECLARE rows_cursor NO SCROLL CURSOR FOR {query_str.strip().rstrip(';')}", **value_keys)
+            while True:
+                with timed_phase('fetch'):
+                    rows = conn.run(f'FETCH FORWARD {int(chunk_size)} FROM rows_cursor')
+                if not rows:
+                    break
+                yield [column['name'] for column in conn.columns], rows
+        finally:
+            # also closes the cursor; nothing was written
+            conn.run('ROLLBACK')
+
+def get_treasures_query(relevance=False):
     # SELECT string_agg(column_name, ', ') AS column_list FROM (SELECT column_name FROM information_schema.columns WHERE table_name = 'treasures' ORDER BY ordinal_position) AS ordered_columns;
     # SELECT string_agg('"'||column_name||'"', ', ') FROM information_schema.columns where table_name = 'treasures';
     # SELECT constraint_name, column_name FROM information_schema.key_column_usage WHERE table_name = 'treasures' AND constraint_name LIKE '%_pkey';
-    return '''SELECT treasure_id, treasure_name, colour, age, cost_at_auction, shop_name
+    relevance_str = f', {RELEVANCE} AS relevance' if relevance else ''
+    return f'''SELECT treasure_id, treasure_name, colour, age, cost_at_auction, shop_name{relevance_str}
             FROM treasures t
             LEFT JOIN shops s
             ON t.shop_id = s.shop_id'''
 
-def get_valid_colours_from_db():
-    load_enviroment(TESTING)
-    conn = connect_to_db()
-    colour_list = conn.run('''SELECT DISTINCT colour from treasures;''')
-    conn.close()
-    colour_list = [item for sublist in colour_list for item in sublist]
-    return colour_list
+# how well :q matches the best run of words in the name, plus how well it
+# matches the whole name, so a closer name ranks first among equally good
+# word matches; from 0 to 2, and a REAL like both terms
+RELEVANCE = '(word_similarity(:q, treasure_name) + similarity(:q, treasure_name))'
+
+# all three are served by the trigram index on treasure_name; fuzzy
+# matches names holding words at least pg_trgm.word_similarity_threshold
+# (0.6) similar to :q
+SEARCH_CONDITIONS = {
+    'prefix': 'treasure_name ILIKE :q_pattern',
+    'substring': 'treasure_name ILIKE :q_pattern',
+    'fuzzy': ':q <% treasure_name',
+}
+
+def escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def get_treasures_filters(colour=None, max_age=None, min_age=None, q=None, match='substring'):
+    conditions = []
+    params = {}
+    if q:
+        conditions.append(SEARCH_CONDITIONS[match])
+        if match == 'fuzzy':
+            params['q'] = q
+        else:
+            params['q_pattern'] = escape_like(q) + '%' if match == 'prefix' else '%' + escape_like(q) + '%'
+    if colour:
+        conditions.append('colour = :colour')
+        params['colour'] = colour.lower()
+    if max_age:
+        conditions.append('age <= :max_age')
+        params['max_age'] = max_age
+    if min_age:
+        conditions.append('age >= :min_age')
+        params['min_age'] = min_age
+    return conditions, params
+
+def get_order_by(sort_by, order):
+    # treasure_id breaks ties so every row has a fixed position to page from
+    if sort_by == 'treasure_id':
+        return f' ORDER BY treasure_id {order}'
+    return f' ORDER BY {sort_by} {order}, treasure_id {order}'
+
+SORT_COLUMN_TYPES = {'age': 'INT', 'cost_at_auction': 'REAL', 'treasure_name': 'VARCHAR', 'relevance': 'REAL'}
+
+# sorts on a computed column repeat its expression in keyset conditions
+SORT_EXPRESSIONS = {'relevance': RELEVANCE}
+
+def get_keyset_conditions(sort_by, order, last_value):
+    '''Conditions selecting the rows after a cursor, one per ordered run of rows.
+
+    NULLs sort after every value ascending and before every value descending,
+    so a page may continue from the non-NULL run into the NULL run (or the
+    other way round). Each run gets its own index-friendly condition.
+    '''
+    comparison = '>' if order == 'ASC' else '<'
+    if sort_by == 'treasure_id':
+        return [f'treasure_id {comparison} :cursor_id']
+    if last_value is None:
+        conditions = [f'{sort_by} IS NULL AND treasure_id {comparison} :cursor_id']
+        if order == 'DESC':
+            conditions.append(f'{sort_by} IS NOT NULL')
+        return conditions
+    # the cast keeps the comparison in the column's type, a REAL compared
+    # as a double would skip rows tied on the cursor value
+    sort_expression = SORT_EXPRESSIONS.get(sort_by, sort_by)
+    conditions = [f'({sort_expression}, treasure_id) {comparison} (CAST(:cursor_value AS {SORT_COLUMN_TYPES[sort_by]}), :cursor_id)']
+    # relevance is never NULL
+    if order == 'ASC' and sort_by not in SORT_EXPRESSIONS:
+        conditions.append(f'{sort_by} IS NULL')
+    return conditions
+
+def build_treasures_query(conditions, sort_by, order, limit=None, offset=None, keyset_conditions=None,
+                          check_colour=False):
+    order_by = get_order_by(sort_by, order) if sort_by else ''
+    # bound rather than inlined, so every page of a shape shares one prepared statement
+    limit_str = ' LIMIT :limit' if limit else ''
+    branches = []
+    for keyset_condition in keyset_conditions or [None]:
+        where = conditions + [keyset_condition] if keyset_condition else conditions
+        query_str = get_treasures_query(relevance=sort_by == 'relevance')
+        if where:
+            query_str += ' WHERE ' + ' AND '.join(where)
+        branches.append(query_str + order_by + limit_str)
+    if len(branches) == 1:
+        query_str = branches[0]
+        if offset:
+            query_str += ' OFFSET :offset'
+    else:
+        union = ' UNION ALL '.join(f'({branch})' for branch in branches)
+        query_str = f'SELECT * FROM ({union}) AS keyset_page{order_by}{limit_str}'
+    if check_colour:
+        query_str = add_colour_check(query_str, order_by)
+    return query_str + ';'
+
+def add_colour_check(query_str, order_by):
+    '''Make a colour-filtered listing also report whether :colour exists at all.
+
+    The page is joined onto a one-row check, so an empty page still returns
+    a row: its treasure columns are NULL and `colour_exists` tells an unknown
+    colour (422) from a page past the end (404). Both answers come from one
+    statement, in one round trip.
+
+    The check reads the first colour >= :colour from the colour index rather
+    than using EXISTS: a cached generic plan may run EXISTS as a sequential
+    scan, which only stops early for colours that exist.
+    '''
+    return f'''WITH listing AS ({query_str})
+            SELECT listing.*, colour_check.colour_exists
+            FROM (SELECT (SELECT colour FROM treasures WHERE colour >= :colour ORDER BY colour LIMIT 1) = :colour
+                  AS colour_exists) AS colour_check
+            LEFT JOIN listing ON true{order_by}'''
+
+def split_colour_check(key_list, rows):
+    '''Strip the `colour_exists` column added by add_colour_check.
+
+    Raises 422 for an unknown colour and returns no rows for an empty page;
+    results of any other query are returned unchanged.
+    '''
+    if not key_list or key_list[-1] != 'colour_exists':
+        return key_list, rows
+    if rows and not rows[0][-1]:
+        raise HTTPException(status_code=422, detail='There is no such colour in the database, please try another one')
+    # treasure_id is never NULL on a real row
+    if rows and rows[0][0] is None:
+        return key_list[:-1], []
+    return key_list[:-1], [row[:-1] for row in rows]
+
+def encode_cursor(sort_by, order, last_row):
+    payload = json.dumps([sort_by, order, last_row[sort_by], last_row['treasure_id']])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+# the range of an INT column
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+
+def is_int_value(value):
+    # bool is an int to Python, but not to the database
+    return isinstance(value, int) and not isinstance(value, bool) and INT_MIN <= value <= INT_MAX
+
+def is_cursor_value(sort_by, value):
+    '''Whether `value` can be the last value of a page sorted by `sort_by`.'''
+    if value is None:
+        # only a stored column can be NULL
+        return sort_by != 'treasure_id' and sort_by not in SORT_EXPRESSIONS
+    column_type = SORT_COLUMN_TYPES.get(sort_by, 'INT')
+    if column_type == 'INT':
+        return is_int_value(value)
+    if column_type == 'REAL':
+        return (is_int_value(value) or isinstance(value, float)) and math.isfinite(value)
+    return isinstance(value, str)
+
+def decode_cursor(cursor, sort_by, order):
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort_by, cursor_order, last_value, last_id = json.loads(payload)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=422, detail='Invalid cursor')
+    if (cursor_sort_by, cursor_order) != (sort_by, order):
+        raise HTTPException(status_code=422, detail='The cursor does not match sort_by and order')
+    # the values are bound to the keyset conditions as they are
+    if not is_int_value(last_id) or not is_cursor_value(sort_by, last_value):
+        raise HTTPException(status_code=422, detail='Invalid cursor')
+    return last_value, last_id
+
+def get_treasures_by_ids_query():
+    return get_treasures_query() + ' WHERE treasure_id = ANY(:ids);'
+
+def get_count_treasures_query(conditions):
+    query_str = 'SELECT COUNT(*) AS total FROM treasures'
+    if conditions:
+        query_str += ' WHERE ' + ' AND '.join(conditions)
+    return query_str + ';'
+
+def get_estimate_treasures_query(conditions):
+    '''EXPLAIN the count's scan, so the planner estimates the rows from its statistics without reading them.
+
+    EXPLAIN plans with the bound values each time, even from a prepared
+    statement, so every colour gets its own estimate.
+    '''
+    query_str = 'EXPLAIN (FORMAT JSON) SELECT 1 FROM treasures'
+    if conditions:
+        query_str += ' WHERE ' + ' AND '.join(conditions)
+    return query_str + ';'
+
+def parse_row_estimate(plan):
+    # pg8000 decodes the json, asyncpg returns it as text
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(round(plan[0]['Plan']['Plan Rows']))
+
+# GROUPING(colour, age_bucket) of each grouping set in get_facets_query
+FACET_TOTAL, FACET_COLOUR, FACET_AGE = 3, 1, 2
+
+def get_facets_query(conditions, check_colour=False):
+    '''Count the filtered treasures by colour and by :age_bucket wide age bucket, in one scan.
+
+    The grand total row also carries the cost summary. It comes first, so
+    with `check_colour` an empty selection still has a non-NULL first
+    column for split_colour_check.
+    '''
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    colour_check = ''
+    if check_colour:
+        colour_check = (',\n            (SELECT colour FROM treasures WHERE colour >= :colour ORDER BY colour LIMIT 1) = :colour'
+                        ' AS colour_exists')
+    return f'''
+            SELECT GROUPING(colour, age_bucket) AS facet, colour, age_bucket, COUNT(*) AS count,
+            MIN(cost_at_auction) AS min_cost, ROUND(AVG(cost_at_auction)::NUMERIC, 2)::REAL AS avg_cost,
+            MAX(cost_at_auction) AS max_cost, COUNT(cost_at_auction) AS priced{colour_check}
+            FROM (SELECT colour, CAST(FLOOR(age / CAST(:age_bucket AS FLOAT8)) * :age_bucket AS INT) AS age_bucket,
+                  cost_at_auction
+                  FROM treasures{where}) AS filtered
+            GROUP BY GROUPING SETS ((), (colour), (age_bucket))
+            ORDER BY facet DESC;'''
+
+def format_facets(columns, rows, age_bucket):
+    '''Turn the rows of get_facets_query into colour counts, an age histogram and a cost summary.'''
+    facets = {'total': 0, 'colours': [], 'ages': [], 'cost_at_auction': None}
+    for row in rows:
+        row = dict(zip(columns, row))
+        if row['facet'] == FACET_TOTAL:
+            facets['total'] = row['count']
+            facets['cost_at_auction'] = {'min': row['min_cost'], 'avg': row['avg_cost'], 'max': row['max_cost'],
+                                         'priced': row['priced']}
+        elif row['facet'] == FACET_COLOUR:
+            facets['colours'].append({'colour': row['colour'], 'count': row['count']})
+        else:
+            start = row['age_bucket']
+            facets['ages'].append({'min_age': start, 'max_age': start + age_bucket - 1 if start is not None else None,
+                                   'count': row['count']})
+    # most common colours first; treasures without a colour or age last
+    facets['colours'].sort(key=lambda facet: (facet['colour'] is None, -facet['count'], facet['colour'] or ''))
+    facets['ages'].sort(key=lambda facet: (facet['min_age'] is None, facet['min_age'] or 0))
+    return facets
+
+def get_export_treasures_query():
+    return get_treasures_query() + ' ORDER BY treasure_id;'
+
+def get_wal_position_query():
+    # on the primary: how far it has written; on a replica: how far it has replayed
+    return '''SELECT (CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn()
+                          ELSE pg_current_wal_lsn() END)::text AS lsn;'''
 
 def get_insert_treasures_query():
     return '''INSERT INTO treasures (treasure_name, colour, age, cost_at_auction, shop_id)
@@ -68,6 +364,122 @@ def get_params_from_new_treasure(new_treasure):
     params = {placeholder[i]:getattr(new_treasure, attributes[i]) for i in range(len(placeholder))}
     return params
 
+# the limits of the treasures columns: VARCHAR lengths and the range of REAL
+TEXT_MAX_LENGTHS = {'treasure_name': 256, 'colour': 42}
+
+def is_real_value(value):
+    '''Whether `value` is a finite number a REAL column stores without over- or underflowing.'''
+    if not math.isfinite(value):
+        return False
+    try:
+        stored = struct.unpack('f', struct.pack('f', value))[0]
+    except OverflowError:
+        return False
+    return math.isfinite(stored) and (stored != 0 or value == 0)
+
+def check_treasure_values(**values):
+    '''Describe every value a treasures column would reject.
+
+    A rejected value aborts the whole statement, so batches check their rows
+    first and leave out only the bad ones.
+    '''
+    problems = []
+    for name, value in values.items():
+        if value is None:
+            continue
+        if name in TEXT_MAX_LENGTHS:
+            if len(value) > TEXT_MAX_LENGTHS[name]:
+                problems.append(f'{name} must be at most {TEXT_MAX_LENGTHS[name]} characters')
+            if '\x00' in value:
+                problems.append(f'{name} must not contain NUL characters')
+        elif name == 'cost_at_auction' and not is_real_value(value):
+            problems.append('cost_at_auction must be a finite number within the range of REAL')
+        elif name in ('age', 'shop_id') and not is_int_value(value):
+            problems.append(f'{name} must be between {INT_MIN} and {INT_MAX}')
+    return problems
+
+def get_shop_ids_from_db():
+    query_str = '''SELECT shop_id FROM shops;'''
+    with get_pool().connection() as conn:
+        with timed_query(query_str, {}):
+            shop_ids, _ = run_prepared(conn, query_str)
+    return {row[0] for row in shop_ids}
+
+TREASURE_COLUMNS = ['treasure_name', 'colour', 'age', 'cost_at_auction', 'shop_id']
+
+def get_copy_treasures_query():
+    return f'''COPY treasures ({', '.join(TREASURE_COLUMNS)})
+            FROM STDIN WITH (FORMAT csv)'''
+
+def format_csv_value(value):
+    # strings are always quoted so that only a bare empty field is read back as NULL
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    return str(value)
+
+def format_rows_as_csv(rows):
+    return ''.join(','.join(format_csv_value(value) for value in row) + '\n' for row in rows)
+
+def bulk_insert_treasures(rows, batch_size):
+    '''COPY `rows` (tuples in TREASURE_COLUMNS order) in batches, all in one transaction.'''
+    try:
+        with get_pool().connection() as conn:
+            conn.run('START TRANSACTION')
+            try:
+                for start in range(0, len(rows), batch_size):
+                    with timed_phase('format'):
+                        csv_batch = format_rows_as_csv(rows[start:start + batch_size])
+                    with timed_query(get_copy_treasures_query(), {'rows': min(batch_size, len(rows) - start)}):
+                        conn.run(get_copy_treasures_query(), stream=[csv_batch])
+                conn.run('COMMIT')
+            except Exception:
+                conn.run('ROLLBACK')
+                raise
+        return len(rows)
+    except PoolTimeout as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def run_chunked_transactions(query_str, chunks):
+    '''Run `query_str` once per params dict in `chunks`, each in a transaction of its own.
+
+    Returns a (values, error) pair per chunk: the first column of the rows
+    the chunk returned, or the error that rolled it back. A failed chunk
+    does not undo the ones before it.
+    '''
+    results = []
+    try:
+        with get_pool().connection() as conn:
+            for params in chunks:
+                conn.run('START TRANSACTION')
+                try:
+                    with timed_query(query_str, {'rows': len(params['ids'])}):
+                        rows, _ = run_prepared(conn, query_str, **params)
+                    conn.run('COMMIT')
+                except DatabaseError as e:
+                    conn.run('ROLLBACK')
+                    results.append((None, e.args[0].get('M', str(e))))
+                else:
+                    results.append(([row[0] for row in rows], None))
+        return results
+    except PoolTimeout as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def get_bulk_update_treasures_query():
+    return '''UPDATE treasures AS t SET cost_at_auction = changes.cost
+            FROM unnest(CAST(:ids AS INT[]), CAST(:costs AS REAL[])) AS changes(treasure_id, cost)
+            WHERE t.treasure_id = changes.treasure_id
+            RETURNING t.treasure_id;'''
+
+def get_bulk_delete_treasures_query():
+    return '''DELETE FROM treasures WHERE treasure_id = ANY(CAST(:ids AS INT[]))
+            RETURNING treasure_id;'''
+
 def get_update_treasures_query():
     return '''UPDATE treasures SET cost_at_auction = :cost WHERE treasure_id = :id
             RETURNING *;'''
@@ -77,12 +489,11 @@ def get_delete_treasures_query():
             RETURNING *;'''
 
 def get_shops_query():
+    # stock values are kept in shop_stock_summary by triggers on treasures
     return '''
-            WITH total_cost_per_shop AS 
-            (SELECT shop_id, SUM(cost_at_auction) AS stock_value, COUNT(treasure_id) AS count FROM treasures GROUP BY shop_id)
-            SELECT s.shop_id, shop_name, slogan ,stock_value, count as treasure_count
+            SELECT s.shop_id, shop_name, slogan,
+            CASE WHEN priced_count > 0 THEN stock_value::REAL END AS stock_value, treasure_count
             FROM shops s
-            LEFT JOIN total_cost_per_shop tc
-            ON s.shop_id = tc.shop_id
+            LEFT JOIN shop_stock_summary ss
+            ON s.shop_id = ss.shop_id
             ORDER BY s.shop_id ASC;'''
-
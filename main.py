@@ -1,22 +1,217 @@
 '''This module is the entrypoint for the `Cat's Rare Treasures` FastAPI app.'''
 
-from fastapi import FastAPI, Query, HTTPException, Request
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi import FastAPI, Query, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, HTMLResponse, Response, StreamingResponse, PlainTextResponse
 from fastapi.exceptions import RequestValidationError
-from db.utils import connect_to_db_and_get_formatted_result, get_treasures_query, get_valid_colours_from_db, get_insert_treasures_query,\
-                    get_params_from_new_treasure, get_update_treasures_query, get_delete_treasures_query, get_shops_query
+from db.utils import connect_to_db_and_get_formatted_result, get_treasures_query, get_insert_treasures_query,\
+                    get_params_from_new_treasure, get_update_treasures_query, get_delete_treasures_query, get_shops_query,\
+                    get_treasures_filters, get_keyset_conditions, build_treasures_query, encode_cursor, decode_cursor,\
+                    get_shop_ids_from_db, bulk_insert_treasures, iter_query_rows, get_export_treasures_query,\
+                    split_colour_check, get_wal_position_query, get_treasures_by_ids_query, run_chunked_transactions,\
+                    get_bulk_update_treasures_query, get_bulk_delete_treasures_query, get_count_treasures_query,\
+                    get_estimate_treasures_query, parse_row_estimate, get_facets_query, format_facets,\
+                    check_treasure_values
 from typing import Optional, Annotated, Literal
 from enum import Enum
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from pg8000 import DatabaseError
-from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool, iterate_in_threadpool
+from contextlib import asynccontextmanager
+from db.pool import get_pool, close_pool
+from db.cache import response_cache, row_cache, count_cache, etag_matches
+import math
+from db.statements import statement_stats
+from db.serialization import FastJSONResponse, Rows, dumps
+from db.timing import TimingMiddleware, track_db_time, timed_phase, set_query_shape, render_metrics
+from db.routing import SessionTokenMiddleware, ReplicaUnavailable, get_router, is_unavailable, parse_lsn,\
+                    session_read_after, issue_session_token
+from db.async_utils import async_connect_to_db_and_get_formatted_result,\
+                    get_async_pool, close_async_pool, async_pool_stats, async_get_shop_ids_from_db,\
+                    async_bulk_insert_treasures, async_iter_query_rows, async_run_chunked_transactions
+import json
+from db.settings import get_settings, on_reload, watch_settings_file, install_sighup_handler, remove_sighup_handler
+from catalogue import templates, static_files, STATIC_PATH, precompile_templates, page_etag, page_link, buffered,\
+                    BlankQueryParamsMiddleware
+from db.changes import change_feed, format_event, get_changes_query, get_change_kept_query
+from markupsafe import Markup
+import asyncpg
+import asyncio
+import time
 
-app = FastAPI()
 
-#app.mount('/static', StaticFiles(directory='static'), name='static')
+@asynccontextmanager
+async def lifespan(app):
+    # the pool lives as long as the app, so connections are reused across requests
+    if app.state.db_mode == 'async':
+        await get_async_pool()
+    else:
+        await run_in_threadpool(get_pool)
+    precompile_templates()
+    loop = asyncio.get_running_loop()
+    install_sighup_handler(loop)
+    stop_watching = watch_settings_file()
+    yield
+    stop_watching.set()
+    remove_sighup_handler(loop)
+    await change_feed.stop()
+    await close_async_pool()
+    close_pool()
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+# 'async' serves queries with asyncpg on the event loop, 'sync' runs the
+# pg8000 helpers on the threadpool; kept switchable to compare throughput.
+# Read at startup only, a reload does not move requests between drivers
+app.state.db_mode = get_settings().db_mode.lower()
+# SERVER_TIMING=1 reports the database time of each request, e.g. for the benchmarks
+app.state.server_timing = get_settings().server_timing
+app.add_middleware(TimingMiddleware, server_timing=lambda: app.state.server_timing)
+app.add_middleware(SessionTokenMiddleware)
+# blank fields of the catalogue's search form
+app.add_middleware(BlankQueryParamsMiddleware, paths=['/treasures'])
+
+
+@on_reload
+def apply_app_settings(new, old):
+    if new.server_timing != old.server_timing:
+        app.state.server_timing = new.server_timing
+
+
+async def run_query(query_str, key, columnar=False, endpoint=None, **params):
+    '''Run a query on the primary, or on the replica `endpoint`.'''
+    with track_db_time():
+        if app.state.db_mode == 'async':
+            return await async_connect_to_db_and_get_formatted_result(query_str, key, columnar, endpoint, **params)
+        return await run_in_threadpool(connect_to_db_and_get_formatted_result, query_str, key, columnar, endpoint,
+                                       **params)
+
+
+async def run_read_query(query_str, key, columnar=False, **params):
+    '''Run a read on a replica, moving on to the next one and then the primary if it is unavailable.'''
+    router = get_router()
+    for endpoint in await read_endpoints():
+        try:
+            with router.reading_from(endpoint):
+                return await run_query(query_str, key, columnar, endpoint, **params)
+        except ReplicaUnavailable as e:
+            router.mark_down(endpoint, e)
+    with router.reading_from(None):
+        return await run_query(query_str, key, columnar, **params)
+
+
+async def read_endpoints():
+    '''The replicas a read may go to, in order, leaving out any that has not replayed the session's writes.'''
+    router = get_router()
+    endpoints = router.candidates()
+    read_after = session_read_after()
+    if read_after is None or not endpoints:
+        return endpoints
+    caught_up = [endpoint for endpoint in endpoints if endpoint.replayed_lsn >= read_after]
+    if caught_up:
+        return caught_up
+    for endpoint in endpoints:
+        try:
+            # wait on one replica only, so a lagging cluster costs one timeout at most
+            return [endpoint] if await wait_for_replay(endpoint, read_after) else []
+        except ReplicaUnavailable as e:
+            router.mark_down(endpoint, e)
+    return []
+
+
+async def wait_for_replay(endpoint, lsn):
+    '''Poll `endpoint` until it has replayed `lsn`; False if it has not within the wait timeout.'''
+    router = get_router()
+    deadline = time.monotonic() + router.wait_timeout
+    delay = 0.002
+    while True:
+        response = await run_query(get_wal_position_query(), 'wal', False, endpoint)
+        router.note_replayed(endpoint, parse_lsn(response['wal']['lsn']) or 0)
+        if endpoint.replayed_lsn >= lsn:
+            return True
+        if time.monotonic() + delay > deadline:
+            return False
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+
+async def stream_query_rows(query_str, endpoint=None, **params):
+    '''Yield (key_list, rows) chunks from a server-side cursor on the primary or the replica `endpoint`.'''
+    chunk_size = get_settings().stream_chunk_size
+    with get_router().reading_from(endpoint):
+        try:
+            if app.state.db_mode == 'async':
+                async for chunk in async_iter_query_rows(query_str, chunk_size, endpoint, **params):
+                    yield chunk
+                return
+            chunks = iter_query_rows(query_str, chunk_size, endpoint, **params)
+            try:
+                async for chunk in iterate_in_threadpool(chunks):
+                    yield chunk
+            finally:
+                # hands the connection back even if the client went away mid-stream
+                await run_in_threadpool(chunks.close)
+        except Exception as e:
+            if endpoint is not None and is_unavailable(e):
+                raise ReplicaUnavailable(endpoint, e)
+            raise
+
+
+async def open_read_stream(query_str, **params):
+    '''Start streaming a read from a replica, or the primary; returns the chunks and the first chunk.
+
+    A replica can only be swapped for another one until its first chunk arrives.
+    '''
+    router = get_router()
+    for endpoint in await read_endpoints():
+        chunks = stream_query_rows(query_str, endpoint, **params)
+        try:
+            with track_db_time():
+                return chunks, await anext(chunks, None)
+        except ReplicaUnavailable as e:
+            await chunks.aclose()
+            router.mark_down(endpoint, e)
+    chunks = stream_query_rows(query_str, **params)
+    with track_db_time():
+        return chunks, await anext(chunks, None)
+
+
+def reset_caches():
+    '''Forget everything cached in-process, e.g. after the database is reseeded.'''
+    response_cache.clear()
+    row_cache.clear()
+    count_cache.invalidate()
+
+
+async def treasures_changed(treasure_ids=()):
+    '''Called after every write to `treasures` with the ids of the rows it changed or deleted.
 
-#templates = Jinja2Templates(directory="templates")
+    Shop totals are derived from `treasures` too.
+    '''
+    response_cache.bump('treasures', 'shops')
+    row_cache.invalidate(treasure_ids)
+    count_cache.invalidate()
+    if get_router().replicas:
+        # the client's next reads wait for a replica that has replayed this write
+        response = await run_query(get_wal_position_query(), 'wal')
+        issue_session_token(response['wal']['lsn'])
+
+
+def etag_response(request, body, etag):
+    if request is not None and etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    return Response(body, media_type='application/json', headers={'ETag': etag})
+
+
+async def cached_json(request, cache_key, build):
+    '''Serve `build()` through the response cache, answering If-None-Match with 304.'''
+    cached = response_cache.get(cache_key)
+    if cached is None:
+        content = await build()
+        with timed_phase('serialize'):
+            body = dumps(content)
+        cached = body, response_cache.put(cache_key, body)
+    return etag_response(request, *cached)
+
+app.mount(STATIC_PATH, static_files, name='static')
 
 
 # class SortBy(str, Enum):
@@ -66,69 +261,148 @@ def handle_request_validation(request, exc):
 def handle_general_exception(request, exc):
     return JSONResponse(status_code=500, content={'detail':'Interal Server Error'})
 
-@app.get('/api/treasures') # , response_class=HTMLResponse
-def get_treasures(#request:Request,
-                sort_by: 
-                Optional[str] = 
-                Query(default='age', description='Field to sort by', examples='age', pattern='^(?i)(age|cost_at_auction|treasure_name|treasure_id)$'), 
-                order:
-                Optional[str] =
-                Query(default='ASC', description='Sort order (case insensitive, must be "ASC" or "DESC")', examples='ASC', pattern='^(?i)(ASC|DESC)$'),
-                colour:
-                Optional[str] = 
-                Query(default=None, description='Filter by colour (case insensitive)', examples='gold', pattern='^(?i)[a-z]+$'),
-                max_age:
-                Optional[int] = 
-                Query(default=None, description='Filter by max_age', examples=100), # pattern='^[0-9]{1,3}$' would
-                min_age:
-                Optional[int] =
-                Query(default=None, description='Filter by min_age', examples=1),
-                limit:
-                Optional[int] = 
-                Query(default=5, description='Limit the number of results', examples=5),
-                page:
-                Optional[int] = 
-                Query(default=1, description='Respond with the select page', examples=1)
+# the listing's query parameters, shared by the JSON API and the HTML catalogue
+SortByQuery = Annotated[Optional[str],
+                Query(description='Field to sort by (default: relevance with q, otherwise age)', examples='age', pattern='^(?i)(age|cost_at_auction|treasure_name|treasure_id|relevance)$')]
+OrderQuery = Annotated[Optional[str],
+                Query(description='Sort order (case insensitive, must be "ASC" or "DESC"; default: DESC for relevance, otherwise ASC)', examples='ASC', pattern='^(?i)(ASC|DESC)$')]
+ColourQuery = Annotated[Optional[str],
+                Query(description='Filter by colour (case insensitive)', examples='gold', pattern='^(?i)[a-z]+$')]
+MaxAgeQuery = Annotated[Optional[int],
+                Query(description='Filter by max_age', examples=100)] # pattern='^[0-9]{1,3}$' would
+MinAgeQuery = Annotated[Optional[int],
+                Query(description='Filter by min_age', examples=1)]
+SearchQuery = Annotated[Optional[str],
+                Query(description='Search treasure names (case insensitive)', examples='vase', min_length=1, max_length=100)]
+MatchQuery = Annotated[Optional[str],
+                Query(description='How q matches: names starting with it, containing it, or with a word like it (fuzzy)', pattern='^(?i)(prefix|substring|fuzzy)$')]
+LimitQuery = Annotated[Optional[int],
+                Query(description='Limit the number of results', examples=5)]
+PageQuery = Annotated[Optional[int],
+                Query(description='Respond with the select page', examples=1)]
+CursorQuery = Annotated[Optional[str],
+                Query(description='Continue after the page that returned this next_cursor (page is ignored)')]
+IncludeTotalQuery = Annotated[Optional[str],
+                Query(description='Add total, page_count and has_next: "estimate" takes the total from planner '
+                      'statistics, "exact" counts the rows, "true" counts them only when the estimate is small',
+                      pattern='^(?i)(true|false|estimate|exact)$')]
+
+
+def parse_treasures_listing(sort_by, order, colour, max_age, min_age, q, match):
+    '''Apply the listing's defaults and checks; returns sort_by, order and the filters.'''
+    sort_by = sort_by.lower() if sort_by else 'relevance' if q else 'age'
+    order = order.upper() if order else 'DESC' if sort_by == 'relevance' else 'ASC'
+    if sort_by == 'relevance' and not q:
+        raise HTTPException(status_code=422, detail='sort_by=relevance needs q')
+    return sort_by, order, parse_treasures_filters(colour, max_age, min_age, q, match)
+
+
+def parse_treasures_filters(colour, max_age, min_age, q, match):
+    # an unknown colour is reported by the query itself (see add_colour_check)
+    match = match.lower()
+    if q and match == 'substring' and len(q) < 3:
+        # shorter text has no trigram to look up in the index
+        raise HTTPException(status_code=422, detail='q needs at least 3 characters for a substring match, '
+                                                    'use match=prefix for shorter text')
+    return {'colour': colour.lower() if colour else None, 'max_age': max_age, 'min_age': min_age,
+            'q': q, 'match': match if q else None}
+
+
+def parse_include_total(include_total):
+    return {'false': None, 'true': 'auto'}.get(include_total.lower(), include_total.lower())
+
+
+@app.get('/api/treasures')
+async def get_treasures(
+                sort_by: SortByQuery = None,
+                order: OrderQuery = None,
+                colour: ColourQuery = None,
+                max_age: MaxAgeQuery = None,
+                min_age: MinAgeQuery = None,
+                q: SearchQuery = None,
+                match: MatchQuery = 'substring',
+                limit: LimitQuery = 5,
+                page: PageQuery = 1,
+                cursor: CursorQuery = None,
+                stream:
+                Annotated[Optional[bool],
+                Query(description='Stream the rows as they are read (always returns a list)')] = False,
+                format:
+                Annotated[Optional[str],
+                Query(description='"columnar" sends the column names once, then one array per row', pattern='^(?i)(objects|columnar)$')] = 'objects',
+                include_total: IncludeTotalQuery = 'false',
+                request: Request = None
                 ):
+    sort_by, order, filters = parse_treasures_listing(sort_by, order, colour, max_age, min_age, q, match)
+    columnar = format.lower() == 'columnar'
+    include_total = parse_include_total(include_total)
+    set_query_shape(get_treasures_shape(sort_by, order, filters, limit, page, cursor))
+    if stream:
+        query_str, params = build_treasures_listing(sort_by, order, filters, limit, page, cursor)
+        page_totals = include_total and (lambda on_page: get_page_totals(include_total, filters, limit, page, cursor,
+                                                                          on_page))
+        return await stream_treasures(query_str, params, sort_by, order, limit, columnar, page_totals)
+    cache_key = response_cache.key('treasures', sort_by=sort_by, order=order, limit=limit, page=page, cursor=cursor,
+                                   columnar=columnar, include_total=include_total, **filters)
+    return await cached_json(request, cache_key, lambda: fetch_treasures(sort_by, order, filters, limit, page, cursor,
+                                                                         columnar, include_total))
 
 
-    query_str = get_treasures_query()
-    params = {}
-    if colour:
-        colour_list = get_valid_colours_from_db()
-        if colour.lower() not in colour_list:
-            raise HTTPException(status_code=422, detail="There is no such colour in the database, please try another one")
-        query_str += ' WHERE colour = :colour'
-        params['colour'] = colour.lower()
-    if max_age:
-        params['max_age'] = max_age
-        if colour:
-            query_str += ' AND '
-        else:
-            query_str += ' WHERE '
-        query_str += 'age <= :max_age'
-    if min_age:
-        params['min_age'] = min_age
-        if colour or max_age:
-            query_str += ' AND '
-        else:
-            query_str += ' WHERE '
-        query_str += 'age >= :min_age'
-    if sort_by:
-        query_str += f' ORDER BY {sort_by} {order}'
+def get_treasures_shape(sort_by, order, filters, limit, page, cursor):
+    '''Describe a listing by its query plan inputs only, so metrics get a bounded set of labels.'''
+    if not limit:
+        paging = 'unlimited'
+    elif cursor:
+        paging = 'cursor'
+    else:
+        paging = 'first_page' if page == 1 else 'offset'
+    return f'treasures:{sort_by}:{order}:{get_filters_shape(filters)}:{paging}'
+
+
+def get_filters_shape(filters):
+    names = [f"q_{filters['match']}" if name == 'q' else name for name, value in filters.items()
+             if value and name != 'match']
+    return '+'.join(names) or 'unfiltered'
+
+
+def build_treasures_listing(sort_by, order, filters, limit, page, cursor):
+    conditions, params = get_treasures_filters(**filters)
+    if sort_by == 'relevance':
+        params['q'] = filters['q']
+    keyset_conditions = None
+    if cursor:
+        last_value, last_id = decode_cursor(cursor, sort_by, order)
+        keyset_conditions = get_keyset_conditions(sort_by, order, last_value)
+        params['cursor_id'] = last_id
+        if last_value is not None and sort_by != 'treasure_id':
+            params['cursor_value'] = last_value
+    offset = (page-1) *limit if page and limit and not cursor else None
     if limit:
-        query_str += f' LIMIT {limit}'
-    if page:
-        query_str += f' OFFSET {(page-1) *limit}'
-    query_str += ';'
+        params['limit'] = limit
+    if offset:
+        params['offset'] = offset
+    query_str = build_treasures_query(conditions, sort_by, order, limit, offset, keyset_conditions,
+                                      check_colour=bool(filters['colour']))
+    return query_str, params
+
+
+async def fetch_treasures(sort_by, order, filters, limit, page, cursor, columnar=False, include_total=None):
+    query_str, params = build_treasures_listing(sort_by, order, filters, limit, page, cursor)
     #if params:
-    response = connect_to_db_and_get_formatted_result(query_str, 'treasures', **params)
+    response = await run_read_query(query_str, 'treasures', columnar, **params)
     #else:
     #    response = connect_to_db_and_get_formatted_result(query_str, 'treasures')
     if not response and page > 1:
         raise HTTPException(status_code=404, detail='Page not found')
+    # a lone row comes back as an object, anything else as Rows
+    treasures = [response['treasures']] if isinstance(response['treasures'], dict) else response['treasures']
+    if limit and len(treasures) == limit:
+        response['next_cursor'] = encode_cursor(sort_by, order, treasures[-1])
+    else:
+        response['next_cursor'] = None
+    if include_total:
+        response.update(await get_page_totals(include_total, filters, limit, page, cursor, len(treasures)))
     return response
-    #return templates.TemplateResponse(request, name='treasures.html', context=response)
 
     # except HTTPException as http_err:
     #     print(http_err)
@@ -140,6 +414,207 @@ def get_treasures(#request:Request,
 
 
 
+async def count_treasures(mode, filters):
+    '''Return (total, exact) for the listing's filters.
+
+    "estimate" takes the planner's row estimate, "exact" runs COUNT(*),
+    which reads every matching row. "auto" starts from the estimate and
+    only counts when it is below COUNT_EXACT_THRESHOLD, where counting is
+    cheap. Totals are cached by filters for COUNT_CACHE_TTL seconds.
+    '''
+    conditions, params = get_treasures_filters(**filters)
+    cache_key = tuple(sorted(params.items()))
+    threshold = get_settings().count_exact_threshold
+    cached, version = count_cache.get(cache_key, exact=mode == 'exact')
+    # a cached estimate only stands in for an auto count where counting would be expensive
+    if cached is not None and (cached[1] or mode == 'estimate' or cached[0] >= threshold):
+        return cached
+    if mode != 'exact':
+        response = await run_read_query(get_estimate_treasures_query(conditions), 'plan', **params)
+        total = parse_row_estimate(response['plan']['QUERY PLAN'])
+        if mode == 'estimate' or total >= threshold:
+            count_cache.put(cache_key, total, False, version)
+            return total, False
+    response = await run_read_query(get_count_treasures_query(conditions), 'count', **params)
+    total = response['count']['total']
+    count_cache.put(cache_key, total, True, version)
+    return total, True
+
+
+async def get_page_totals(mode, filters, limit, page, cursor, on_page):
+    '''The total, page_count and has_next of a page holding `on_page` rows.'''
+    offset = (page - 1) * limit if limit and not cursor else 0
+    full = bool(limit) and on_page == limit
+    if not full and not cursor:
+        # the last page of an offset listing gives the exact total without a count
+        total, exact = offset + on_page, True
+    else:
+        total, exact = await count_treasures(mode, filters)
+        if not cursor:
+            # an estimate can be lower than the rows already seen
+            total = max(total, offset + on_page)
+    if exact and not cursor:
+        has_next = offset + on_page < total
+    else:
+        # a cursor's position in the listing is unknown, as is the end of an estimated one
+        has_next = full
+    page_count = math.ceil(total / limit) if limit else 1
+    return {'total': total, 'total_exact': exact, 'page_count': page_count, 'has_next': has_next}
+
+
+async def open_treasures_stream(query_str, params):
+    '''Start streaming a listing; returns the chunks and the first one, which holds at least a row.'''
+    # read the first chunk up front so an empty page can still be a 404
+    chunks, chunk = await open_read_stream(query_str, **params)
+    try:
+        if chunk is not None:
+            chunk = split_colour_check(*chunk)
+    except HTTPException:
+        await chunks.aclose()
+        raise
+    if chunk is None or not chunk[1]:
+        await chunks.aclose()
+        raise HTTPException(status_code=404, detail='Page Not Found')
+    return chunks, chunk
+
+
+async def stream_treasures(query_str, params, sort_by, order, limit, columnar=False, page_totals=None):
+    chunks, chunk = await open_treasures_stream(query_str, params)
+
+    async def body(chunk):
+        try:
+            count, last_row, separator = 0, None, b''
+            if columnar:
+                yield b'{"treasures":{"columns":' + dumps(chunk[0]) + b',"rows":['
+            else:
+                yield b'{"treasures":['
+            while chunk is not None:
+                key_list, rows = chunk
+                with timed_phase('serialize'):
+                    # columnar rows are already arrays; otherwise Rows are encoded as objects
+                    encoded = dumps(rows if columnar else Rows(key_list, rows))
+                # drop the brackets so the chunks join into one array
+                yield separator + encoded[1:-1]
+                separator = b','
+                count += len(rows)
+                last_row = dict(zip(key_list, rows[-1]))
+                chunk = await anext(chunks, None)
+                if chunk is not None:
+                    chunk = split_colour_check(*chunk)
+            next_cursor = encode_cursor(sort_by, order, last_row) if limit and count == limit else None
+            yield (b']},"next_cursor":' if columnar else b'],"next_cursor":') + dumps(next_cursor)
+            if page_totals:
+                yield b',' + dumps(await page_totals(count))[1:-1]
+            yield b'}'
+        finally:
+            await chunks.aclose()
+
+    return StreamingResponse(body(chunk), media_type='application/json')
+
+
+@app.get('/api/treasures/export')
+async def export_treasures():
+    set_query_shape('export')
+
+    async def body():
+        chunks, chunk = await open_read_stream(get_export_treasures_query())
+        try:
+            while chunk is not None:
+                key_list, rows = chunk
+                with timed_phase('serialize'):
+                    encoded = b''.join(dumps(dict(zip(key_list, row))) + b'\n' for row in rows)
+                yield encoded
+                chunk = await anext(chunks, None)
+        finally:
+            await chunks.aclose()
+
+    return StreamingResponse(body(), media_type='application/x-ndjson')
+
+
+
+@app.get('/api/treasures/facets')
+async def get_treasures_facets(
+                colour: ColourQuery = None,
+                max_age: MaxAgeQuery = None,
+                min_age: MinAgeQuery = None,
+                q: SearchQuery = None,
+                match: MatchQuery = 'substring',
+                age_bucket:
+                Annotated[int,
+                Query(description='Width of the age histogram buckets, in years', examples=10, gt=0)] = 10,
+                request: Request = None
+                ):
+    filters = parse_treasures_filters(colour, max_age, min_age, q, match)
+    set_query_shape('facets:' + get_filters_shape(filters))
+    # keyed and invalidated like the listings of the same treasures
+    cache_key = response_cache.key('treasures', view='facets', age_bucket=age_bucket, **filters)
+    return await cached_json(request, cache_key, lambda: fetch_treasures_facets(filters, age_bucket))
+
+
+async def fetch_treasures_facets(filters, age_bucket):
+    conditions, params = get_treasures_filters(**filters)
+    query_str = get_facets_query(conditions, check_colour=bool(filters['colour']))
+    response = await run_read_query(query_str, 'facets', True, age_bucket=age_bucket, **params)
+    result = response['facets']
+    return {'facets': format_facets(result.columns, result.rows, age_bucket)}
+
+
+
+MAX_TREASURE_ID = 2 ** 31 - 1
+
+@app.get('/api/treasures/batch')
+async def get_treasures_batch(
+                ids:
+                Annotated[str,
+                Query(description='Comma-separated treasure_ids, returned in this order', examples='3,1,2')]
+                ):
+    try:
+        treasure_ids = [int(treasure_id) for treasure_id in ids.split(',') if treasure_id.strip()]
+    except ValueError:
+        raise HTTPException(status_code=422, detail='ids must be comma-separated integers')
+    return await fetch_treasures_batch(treasure_ids, get_settings().batch_max_ids)
+
+
+class TreasureIds(BaseModel):
+    ids: list[int]
+
+@app.post('/api/treasures/batch')
+async def post_treasures_batch(treasure_ids:TreasureIds):
+    # the same lookup as GET, for id lists too long for a URL
+    return await fetch_treasures_batch(treasure_ids.ids, get_settings().batch_post_max_ids)
+
+
+async def fetch_treasures_batch(treasure_ids, max_ids):
+    set_query_shape('batch')
+    treasure_ids = list(dict.fromkeys(treasure_ids))
+    if not treasure_ids:
+        raise HTTPException(status_code=422, detail='ids must not be empty')
+    if len(treasure_ids) > max_ids:
+        raise HTTPException(status_code=422, detail=f'At most {max_ids} ids can be fetched at once')
+    found, version = row_cache.get_many(treasure_ids)
+    # treasure_id is a SERIAL, so anything outside its range is simply missing
+    uncached = [treasure_id for treasure_id in treasure_ids
+                if treasure_id not in found and 0 < treasure_id <= MAX_TREASURE_ID]
+    # large lists are read BATCH_MAX_IDS at a time, keeping each array parameter small
+    query_ids = get_settings().batch_max_ids
+    for start in range(0, len(uncached), query_ids):
+        try:
+            response = await run_read_query(get_treasures_by_ids_query(), 'treasures', True,
+                                            ids=uncached[start:start + query_ids])
+        except HTTPException as http_err:
+            if http_err.status_code != 404:
+                raise
+        else:
+            result = response['treasures']
+            loaded = {row[0]: dict(zip(result.columns, row)) for row in result.rows}
+            row_cache.put_many(loaded, version)
+            found.update(loaded)
+    return {
+        'treasures': [found[treasure_id] for treasure_id in treasure_ids if treasure_id in found],
+        'missing': [treasure_id for treasure_id in treasure_ids if treasure_id not in found],
+    }
+
+
 class NewTreasure(BaseModel):
     treasure_name : str | None = None
     colour : str | None = None
@@ -149,11 +624,13 @@ class NewTreasure(BaseModel):
 
 
 @app.post('/api/treasures', status_code=201)
-def post_treasures(new_treasure:NewTreasure):
+async def post_treasures(new_treasure:NewTreasure):
     # try:
+    set_query_shape('insert')
     query_str = get_insert_treasures_query()
     params = get_params_from_new_treasure(new_treasure)
-    response = connect_to_db_and_get_formatted_result(query_str, 'treasure', **params)
+    response = await run_query(query_str, 'treasure', **params)
+    await treasures_changed()
     return response
     # except Exception as e:
     #     print(f"An error occurred: {e}")
@@ -161,28 +638,184 @@ def post_treasures(new_treasure:NewTreasure):
 
 
 
+async def iter_bulk_items(request):
+    '''Yield (index, item) pairs from a JSON array body or an NDJSON stream.'''
+    if request.headers.get('content-type', '').startswith(('application/x-ndjson', 'application/jsonl')):
+        buffer = b''
+        index = 0
+        async for chunk in request.stream():
+            *lines, buffer = (buffer + chunk).split(b'\n')
+            for line in lines:
+                if line.strip():
+                    yield index, line
+                    index += 1
+        if buffer.strip():
+            yield index, buffer
+    else:
+        try:
+            items = json.loads(await request.body())
+        except ValueError:
+            raise HTTPException(status_code=422, detail='Expected a JSON array or NDJSON of treasures')
+        if not isinstance(items, list):
+            raise HTTPException(status_code=422, detail='Expected a JSON array or NDJSON of treasures')
+        for index, item in enumerate(items):
+            yield index, item
+
+
+def validate_bulk_treasure(item, shop_ids):
+    try:
+        if isinstance(item, bytes):
+            new_treasure = NewTreasure.model_validate_json(item)
+        else:
+            new_treasure = NewTreasure.model_validate(item)
+    except ValidationError as e:
+        return None, [f"{'.'.join(str(loc) for loc in err['loc']) or 'treasure'} {err['msg']}" for err in e.errors()]
+    # checked up front so one bad row cannot abort the whole COPY
+    problems = []
+    if new_treasure.treasure_name is None:
+        problems.append('treasure_name is required')
+    problems += check_treasure_values(**new_treasure.model_dump())
+    if new_treasure.shop_id is not None and new_treasure.shop_id not in shop_ids:
+        problems.append(f'shop_id {new_treasure.shop_id} does not exist')
+    return new_treasure, problems
+
+
+@app.post('/api/treasures/bulk', status_code=201)
+async def post_treasures_bulk(request:Request,
+                batch_size:
+                Optional[int] =
+                Query(default=None, gt=0, description='Rows loaded per COPY batch (default: BULK_BATCH_SIZE)')
+                ):
+    batch_size = batch_size or get_settings().bulk_batch_size
+    set_query_shape('bulk_insert')
+    with track_db_time():
+        if app.state.db_mode == 'async':
+            shop_ids = await async_get_shop_ids_from_db()
+        else:
+            shop_ids = await run_in_threadpool(get_shop_ids_from_db)
+    rows, errors = [], []
+    async for index, item in iter_bulk_items(request):
+        new_treasure, problems = validate_bulk_treasure(item, shop_ids)
+        if problems:
+            errors.append({'index': index, 'detail': problems})
+        else:
+            rows.append(tuple(get_params_from_new_treasure(new_treasure).values()))
+    if rows:
+        with track_db_time():
+            if app.state.db_mode == 'async':
+                await async_bulk_insert_treasures(rows, batch_size)
+            else:
+                await run_in_threadpool(bulk_insert_treasures, rows, batch_size)
+        await treasures_changed()
+    return {'inserted': len(rows), 'rejected': len(errors), 'errors': errors}
+
+
+# the bulk routes come before /api/treasures/{treasure_id}, which would otherwise take 'bulk' as an id
+
+class TreasureCost(BaseModel):
+    treasure_id: int
+    cost_at_auction: float | None = None
+
+class BulkUpdateTreasures(BaseModel):
+    updates: list[TreasureCost]
+
+@app.patch('/api/treasures/bulk')
+async def patch_treasures_bulk(bulk_update:BulkUpdateTreasures,
+                batch_size:
+                Annotated[Optional[int],
+                Query(gt=0, description='Rows changed per statement and transaction (default: BULK_BATCH_SIZE)')] = None
+                ):
+    set_query_shape('bulk_update')
+    # a later update of the same id wins
+    costs = {update.treasure_id: update.cost_at_auction for update in bulk_update.updates}
+    # checked up front so one bad cost cannot fail the rest of its chunk
+    problems = {treasure_id: check_treasure_values(cost_at_auction=cost) for treasure_id, cost in costs.items()}
+    rejected = {treasure_id: detail for treasure_id, detail in problems.items() if detail}
+    chunks = [{'ids': ids, 'costs': [costs[treasure_id] for treasure_id in ids]}
+              for ids in chunk_treasure_ids([treasure_id for treasure_id in costs if treasure_id not in rejected],
+                                            batch_size)]
+    return await run_bulk_change(get_bulk_update_treasures_query(), chunks, list(costs), 'updated', rejected)
+
+
+@app.delete('/api/treasures/bulk')
+async def delete_treasures_bulk(treasure_ids:TreasureIds,
+                batch_size:
+                Annotated[Optional[int],
+                Query(gt=0, description='Rows deleted per statement and transaction (default: BULK_BATCH_SIZE)')] = None
+                ):
+    set_query_shape('bulk_delete')
+    treasure_ids = list(dict.fromkeys(treasure_ids.ids))
+    chunks = [{'ids': ids} for ids in chunk_treasure_ids(treasure_ids, batch_size)]
+    return await run_bulk_change(get_bulk_delete_treasures_query(), chunks, treasure_ids, 'deleted')
+
+
+def chunk_treasure_ids(treasure_ids, batch_size):
+    # ids outside the SERIAL range cannot exist, and would fail the cast to INT[]
+    treasure_ids = [treasure_id for treasure_id in treasure_ids if 0 < treasure_id <= MAX_TREASURE_ID]
+    batch_size = batch_size or get_settings().bulk_batch_size
+    return [treasure_ids[start:start + batch_size] for start in range(0, len(treasure_ids), batch_size)]
+
+
+async def run_bulk_change(query_str, chunks, treasure_ids, outcome, rejected=None):
+    '''Run a set-based change chunk by chunk and report what happened to each id.
+
+    Each chunk is one statement in its own transaction, so the shop totals
+    kept by statement triggers are updated once per chunk, and the caches
+    once per request. `rejected` maps the ids left out of the chunks to
+    their problems; they are reported as failed.
+    '''
+    rejected = rejected or {}
+    with track_db_time():
+        if app.state.db_mode == 'async':
+            results = await async_run_chunked_transactions(query_str, chunks)
+        else:
+            results = await run_in_threadpool(run_chunked_transactions, query_str, chunks)
+    changed, failed = set(), set(rejected)
+    errors = [{'treasure_ids': [treasure_id], 'detail': problems} for treasure_id, problems in rejected.items()]
+    for chunk, (values, error) in zip(chunks, results):
+        if error is None:
+            changed.update(values)
+        else:
+            failed.update(chunk['ids'])
+            errors.append({'treasure_ids': chunk['ids'], 'detail': error})
+    if changed:
+        await treasures_changed(changed)
+    return {
+        outcome: [treasure_id for treasure_id in treasure_ids if treasure_id in changed],
+        'not_found': [treasure_id for treasure_id in treasure_ids
+                      if treasure_id not in changed and treasure_id not in failed],
+        'failed': [treasure_id for treasure_id in treasure_ids if treasure_id in failed],
+        'errors': errors,
+    }
+
+
 class UpdateTreasures(BaseModel):
     cost_at_auction: int | None = None
 
 @app.patch('/api/treasures/{treasure_id}')
-def patch_treasures(treasure_id:int, update_treasure:UpdateTreasures):
+async def patch_treasures(treasure_id:int, update_treasure:UpdateTreasures):
+    set_query_shape('update')
     try:
         params = {'id':treasure_id}
         params['cost'] = getattr(update_treasure, 'cost_at_auction')
         query_str = get_update_treasures_query()
-        response = connect_to_db_and_get_formatted_result(query_str, 'treasure', **params)
-        return response
+        response = await run_query(query_str, 'treasure', **params)
     except HTTPException as http_err:
         raise HTTPException(status_code=404, detail='There is no data given the request')
+    # outside the try: only an update that matched no row is a 404
+    await treasures_changed([treasure_id])
+    return response
     # except Exception as e:
     #     print(f"An error occurred: {e}")
     #     raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete('/api/treasures/{treasure_id}', status_code=204)
-def delete_treasures(treasure_id:int):
+async def delete_treasures(treasure_id:int):
     # try:
+    set_query_shape('delete')
     query_str = get_delete_treasures_query()
-    response = connect_to_db_and_get_formatted_result(query_str, 'treasure', id=treasure_id)
+    response = await run_query(query_str, 'treasure', id=treasure_id)
+    await treasures_changed([treasure_id])
     # except HTTPException as http_err:
     #     raise HTTPException(status_code=404, detail='There is no such treasure_id in the database')
     # except Exception as e:
@@ -191,10 +824,262 @@ def delete_treasures(treasure_id:int):
 
         
 @app.get('/api/shops')
-def get_shops():
-    query_str = get_shops_query()
-    response = connect_to_db_and_get_formatted_result(query_str, 'shops')
-    return response
+async def get_shops(request: Request = None):
+    set_query_shape('shops')
+    return await cached_json(request, response_cache.key('shops'), lambda: run_read_query(get_shops_query(), 'shops'))
+
+
+# Changes to treasures (and so to the shops they are stocked in) as
+# server-sent events, in place of polling the listings. A reconnecting
+# EventSource sends the id of the last event it got as Last-Event-ID and
+# picks up from the change after it.
+
+@app.get('/api/changes')
+async def get_changes(
+    since: Annotated[int | None, Query(ge=0, description='Send the changes after this change id')] = None,
+    timeout: Annotated[float | None, Query(gt=0, description='Close the stream after this many seconds')] = None,
+    last_event_id: Annotated[int | None, Header(alias='Last-Event-ID', ge=0)] = None,
+):
+    set_query_shape('changes')
+    try:
+        subscription = await change_feed.subscribe(get_settings().change_feed_queue_size)
+    except (OSError, asyncpg.PostgresError) as e:
+        raise HTTPException(status_code=503, detail=f'The change feed is unavailable: {e}')
+    since = last_event_id if last_event_id is not None else since
+    return StreamingResponse(stream_changes(subscription, since, timeout), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def stream_changes(subscription, since, timeout):
+    '''Send the retained changes after `since`, then the live ones, until `timeout` or the feed drops us.'''
+    deadline = time.monotonic() + timeout if timeout else None
+    heartbeat = get_settings().change_feed_heartbeat
+    # without `since` the stream starts from now
+    last = subscription.position if since is None else since
+    try:
+        if last < subscription.position:
+            async for change in replay_changes(last, subscription.position):
+                if change is None:
+                    # the changes after `since` were pruned; the client has to reload
+                    yield b'event: reset\ndata: {}\n\n'
+                    break
+                yield format_event(change)
+            last = max(last, subscription.position)
+        while not (subscription.closed and subscription.queue.empty()):
+            wait = heartbeat if deadline is None else min(heartbeat, deadline - time.monotonic())
+            if wait <= 0:
+                return
+            try:
+                change = await asyncio.wait_for(subscription.queue.get(), wait)
+            except asyncio.TimeoutError:
+                if deadline is None or time.monotonic() < deadline:
+                    yield b': keepalive\n\n'
+                continue
+            if change[0] > last:
+                last = change[0]
+                yield format_event(change)
+    finally:
+        change_feed.unsubscribe(subscription)
+
+
+async def replay_changes(after, through):
+    '''Yield the changes in (after, through] from the outbox, or only None if some may have been pruned.
+
+    A client only resumes from a change it was sent, so that change is
+    still in the outbox unless the ones after it may be gone too. 0 asks
+    for every change kept. A failed read ends the stream with an error, and
+    the client resumes from the last change it got.
+    '''
+    if after and not (await run_query(get_change_kept_query(), 'change', change_id=after))['change']['kept']:
+        yield None
+        return
+    batch_size = get_settings().stream_chunk_size
+    while after < through:
+        try:
+            response = await run_query(get_changes_query(), 'changes', True, after=after, through=through,
+                                       limit=batch_size)
+        except HTTPException as http_err:
+            # a 404 means no change up to `through` was kept, e.g. they all rolled back
+            if http_err.status_code == 404:
+                return
+            raise
+        for change in response['changes'].rows:
+            yield tuple(change)
+        after = response['changes'].rows[-1][0]
+
+
+@app.get('/api/stats/changes')
+async def get_change_feed_stats():
+    return {'change_feed': change_feed.stats()}
+
+
+# The HTML catalogue shows the same listings as /api/treasures and /api/shops.
+# The table of each page is a fragment cached with the JSON responses, so
+# writes invalidate both; the page around it is rendered per request.
+
+@app.get('/treasures', response_class=HTMLResponse)
+async def get_treasures_page(
+                request: Request,
+                sort_by: SortByQuery = None,
+                order: OrderQuery = None,
+                colour: ColourQuery = None,
+                max_age: MaxAgeQuery = None,
+                min_age: MinAgeQuery = None,
+                q: SearchQuery = None,
+                match: MatchQuery = 'substring',
+                limit: LimitQuery = 50,
+                page: PageQuery = 1,
+                cursor: CursorQuery = None,
+                include_total: IncludeTotalQuery = 'false'
+                ):
+    form = {'sort_by': sort_by, 'order': order, 'colour': colour, 'max_age': max_age, 'min_age': min_age,
+            'q': q, 'match': match, 'limit': limit}
+    try:
+        sort_by, order, filters = parse_treasures_listing(sort_by, order, colour, max_age, min_age, q, match)
+        # links carry the normalized parameters, so a cached fragment has the same links for every request it serves
+        links = {'sort_by': sort_by, 'order': order, **filters, 'limit': limit,
+                 'include_total': include_total.lower() if include_total.lower() != 'false' else None}
+        include_total = parse_include_total(include_total)
+        set_query_shape('html:' + get_treasures_shape(sort_by, order, filters, limit, page, cursor))
+        if not limit or limit > get_settings().html_stream_rows:
+            return await stream_treasures_page(form, links, sort_by, order, filters, limit, page, cursor,
+                                               include_total)
+        cache_key = response_cache.key('treasures', view='html', sort_by=sort_by, order=order, limit=limit, page=page,
+                                       cursor=cursor, include_total=include_total, **filters)
+        fragment = await cached_fragment(cache_key, lambda: render_treasures_table(links, sort_by, order, filters,
+                                                                                   limit, page, cursor, include_total))
+    except HTTPException as http_err:
+        return await render_page(request, 'treasures.html', status_code=http_err.status_code, form=form,
+                                 error='No treasures found.' if http_err.status_code == 404 else http_err.detail)
+    return await render_page(request, 'treasures.html', fragment, form=form)
+
+
+def treasures_paging(links, page, cursor, next_cursor, totals=None):
+    '''The links and counts shown under a catalogue page.'''
+    if cursor:
+        # a cursor does not know the page before it, so this goes back to the start
+        previous = page_link(links)
+    else:
+        previous = page_link(links, page=page - 1) if page > 1 else None
+    paging = {'previous': previous, 'next': page_link(links, cursor=next_cursor) if next_cursor else None,
+              'page': None if cursor else page}
+    if totals:
+        paging.update(total=totals['total'], total_exact=totals['total_exact'], page_count=totals['page_count'])
+    return paging
+
+
+async def render_treasures_table(links, sort_by, order, filters, limit, page, cursor, include_total):
+    response = await fetch_treasures(sort_by, order, filters, limit, page, cursor, include_total=include_total)
+    treasures = [response['treasures']] if isinstance(response['treasures'], dict) else response['treasures']
+    paging = treasures_paging(links, page, cursor, response['next_cursor'], include_total and response)
+    with timed_phase('render'):
+        rows = await templates.get_template('_treasure_rows.html').render_async(treasures=treasures)
+        return await templates.get_template('_treasure_table.html').render_async(row_chunks=[Markup(rows)],
+                                                                                 paging=lambda: paging)
+
+
+async def stream_treasures_page(form, links, sort_by, order, filters, limit, page, cursor, include_total):
+    '''Render a large page as its rows are read, one chunk of rows at a time.'''
+    query_str, params = build_treasures_listing(sort_by, order, filters, limit, page, cursor)
+    chunks, chunk = await open_treasures_stream(query_str, params)
+    rows_template = templates.get_template('_treasure_rows.html')
+    count, last_row = 0, None
+
+    async def row_chunks(chunk):
+        nonlocal count, last_row
+        while chunk is not None:
+            key_list, rows = chunk
+            yield Markup(await rows_template.render_async(treasures=Rows(key_list, rows)))
+            count += len(rows)
+            last_row = dict(zip(key_list, rows[-1]))
+            chunk = await anext(chunks, None)
+            if chunk is not None:
+                chunk = split_colour_check(*chunk)
+
+    # called by the template after the last row
+    async def paging():
+        next_cursor = encode_cursor(sort_by, order, last_row) if limit and count == limit else None
+        totals = include_total and await get_page_totals(include_total, filters, limit, page, cursor, count)
+        return treasures_paging(links, page, cursor, next_cursor, totals)
+
+    async def body():
+        try:
+            pieces = templates.get_template('treasures.html').generate_async(form=form, table=None,
+                                                                             row_chunks=row_chunks(chunk), paging=paging)
+            async for piece in buffered(pieces):
+                yield piece
+        finally:
+            await chunks.aclose()
+
+    return StreamingResponse(body(), media_type='text/html')
+
+
+@app.get('/shops', response_class=HTMLResponse)
+async def get_shops_page(request: Request):
+    set_query_shape('html:shops')
+    try:
+        fragment = await cached_fragment(response_cache.key('shops', view='html'), render_shops_table)
+    except HTTPException as http_err:
+        return await render_page(request, 'shops.html', status_code=http_err.status_code, error=http_err.detail)
+    return await render_page(request, 'shops.html', fragment)
+
+
+async def render_shops_table():
+    response = await run_read_query(get_shops_query(), 'shops')
+    shops = [response['shops']] if isinstance(response['shops'], dict) else response['shops']
+    with timed_phase('render'):
+        return await templates.get_template('_shop_table.html').render_async(shops=shops)
+
+
+async def cached_fragment(cache_key, render):
+    '''Serve the HTML of `render()` through the response cache; returns (body, etag).'''
+    cached = response_cache.get(cache_key)
+    if cached is None:
+        body = (await render()).encode()
+        cached = body, response_cache.put(cache_key, body)
+    return cached
+
+
+async def render_page(request, name, fragment=None, status_code=200, **context):
+    '''Render the page `name` around a cached (body, etag) `fragment`, answering If-None-Match with 304.'''
+    headers = {}
+    if fragment is not None:
+        etag = page_etag(fragment[1])
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return Response(status_code=304, headers={'ETag': etag})
+        headers['ETag'] = etag
+        context['table'] = Markup(fragment[0].decode())
+    with timed_phase('render'):
+        body = await templates.get_template(name).render_async(**context)
+    return HTMLResponse(body, status_code=status_code, headers=headers)
+
+
+@app.get('/api/stats/pool')
+async def get_pool_stats():
+    if app.state.db_mode == 'async':
+        return {'pool': await async_pool_stats()}
+    return {'pool': get_pool().stats()}
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
+
+
+@app.get('/api/stats/statements')
+async def get_statement_stats():
+    return {'statements': statement_stats.stats()}
+
+
+@app.get('/api/stats/replicas')
+async def get_replica_stats():
+    return {'routing': get_router().stats()}
+
+
+@app.get('/api/stats/cache')
+async def get_cache_stats():
+    return {'response_cache': response_cache.stats(), 'row_cache': row_cache.stats(),
+            'count_cache': count_cache.stats()}
 
 
 
@@ -1,20 +1,37 @@
 '''This module contains the test suite for the
 `Cat's Rare Treasures` FastAPI app.'''
 
-from main import app
+from main import app, reset_caches
+from fastapi import HTTPException
+from db.timing import parse_server_timing
+from db.settings import get_settings
+from dataclasses import replace
+import db.settings
 import pytest
 from fastapi.testclient import TestClient
-from db.seed import seed_db
+from db.seed import restore_db
+from catalogue import templates, static_files
+from db.connection import connect_to_db
+from db.settings import Settings
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import html
 import json
+import time
+import re
 
-@pytest.fixture
-def test_client():
-    return TestClient(app)
+@pytest.fixture(params=['async', 'sync'])
+def test_client(request):
+    # run every API test against both data-access paths
+    app.state.db_mode = request.param
+    with TestClient(app) as client:
+        yield client
 
 @pytest.fixture(autouse=True) # scope default to be function
 def reset_db():
     try:
-        seed_db('test')
+        restore_db('test')
+        reset_caches()
     except Exception as e:
         print(e)
         raise e
@@ -76,7 +93,7 @@ class TestGetTreasures:
     def test_422_get_treasure_bad_request_sort_by(self, test_client):
         response = test_client.get('/api/treasures?sort_by=trea')
         assert response.status_code == 422
-        assert response.json()['detail'][0]['msg'] == "String should match pattern '^(?i)(age|cost_at_auction|treasure_name|treasure_id)$'"
+        assert response.json()['detail'][0]['msg'] == "String should match pattern '^(?i)(age|cost_at_auction|treasure_name|treasure_id|relevance)$'"
         #assert response.json()['detail'][0]['msg'] == "Input should be 'age', 'cost_at_auction' or 'treasure_name'"
         
 
@@ -332,6 +349,14 @@ class TestPatchTreasures:
         error_response = response.json()['detail']
         assert error_response == 'There is no data given the request'
 
+    @pytest.mark.it('Test if patch_treasures does not report a failure after the update as a 404')
+    def test_503_patch_treasures_failure_after_update(self, test_client, monkeypatch):
+        async def treasures_changed(treasure_ids=()):
+            raise HTTPException(status_code=503, detail='Replica unavailable')
+        monkeypatch.setattr('main.treasures_changed', treasures_changed)
+        response = test_client.patch('/api/treasures/1', json={"cost_at_auction": 7000})
+        assert response.status_code == 503
+
     @pytest.mark.it('Test if patch_treasures return 422 status code with incorrect data type')
     def test_422_patch_treasures_incorrect_data_type(self, test_client):
         input_data = {
@@ -391,3 +416,903 @@ class TestGetShops:
     
 
 
+
+
+class TestGetPoolStats:
+    @pytest.mark.it('Test if get_pool_stats returns 200 status code and pool usage')
+    def test_200_get_pool_stats(self, test_client):
+        test_client.get('/api/treasures')
+        response = test_client.get('/api/stats/pool')
+        assert response.status_code == 200
+        pool_stats = response.json()['pool']
+        for key in ['min_size', 'max_size', 'in_use', 'idle', 'avg_wait_ms', 'max_wait_ms']:
+            assert key in pool_stats
+        assert pool_stats['in_use'] == 0
+        assert pool_stats['idle'] >= 1
+        assert pool_stats['checkouts'] >= 1
+
+
+class TestColourCheck:
+    @pytest.mark.it('Test if a colour filtered listing runs a single statement')
+    def test_colour_check_in_listing_statement(self, test_client):
+        before = test_client.get('/api/stats/statements').json()['statements']
+        # a limit no other test uses, so the response cache cannot answer it
+        response = test_client.get('/api/treasures?colour=GOLD&limit=17')
+        assert response.status_code == 200
+        after = test_client.get('/api/stats/statements').json()['statements']
+        assert after['hits'] + after['misses'] == before['hits'] + before['misses'] + 1
+
+    @pytest.mark.it('Test if a known colour past the last page returns 404 status code, not 422')
+    def test_404_colour_page_too_large(self, test_client):
+        for stream in ['false', 'true']:
+            response = test_client.get(f'/api/treasures?colour=gold&page=100&stream={stream}')
+            assert response.status_code == 404
+            assert response.json()['detail'] == 'Page Not Found'
+
+    @pytest.mark.it('Test if a known colour with no rows matching the other filters returns 404 status code')
+    def test_404_colour_filtered_out(self, test_client):
+        response = test_client.get('/api/treasures?colour=gold&min_age=100000')
+        assert response.status_code == 404
+
+    @pytest.mark.it('Test if a streamed listing of an unknown colour returns 422 status code')
+    def test_422_stream_unknown_colour(self, test_client):
+        response = test_client.get('/api/treasures?colour=noncolour&stream=true')
+        assert response.status_code == 422
+
+    @pytest.mark.it('Test if streams closed early hand their pooled connection back in sync mode')
+    def test_422_stream_releases_sync_connection(self, monkeypatch):
+        monkeypatch.setattr(db.settings, '_settings', replace(get_settings(), pool_max_size=2, pool_checkout_timeout=1.0))
+        app.state.db_mode = 'sync'
+        with TestClient(app) as client:
+            for _ in range(5):
+                assert client.get('/api/treasures?colour=noncolour&stream=true').status_code == 422
+            assert client.get('/api/treasures?stream=true').status_code == 200
+
+    @pytest.mark.it('Test if a colour added by post_treasures is valid straight away')
+    def test_new_colour_added_on_post(self, test_client):
+        assert test_client.get('/api/treasures?colour=mauve').status_code == 422
+        input_data = {"treasure_name": "Mauve Vase", "colour": "mauve", "age": 5, "cost_at_auction": 10.0, "shop_id": 2}
+        assert test_client.post('/api/treasures', json=input_data).status_code == 201
+        response = test_client.get('/api/treasures?colour=mauve')
+        assert response.status_code == 200
+        assert response.json()['treasures']['treasure_name'] == 'Mauve Vase'
+
+    @pytest.mark.it('Test if deleting the last treasure of a colour makes it invalid')
+    def test_deleted_colour_removed_on_delete(self, test_client):
+        treasures = test_client.get('/api/treasures?limit=26').json()['treasures']
+        colour_counts = {}
+        for treasure in treasures:
+            colour_counts.setdefault(treasure['colour'], []).append(treasure['treasure_id'])
+        colour, ids = next((colour, ids) for colour, ids in colour_counts.items() if len(ids) == 1)
+        assert test_client.get(f'/api/treasures?colour={colour}').status_code == 200
+        assert test_client.delete(f'/api/treasures/{ids[0]}').status_code == 204
+        assert test_client.get(f'/api/treasures?colour={colour}').status_code == 422
+
+
+class TestGetTreasuresCursor:
+    def walk(self, test_client, query):
+        treasures = []
+        response = test_client.get(f'/api/treasures?{query}&limit=4')
+        while response.status_code == 200:
+            page = response.json()['treasures']
+            treasures += page if isinstance(page, list) else [page]
+            if not response.json()['next_cursor']:
+                break
+            response = test_client.get(f"/api/treasures?{query}&limit=4&cursor={response.json()['next_cursor']}")
+        return treasures
+
+    @pytest.mark.it('Test if following next_cursor walks every treasure in order for each sort_by and order')
+    @pytest.mark.parametrize('sort_by', ['age', 'cost_at_auction', 'treasure_name', 'treasure_id'])
+    @pytest.mark.parametrize('order', ['asc', 'DESC'])
+    def test_200_cursor_walks_all_treasures(self, test_client, sort_by, order):
+        # rows without an age or cost sort last ascending and first descending
+        input_data = {"treasure_name": "Unknown Relic", "colour": "gold", "shop_id": 2}
+        assert test_client.post('/api/treasures', json=input_data).status_code == 201
+        expected = test_client.get(f'/api/treasures?sort_by={sort_by}&order={order}&limit=27').json()['treasures']
+        assert self.walk(test_client, f'sort_by={sort_by}&order={order}') == expected
+
+    @pytest.mark.it('Test if cursor pagination combines with colour and age filters')
+    def test_200_cursor_with_filters(self, test_client):
+        query = 'sort_by=cost_at_auction&order=desc&min_age=1&max_age=500'
+        expected = test_client.get(f'/api/treasures?{query}&limit=26').json()['treasures']
+        assert self.walk(test_client, query) == expected
+
+    @pytest.mark.it('Test if the page parameter still works alongside next_cursor')
+    def test_200_page_returns_next_cursor(self, test_client):
+        response = test_client.get('/api/treasures?sort_by=treasure_name&page=2')
+        assert response.status_code == 200
+        assert len(response.json()['treasures']) == 5
+        assert response.json()['next_cursor']
+
+    @pytest.mark.it('Test if get_treasures return 422 status code with a malformed cursor')
+    def test_422_invalid_cursor(self, test_client):
+        response = test_client.get('/api/treasures?cursor=not-a-cursor')
+        assert response.status_code == 422
+        assert response.json()['detail'] == 'Invalid cursor'
+
+    @pytest.mark.it('Test if get_treasures return 422 status code for a cursor with values of the wrong type')
+    @pytest.mark.parametrize('payload', [
+        ['age', 'ASC', [1], 1],
+        ['age', 'ASC', 'old', 1],
+        ['age', 'ASC', 2 ** 31, 1],
+        ['cost_at_auction', 'ASC', float('nan'), 1],
+        ['treasure_name', 'ASC', 5, 1],
+        ['age', 'ASC', 5, '1'],
+        ['age', 'ASC', 5, True],
+        ['relevance', 'DESC', None, 1],
+    ])
+    def test_422_cursor_with_wrong_types(self, test_client, payload):
+        cursor = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+        sort_by, order = payload[0], payload[1]
+        response = test_client.get(f'/api/treasures?sort_by={sort_by}&order={order}&q=treasure&cursor={cursor}')
+        assert response.status_code == 422
+        assert response.json()['detail'] == 'Invalid cursor'
+
+    @pytest.mark.it('Test if get_treasures return 422 status code when the cursor was made for another sort')
+    def test_422_cursor_for_other_sort(self, test_client):
+        next_cursor = test_client.get('/api/treasures?sort_by=age').json()['next_cursor']
+        response = test_client.get(f'/api/treasures?sort_by=treasure_name&cursor={next_cursor}')
+        assert response.status_code == 422
+        assert response.json()['detail'] == 'The cursor does not match sort_by and order'
+
+
+class TestPostTreasuresBulk:
+    @pytest.mark.it('Test if bulk post loads a JSON array and reports rejected rows')
+    def test_201_bulk_json_array(self, test_client):
+        input_data = [
+            {"treasure_name": "Bulk Lamp", "colour": "gold", "age": 3, "cost_at_auction": 12.5, "shop_id": 2},
+            {"colour": "gold", "age": 3, "cost_at_auction": 12.5, "shop_id": 2},
+            {"treasure_name": "Bulk Rug", "colour": "crimson", "age": "old", "shop_id": 2},
+            {"treasure_name": "Bulk Mirror", "colour": "silver", "age": 40, "cost_at_auction": 99.99, "shop_id": 123},
+            {"treasure_name": "Bulk Clock", "colour": "crimson", "age": 7, "cost_at_auction": 19.99},
+        ]
+        response = test_client.post('/api/treasures/bulk?batch_size=1', json=input_data)
+        assert response.status_code == 201
+        body = response.json()
+        assert body['inserted'] == 2
+        assert body['rejected'] == 3
+        assert [error['index'] for error in body['errors']] == [1, 2, 3]
+        assert body['errors'][0]['detail'] == ['treasure_name is required']
+        assert 'age' in body['errors'][1]['detail'][0]
+        assert body['errors'][2]['detail'] == ['shop_id 123 does not exist']
+
+        treasures = test_client.get('/api/treasures?sort_by=treasure_id&order=desc&limit=2').json()['treasures']
+        assert [treasure['treasure_name'] for treasure in treasures] == ['Bulk Clock', 'Bulk Lamp']
+        assert treasures[0]['cost_at_auction'] == 19.99
+        assert treasures[0]['shop_name'] is None
+        assert test_client.get('/api/treasures?colour=crimson').status_code == 200
+
+    @pytest.mark.it('Test if bulk post rejects values the columns cannot store without failing the other rows')
+    @pytest.mark.parametrize('bad_values, field', [
+        ({"colour": "c" * 43}, 'colour'),
+        ({"treasure_name": "n" * 257}, 'treasure_name'),
+        ({"age": 2 ** 31}, 'age'),
+        ({"cost_at_auction": 1e300}, 'cost_at_auction'),
+        ({"cost_at_auction": 1e-50}, 'cost_at_auction'),
+        ({"treasure_name": "Nul\u0000Lot"}, 'treasure_name'),
+    ])
+    def test_201_bulk_rejects_out_of_range_values(self, test_client, bad_values, field):
+        good = {"treasure_name": "Bulk Lamp", "colour": "gold", "age": 3, "cost_at_auction": 12.5, "shop_id": 2}
+        response = test_client.post('/api/treasures/bulk', json=[good, {**good, **bad_values}, good])
+        assert response.status_code == 201
+        body = response.json()
+        assert body['inserted'] == 2
+        [error] = body['errors']
+        assert error['index'] == 1
+        assert error['detail'][0].startswith(field)
+
+    @pytest.mark.it('Test if bulk post loads an NDJSON stream')
+    def test_201_bulk_ndjson(self, test_client):
+        lines = [json.dumps({"treasure_name": f"Lot {n}", "colour": "gold", "age": n, "cost_at_auction": n, "shop_id": 1})
+                 for n in range(30)]
+        body = '\n'.join(lines[:10]) + '\n{not json}\n\n' + '\n'.join(lines[10:])
+        response = test_client.post('/api/treasures/bulk', content=body,
+                                    headers={'content-type': 'application/x-ndjson'})
+        assert response.status_code == 201
+        assert response.json()['inserted'] == 30
+        assert [error['index'] for error in response.json()['errors']] == [10]
+        assert len(test_client.get('/api/treasures?limit=100').json()['treasures']) == 56
+
+    @pytest.mark.it('Test if bulk post return 422 status code when the body is not an array')
+    def test_422_bulk_not_an_array(self, test_client):
+        response = test_client.post('/api/treasures/bulk', json={"treasure_name": "Lonely Lot"})
+        assert response.status_code == 422
+        assert response.json()['detail'] == 'Expected a JSON array or NDJSON of treasures'
+
+
+class TestResponseCache:
+    @pytest.mark.it('Test if repeated listings with equivalent parameters are served from the cache')
+    def test_equivalent_queries_hit_cache(self, test_client):
+        first = test_client.get('/api/treasures?sort_by=AGE&order=asc&colour=Gold')
+        before = test_client.get('/api/stats/cache').json()['response_cache']
+        second = test_client.get('/api/treasures?colour=gOLD&order=ASC&sort_by=age&limit=5&page=1')
+        after = test_client.get('/api/stats/cache').json()['response_cache']
+        assert second.status_code == 200
+        assert second.json() == first.json()
+        assert second.headers['etag'] == first.headers['etag']
+        assert after['hits'] == before['hits'] + 1
+        assert after['entries'] >= 1 and after['bytes'] > 0
+
+    @pytest.mark.it('Test if a matching If-None-Match gets 304 with no body')
+    def test_304_if_none_match(self, test_client):
+        etag = test_client.get('/api/shops').headers['etag']
+        response = test_client.get('/api/shops', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.content == b''
+        assert response.headers['etag'] == etag
+
+    @pytest.mark.it('Test if If-None-Match compares whole tags, weakly, and honours *')
+    def test_if_none_match_tags(self, test_client):
+        etag = test_client.get('/api/shops').headers['etag']
+        for header in [f'"other", {etag}', f'W/{etag}', '*']:
+            assert test_client.get('/api/shops', headers={'If-None-Match': header}).status_code == 304
+        for header in [f'"x{etag[1:-1]}x"', etag[:-1] + 'x"', '"other"']:
+            assert test_client.get('/api/shops', headers={'If-None-Match': header}).status_code == 200
+
+    @pytest.mark.it('Test if writes invalidate cached treasures and shops')
+    def test_writes_invalidate_cache(self, test_client):
+        treasures_etag = test_client.get('/api/treasures?sort_by=treasure_id').headers['etag']
+        shops_before = test_client.get('/api/shops').json()['shops']
+        test_client.patch('/api/treasures/1', json={"cost_at_auction": 7000})
+        response = test_client.get('/api/treasures?sort_by=treasure_id', headers={'If-None-Match': treasures_etag})
+        assert response.status_code == 200
+        assert response.json()['treasures'][0]['cost_at_auction'] == 7000
+        assert test_client.get('/api/shops').json()['shops'] != shops_before
+        test_client.delete('/api/treasures/1')
+        assert test_client.get('/api/treasures?sort_by=treasure_id').json()['treasures'][0]['treasure_id'] == 2
+
+
+class TestStreamTreasures:
+    @pytest.mark.it('Test if a streamed listing matches the buffered one')
+    def test_200_stream_matches_listing(self, test_client):
+        query = 'sort_by=cost_at_auction&order=desc&min_age=1&limit=20'
+        expected = test_client.get(f'/api/treasures?{query}').json()
+        response = test_client.get(f'/api/treasures?{query}&stream=true')
+        assert response.status_code == 200
+        assert response.json() == expected
+
+    @pytest.mark.it('Test if a streamed listing without a limit returns every treasure in one list')
+    def test_200_stream_without_limit(self, test_client):
+        response = test_client.get('/api/treasures?limit=0&stream=true')
+        assert response.status_code == 200
+        assert len(response.json()['treasures']) == 26
+        assert response.json()['next_cursor'] is None
+
+    @pytest.mark.it('Test if a streamed listing return 404 status code past the last page')
+    def test_404_stream_page_too_large(self, test_client):
+        response = test_client.get('/api/treasures?page=100&stream=true')
+        assert response.status_code == 404
+        assert response.json()['detail'] == 'Page Not Found'
+
+    @pytest.mark.it('Test if export streams the full catalogue as NDJSON ordered by treasure_id')
+    def test_200_export_ndjson(self, test_client):
+        response = test_client.get('/api/treasures/export')
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        treasures = [json.loads(line) for line in response.text.splitlines()]
+        assert [treasure['treasure_id'] for treasure in treasures] == list(range(1, 27))
+        assert treasures == test_client.get('/api/treasures?sort_by=treasure_id&limit=26').json()['treasures']
+
+
+class TestColumnarFormat:
+    @pytest.mark.it('Test if format=columnar returns the column names once and one array per row')
+    def test_200_columnar_matches_listing(self, test_client):
+        query = 'sort_by=cost_at_auction&order=desc&limit=5'
+        expected = test_client.get(f'/api/treasures?{query}').json()
+        response = test_client.get(f'/api/treasures?{query}&format=columnar')
+        assert response.status_code == 200
+        body = response.json()
+        columns = body['treasures']['columns']
+        assert [dict(zip(columns, row)) for row in body['treasures']['rows']] == expected['treasures']
+        assert body['next_cursor'] == expected['next_cursor']
+
+    @pytest.mark.it('Test if format=columnar returns a single row as a one-element list')
+    def test_200_columnar_single_row(self, test_client):
+        response = test_client.get('/api/treasures?limit=1&format=COLUMNAR')
+        assert response.status_code == 200
+        assert len(response.json()['treasures']['rows']) == 1
+
+    @pytest.mark.it('Test if a streamed columnar listing matches the buffered one')
+    def test_200_columnar_stream(self, test_client):
+        query = 'min_age=1&limit=20&format=columnar'
+        expected = test_client.get(f'/api/treasures?{query}').json()
+        response = test_client.get(f'/api/treasures?{query}&stream=true')
+        assert response.status_code == 200
+        assert response.json() == expected
+
+    @pytest.mark.it('Test if an unknown format returns 422 status code')
+    def test_422_unknown_format(self, test_client):
+        response = test_client.get('/api/treasures?format=xml')
+        assert response.status_code == 422
+
+
+class TestIncludeTotal:
+    @pytest.mark.it('Test if include_total adds the total, page count and has_next to a page')
+    def test_200_include_total(self, test_client):
+        response = test_client.get('/api/treasures?limit=5&include_total=exact')
+        assert response.status_code == 200
+        body = response.json()
+        assert len(body['treasures']) == 5
+        assert (body['total'], body['total_exact'], body['page_count'], body['has_next']) == (26, True, 6, True)
+        body = test_client.get('/api/treasures?limit=5&page=6&include_total=exact').json()
+        assert (body['total'], body['page_count'], body['has_next']) == (26, 6, False)
+
+    @pytest.mark.it('Test if include_total counts only the filtered treasures')
+    def test_200_include_total_filtered(self, test_client):
+        body = test_client.get('/api/treasures?colour=gold&limit=1&include_total=true').json()
+        assert (body['total'], body['total_exact'], body['page_count'], body['has_next']) == (2, True, 2, True)
+        body = test_client.get('/api/treasures?min_age=10&limit=0&include_total=true').json()
+        assert (body['total'], body['page_count'], body['has_next']) == (len(body['treasures']), 1, False)
+
+    @pytest.mark.it('Test if include_total=estimate uses the planner estimate')
+    def test_200_include_total_estimate(self, test_client):
+        body = test_client.get('/api/treasures?limit=5&include_total=estimate').json()
+        # the seed analyzes the table, so the estimate is the row count
+        assert (body['total'], body['total_exact'], body['has_next']) == (26, False, True)
+        body = test_client.get('/api/treasures?limit=5&include_total=exact').json()
+        assert body['total_exact']
+
+    @pytest.mark.it('Test if include_total works with cursors, streaming and the columnar format')
+    def test_200_include_total_other_paging(self, test_client):
+        first = test_client.get('/api/treasures?limit=10&include_total=exact').json()
+        body = test_client.get(f"/api/treasures?limit=10&include_total=exact&cursor={first['next_cursor']}").json()
+        assert (body['total'], body['page_count'], body['has_next']) == (26, 3, True)
+        body = test_client.get('/api/treasures?limit=5&stream=true&include_total=exact').json()
+        assert (len(body['treasures']), body['total'], body['has_next']) == (5, 26, True)
+        body = test_client.get('/api/treasures?limit=5&format=columnar&include_total=exact').json()
+        assert (len(body['treasures']['rows']), body['total'], body['page_count']) == (5, 26, 6)
+
+    @pytest.mark.it('Test if the total is cached by filters and refreshed after a write')
+    def test_include_total_count_cache(self, test_client):
+        test_client.get('/api/treasures?limit=5&include_total=exact')
+        before = test_client.get('/api/stats/cache').json()['count_cache']
+        body = test_client.get('/api/treasures?limit=5&sort_by=cost_at_auction&include_total=exact').json()
+        assert test_client.get('/api/stats/cache').json()['count_cache']['hits'] == before['hits'] + 1
+        assert body['total'] == 26
+        assert test_client.delete('/api/treasures/1').status_code == 204
+        body = test_client.get('/api/treasures?limit=5&sort_by=cost_at_auction&include_total=exact').json()
+        assert body['total'] == 25
+
+    @pytest.mark.it('Test if include_total returns 422 status code for an unknown mode')
+    def test_422_include_total_unknown_mode(self, test_client):
+        assert test_client.get('/api/treasures?include_total=maybe').status_code == 422
+
+
+class TestNameSearch:
+    @pytest.mark.it('Test if q finds the treasures whose names contain it, ignoring case')
+    def test_200_q_substring(self, test_client):
+        response = test_client.get('/api/treasures?q=SURE-Q')
+        assert response.status_code == 200
+        assert response.json()['treasures']['treasure_name'] == 'treasure-q'
+
+    @pytest.mark.it('Test if match=prefix only finds names starting with q')
+    def test_200_q_prefix(self, test_client):
+        body = test_client.get('/api/treasures?q=treasure-&match=prefix&limit=0').json()
+        assert len(body['treasures']) == 26
+        assert test_client.get('/api/treasures?q=easure-&match=prefix').status_code == 404
+
+    @pytest.mark.it('Test if match=fuzzy finds misspelt names and ranks the closest first')
+    def test_200_q_fuzzy(self, test_client):
+        body = test_client.get('/api/treasures?q=treasure-qq&match=fuzzy&limit=3').json()
+        assert body['treasures'][0]['treasure_name'] == 'treasure-q'
+        relevance = [treasure['relevance'] for treasure in body['treasures']]
+        assert relevance == sorted(relevance, reverse=True)
+
+    @pytest.mark.it('Test if a search sorted by relevance pages through every match with cursors')
+    def test_200_q_relevance_cursor(self, test_client):
+        body = test_client.get('/api/treasures?q=treasure-&match=fuzzy&limit=4').json()
+        seen = [treasure['treasure_id'] for treasure in body['treasures']]
+        while body['next_cursor']:
+            response = test_client.get(f"/api/treasures?q=treasure-&match=fuzzy&limit=4&cursor={body['next_cursor']}")
+            if response.status_code == 404:
+                break
+            body = response.json()
+            treasures = body['treasures'] if isinstance(body['treasures'], list) else [body['treasures']]
+            seen += [treasure['treasure_id'] for treasure in treasures]
+        assert sorted(seen) == list(range(1, 27))
+
+    @pytest.mark.it('Test if q combines with the colour and age filters, sorting and totals')
+    def test_200_q_with_filters(self, test_client):
+        body = test_client.get('/api/treasures?q=treasure&colour=gold&sort_by=age&include_total=exact').json()
+        assert [treasure['treasure_name'] for treasure in body['treasures']] == ['treasure-b', 'treasure-c']
+        assert 'relevance' not in body['treasures'][0]
+        assert body['total'] == 2
+        body = test_client.get('/api/treasures?q=treasure-&match=prefix&min_age=100&sort_by=treasure_id&limit=0').json()
+        expected = test_client.get('/api/treasures?min_age=100&sort_by=treasure_id&limit=0').json()
+        assert body['treasures'] == expected['treasures']
+
+    @pytest.mark.it('Test if LIKE wildcards in q are matched literally')
+    def test_404_q_wildcards(self, test_client):
+        assert test_client.get('/api/treasures?q=%25&match=prefix').status_code == 404
+        assert test_client.get('/api/treasures?q=treasure_q').status_code == 404
+
+    @pytest.mark.it('Test if q returns 422 status code for a short substring or relevance without q')
+    def test_422_q_invalid(self, test_client):
+        assert test_client.get('/api/treasures?q=tr').status_code == 422
+        assert test_client.get('/api/treasures?q=tr&match=prefix').status_code == 200
+        assert test_client.get('/api/treasures?sort_by=relevance').status_code == 422
+        assert test_client.get('/api/treasures?q=treasure&match=regex').status_code == 422
+
+
+class TestTreasuresBatch:
+    @pytest.mark.it('Test if batch returns the requested treasures in request order and reports missing ids')
+    def test_200_batch_keeps_order(self, test_client):
+        response = test_client.get('/api/treasures/batch?ids=5,999,2,5,0')
+        assert response.status_code == 200
+        body = response.json()
+        assert [treasure['treasure_id'] for treasure in body['treasures']] == [5, 2]
+        assert body['missing'] == [999, 0]
+        listing = test_client.get('/api/treasures?sort_by=treasure_id&limit=26').json()['treasures']
+        assert body['treasures'] == [listing[4], listing[1]]
+
+    @pytest.mark.it('Test if the POST form of batch returns the same as GET')
+    def test_200_post_batch(self, test_client):
+        expected = test_client.get('/api/treasures/batch?ids=3,1,2147483648').json()
+        response = test_client.post('/api/treasures/batch', json={'ids': [3, 1, 2147483648]})
+        assert response.status_code == 200
+        assert response.json() == expected
+        assert expected['missing'] == [2147483648]
+
+    @pytest.mark.it('Test if batch serves repeated ids from the row cache')
+    def test_batch_row_cache_hits(self, test_client):
+        test_client.get('/api/treasures/batch?ids=1,2')
+        before = test_client.get('/api/stats/cache').json()['row_cache']
+        test_client.get('/api/treasures/batch?ids=2,1')
+        after = test_client.get('/api/stats/cache').json()['row_cache']
+        assert after['hits'] == before['hits'] + 2
+        assert after['misses'] == before['misses']
+
+    @pytest.mark.it('Test if patch_treasures invalidates the cached row')
+    def test_batch_after_patch(self, test_client):
+        test_client.get('/api/treasures/batch?ids=1')
+        assert test_client.patch('/api/treasures/1', json={'cost_at_auction': 1234}).status_code == 200
+        response = test_client.get('/api/treasures/batch?ids=1')
+        assert response.json()['treasures'][0]['cost_at_auction'] == 1234
+
+    @pytest.mark.it('Test if delete_treasures invalidates the cached row')
+    def test_batch_after_delete(self, test_client):
+        test_client.get('/api/treasures/batch?ids=1,2')
+        assert test_client.delete('/api/treasures/1').status_code == 204
+        response = test_client.get('/api/treasures/batch?ids=1,2')
+        assert [treasure['treasure_id'] for treasure in response.json()['treasures']] == [2]
+        assert response.json()['missing'] == [1]
+
+    @pytest.mark.it('Test if batch returns 422 status code for bad, empty or too many ids')
+    def test_422_batch_bad_ids(self, test_client, monkeypatch):
+        assert test_client.get('/api/treasures/batch?ids=1,a').status_code == 422
+        assert test_client.get('/api/treasures/batch?ids=').status_code == 422
+        assert test_client.post('/api/treasures/batch', json={'ids': []}).status_code == 422
+        monkeypatch.setattr(db.settings, '_settings', replace(get_settings(), batch_max_ids=2, batch_post_max_ids=4))
+        assert test_client.get('/api/treasures/batch?ids=1,2,3').status_code == 422
+        assert test_client.post('/api/treasures/batch', json={'ids': [1, 2, 3, 4, 5]}).status_code == 422
+
+    @pytest.mark.it('Test if a POST batch of more than BATCH_MAX_IDS ids is read in several queries')
+    def test_post_batch_beyond_get_limit(self, test_client, monkeypatch):
+        monkeypatch.setattr(db.settings, '_settings', replace(get_settings(), batch_max_ids=2))
+        response = test_client.post('/api/treasures/batch', json={'ids': [5, 4, 999, 3, 2, 1]})
+        assert response.status_code == 200
+        assert [treasure['treasure_id'] for treasure in response.json()['treasures']] == [5, 4, 3, 2, 1]
+        assert response.json()['missing'] == [999]
+
+
+class TestBulkUpdateTreasures:
+    @pytest.mark.it('Test if bulk patch updates every id and reports the ids it could not find')
+    def test_200_bulk_patch(self, test_client):
+        updates = [{"treasure_id": 1, "cost_at_auction": 5.5}, {"treasure_id": 999, "cost_at_auction": 1},
+                   {"treasure_id": 2}, {"treasure_id": 3, "cost_at_auction": 7}, {"treasure_id": 1, "cost_at_auction": 6.5}]
+        response = test_client.patch('/api/treasures/bulk?batch_size=2', json={"updates": updates})
+        assert response.status_code == 200
+        assert response.json() == {'updated': [1, 2, 3], 'not_found': [999], 'failed': [], 'errors': []}
+        treasures = test_client.get('/api/treasures/batch?ids=1,2,3').json()['treasures']
+        # the last update of an id wins
+        assert [treasure['cost_at_auction'] for treasure in treasures] == [6.5, None, 7.0]
+
+    @pytest.mark.it('Test if bulk patch keeps the chunks that succeeded when one chunk fails')
+    def test_200_bulk_patch_failed_chunk(self, test_client):
+        updates = [{"treasure_id": 1, "cost_at_auction": 10}, {"treasure_id": 2, "cost_at_auction": 1e40},
+                   {"treasure_id": 3, "cost_at_auction": 30}]
+        response = test_client.patch('/api/treasures/bulk?batch_size=1', json={"updates": updates})
+        assert response.status_code == 200
+        body = response.json()
+        assert body['updated'] == [1, 3]
+        assert body['failed'] == [2]
+        assert body['errors'][0]['treasure_ids'] == [2]
+        treasures = test_client.get('/api/treasures/batch?ids=1,3').json()['treasures']
+        assert [treasure['cost_at_auction'] for treasure in treasures] == [10.0, 30.0]
+
+    @pytest.mark.it('Test if bulk patch fails only the id with a cost REAL cannot store')
+    def test_200_bulk_patch_rejects_bad_cost_alone(self, test_client):
+        updates = [{"treasure_id": 1, "cost_at_auction": 10}, {"treasure_id": 2, "cost_at_auction": 1e300},
+                   {"treasure_id": 3, "cost_at_auction": 30}]
+        response = test_client.patch('/api/treasures/bulk', json={"updates": updates})
+        assert response.status_code == 200
+        body = response.json()
+        assert body['updated'] == [1, 3]
+        assert body['failed'] == [2]
+        assert body['errors'] == [{'treasure_ids': [2],
+                                   'detail': ['cost_at_auction must be a finite number within the range of REAL']}]
+
+    @pytest.mark.it('Test if bulk patch refreshes cached listings and rows')
+    def test_bulk_patch_invalidates_caches(self, test_client):
+        test_client.get('/api/treasures/batch?ids=1')
+        listing = test_client.get('/api/treasures?sort_by=treasure_id&limit=1').json()
+        test_client.patch('/api/treasures/bulk', json={"updates": [{"treasure_id": 1, "cost_at_auction": 4321}]})
+        assert test_client.get('/api/treasures/batch?ids=1').json()['treasures'][0]['cost_at_auction'] == 4321
+        assert test_client.get('/api/treasures?sort_by=treasure_id&limit=1').json() != listing
+
+    @pytest.mark.it('Test if bulk patch returns 422 status code for a malformed body')
+    def test_422_bulk_patch_bad_body(self, test_client):
+        response = test_client.patch('/api/treasures/bulk', json={"updates": [{"cost_at_auction": 1}]})
+        assert response.status_code == 422
+        assert test_client.patch('/api/treasures/bulk?batch_size=0', json={"updates": []}).status_code == 422
+
+
+class TestBulkDeleteTreasures:
+    @pytest.mark.it('Test if bulk delete removes every id and reports the ids it could not find')
+    def test_200_bulk_delete(self, test_client):
+        response = test_client.request('DELETE', '/api/treasures/bulk?batch_size=2', json={"ids": [4, 5, 999, 4, 6]})
+        assert response.status_code == 200
+        assert response.json() == {'deleted': [4, 5, 6], 'not_found': [999], 'failed': [], 'errors': []}
+        assert test_client.get('/api/treasures/batch?ids=4,5,6,7').json()['missing'] == [4, 5, 6]
+        assert len(test_client.get('/api/treasures?limit=0').json()['treasures']) == 23
+
+    @pytest.mark.it('Test if the single-id routes still work next to the bulk routes')
+    def test_single_id_routes_not_shadowed(self, test_client):
+        assert test_client.patch('/api/treasures/1', json={"cost_at_auction": 3}).status_code == 200
+        assert test_client.delete('/api/treasures/1').status_code == 204
+
+
+def catalogue_names(response):
+    # the first cell of each row is the treasure's name
+    return re.findall(r'<tr>\s*<td>([^<]*)</td>', response.text)
+
+
+def catalogue_link(response, rel):
+    found = re.search(rf'<a rel="{rel}" href="([^"]*)"', response.text)
+    return html.unescape(found.group(1)) if found else None
+
+
+class TestCatalogue:
+    @pytest.mark.it('Test if the treasures page lists the same treasures as the API, in order')
+    def test_200_treasures_page_matches_listing(self, test_client):
+        query = 'sort_by=cost_at_auction&order=desc&min_age=1&limit=10'
+        expected = test_client.get(f'/api/treasures?{query}').json()['treasures']
+        response = test_client.get(f'/treasures?{query}')
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'text/html; charset=utf-8'
+        assert catalogue_names(response) == [treasure['treasure_name'] for treasure in expected]
+
+    @pytest.mark.it('Test if blank fields of the search form are ignored')
+    def test_200_blank_form_fields(self, test_client):
+        response = test_client.get('/treasures?q=&match=substring&colour=&min_age=&max_age=&sort_by=&order=&limit=5')
+        assert response.status_code == 200
+        assert len(catalogue_names(response)) == 5
+
+    @pytest.mark.it('Test if following the Next links pages through the whole listing')
+    def test_200_next_links_page_through_listing(self, test_client):
+        expected = test_client.get('/api/treasures?sort_by=treasure_name&limit=26').json()['treasures']
+        names, link = [], '?sort_by=treasure_name&limit=10'
+        while link:
+            response = test_client.get(f'/treasures{link}')
+            assert response.status_code == 200
+            names += catalogue_names(response)
+            link = catalogue_link(response, 'next')
+        assert names == [treasure['treasure_name'] for treasure in expected]
+
+    @pytest.mark.it('Test if include_total shows the total and page count')
+    def test_200_include_total(self, test_client):
+        response = test_client.get('/treasures?limit=10&include_total=true')
+        assert '26 treasures, page 1 of 3' in response.text
+
+    @pytest.mark.it('Test if the table fragment is cached, answers If-None-Match with 304 and follows writes')
+    def test_fragment_cache(self, test_client):
+        first = test_client.get('/treasures?limit=10')
+        before = test_client.get('/api/stats/cache').json()['response_cache']['hits']
+        second = test_client.get('/treasures?limit=10')
+        assert test_client.get('/api/stats/cache').json()['response_cache']['hits'] == before + 1
+        assert second.text == first.text
+        etag = second.headers['etag']
+        response = test_client.get('/treasures?limit=10', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.content == b''
+        new_treasure = {"treasure_name": "Catalogue Vase", "colour": "gold", "age": 0, "cost_at_auction": 1.0, "shop_id": 1}
+        test_client.post('/api/treasures', json=new_treasure)
+        response = test_client.get('/treasures?limit=10', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert catalogue_names(response)[0] == 'Catalogue Vase'
+
+    @pytest.mark.it('Test if a page without a limit is streamed and not cached')
+    def test_200_streamed_page(self, test_client):
+        expected = test_client.get('/api/treasures?sort_by=treasure_id&limit=26').json()['treasures']
+        response = test_client.get('/treasures?limit=0&sort_by=treasure_id')
+        assert response.status_code == 200
+        assert 'etag' not in response.headers
+        assert catalogue_names(response) == [treasure['treasure_name'] for treasure in expected]
+        assert catalogue_link(response, 'next') is None
+
+    @pytest.mark.it('Test if errors are shown on the page with their status code')
+    def test_errors_render_as_html(self, test_client):
+        response = test_client.get('/treasures?colour=nocolour')
+        assert response.status_code == 422
+        assert 'There is no such colour in the database' in response.text
+        response = test_client.get('/treasures?page=100')
+        assert response.status_code == 404
+        assert 'No treasures found.' in response.text
+        # past the end of a streamed page
+        response = test_client.get('/treasures?limit=1000&page=100')
+        assert response.status_code == 404
+
+    @pytest.mark.it('Test if the shops page lists every shop and follows writes')
+    def test_200_shops_page(self, test_client):
+        shops = test_client.get('/api/shops').json()['shops']
+        response = test_client.get('/shops')
+        assert response.status_code == 200
+        assert catalogue_names(response) == [shop['shop_name'] for shop in shops]
+        etag = response.headers['etag']
+        test_client.delete('/api/treasures/1')
+        assert test_client.get('/shops', headers={'If-None-Match': etag}).status_code == 200
+
+    @pytest.mark.it('Test if static files are served under their content hash with a long-lived Cache-Control')
+    def test_static_files_are_hashed(self, test_client):
+        page = test_client.get('/treasures')
+        url = static_files.url('styles.css')
+        assert f'href="{url}"' in page.text
+        response = test_client.get(url)
+        assert response.status_code == 200
+        assert response.headers['cache-control'] == 'public, max-age=31536000, immutable'
+        plain = test_client.get('/static/styles.css')
+        assert plain.headers['cache-control'] == 'no-cache'
+        assert plain.content == response.content
+        assert test_client.get('/static/styles.000000000000.css').status_code == 404
+
+    @pytest.mark.it('Test if templates are compiled at startup, not read per request')
+    def test_templates_compiled_at_startup(self, test_client, monkeypatch):
+        def get_source(*args):
+            raise AssertionError('template read after startup')
+        monkeypatch.setattr(templates.loader, 'get_source', get_source)
+        assert test_client.get('/treasures?limit=0').status_code == 200
+        assert test_client.get('/shops').status_code == 200
+
+
+class TestTreasureFacets:
+    @pytest.mark.it('Test if facets count colours and ages and summarise costs over every treasure')
+    def test_200_facets_match_listing(self, test_client):
+        treasures = test_client.get('/api/treasures?limit=26').json()['treasures']
+        response = test_client.get('/api/treasures/facets')
+        assert response.status_code == 200
+        facets = response.json()['facets']
+        assert facets['total'] == 26
+        colours = {facet['colour']: facet['count'] for facet in facets['colours']}
+        assert colours == {colour: [t['colour'] for t in treasures].count(colour) for colour in {t['colour'] for t in treasures}}
+        assert [facet['count'] for facet in facets['colours']] == sorted(colours.values(), reverse=True)
+        ages = {facet['min_age']: facet['count'] for facet in facets['ages']}
+        assert ages == {age: [t['age'] // 10 * 10 for t in treasures].count(age) for age in {t['age'] // 10 * 10 for t in treasures}}
+        assert all(facet['max_age'] == facet['min_age'] + 9 for facet in facets['ages'])
+        costs = [t['cost_at_auction'] for t in treasures]
+        assert facets['cost_at_auction'] == {'min': min(costs), 'avg': pytest.approx(sum(costs) / len(costs), abs=0.01),
+                                             'max': max(costs), 'priced': 26}
+
+    @pytest.mark.it('Test if facets respect the colour and age filters and the age bucket width')
+    def test_200_facets_filtered(self, test_client):
+        treasures = test_client.get('/api/treasures?min_age=10&max_age=100&limit=26').json()['treasures']
+        facets = test_client.get('/api/treasures/facets?min_age=10&max_age=100&age_bucket=25').json()['facets']
+        assert facets['total'] == len(treasures)
+        assert sum(facet['count'] for facet in facets['colours']) == len(treasures)
+        assert [(facet['min_age'], facet['max_age']) for facet in facets['ages']] == \
+            sorted({(t['age'] // 25 * 25, t['age'] // 25 * 25 + 24) for t in treasures})
+        facets = test_client.get('/api/treasures/facets?colour=GOLD').json()['facets']
+        assert facets['colours'] == [{'colour': 'gold', 'count': 2}]
+        assert facets['cost_at_auction']['max'] == 500.0
+
+    @pytest.mark.it('Test if facets of no treasures are empty, and an unknown colour returns 422')
+    def test_facets_empty_and_unknown_colour(self, test_client):
+        facets = test_client.get('/api/treasures/facets?min_age=100000').json()['facets']
+        assert facets == {'total': 0, 'colours': [], 'ages': [],
+                          'cost_at_auction': {'min': None, 'avg': None, 'max': None, 'priced': 0}}
+        assert test_client.get('/api/treasures/facets?colour=nocolour').status_code == 422
+        assert test_client.get('/api/treasures/facets?age_bucket=0').status_code == 422
+
+    @pytest.mark.it('Test if facets are cached per filter combination and follow writes')
+    def test_facets_cached_and_invalidated(self, test_client):
+        first = test_client.get('/api/treasures/facets?colour=gold')
+        before = test_client.get('/api/stats/cache').json()['response_cache']['hits']
+        assert test_client.get('/api/treasures/facets?colour=Gold').headers['etag'] == first.headers['etag']
+        assert test_client.get('/api/stats/cache').json()['response_cache']['hits'] == before + 1
+        test_client.post('/api/treasures', json={"treasure_name": "Facet Vase", "colour": "gold", "age": 5,
+                                                 "cost_at_auction": 1000.0, "shop_id": 1})
+        facets = test_client.get('/api/treasures/facets?colour=gold').json()['facets']
+        assert facets['total'] == 3
+        assert facets['cost_at_auction']['max'] == 1000.0
+
+
+def parse_events(response):
+    events = []
+    for block in response.text.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith(':'))
+        if fields:
+            events.append({**fields, 'data': json.loads(fields['data'])})
+    return events
+
+
+MAUVE_VASE = {"treasure_name": "Mauve Vase", "colour": "mauve", "age": 5, "cost_at_auction": 10.0, "shop_id": 2}
+
+
+class TestChangeFeed:
+    @pytest.mark.it('Test if /api/changes replays inserts, updates and deletes in order as server-sent events')
+    def test_replays_changes_in_order(self, test_client):
+        treasure_id = test_client.post('/api/treasures', json=MAUVE_VASE).json()['treasure']['treasure_id']
+        test_client.patch(f'/api/treasures/{treasure_id}', json={'cost_at_auction': 12})
+        # setting the same cost again changes nothing
+        test_client.patch(f'/api/treasures/{treasure_id}', json={'cost_at_auction': 12})
+        assert test_client.delete(f'/api/treasures/{treasure_id}').status_code == 204
+        response = test_client.get('/api/changes?since=0&timeout=0.3')
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/event-stream')
+        events = parse_events(response)
+        assert [event['event'] for event in events] == ['insert', 'update', 'delete']
+        assert [int(event['id']) for event in events] == sorted(int(event['id']) for event in events)
+        assert all(event['data']['treasure_id'] == treasure_id and event['data']['shop_id'] == 2 for event in events)
+        assert events[0]['data']['treasure']['treasure_name'] == 'Mauve Vase'
+        assert events[1]['data']['treasure']['cost_at_auction'] == 12
+        assert events[2]['data']['treasure'] is None
+
+    @pytest.mark.it('Test if a reconnect with Last-Event-ID only gets the changes after that event')
+    def test_resumes_from_last_event_id(self, test_client):
+        for age in [1, 2, 3]:
+            test_client.post('/api/treasures', json={**MAUVE_VASE, 'age': age})
+        first, *rest = parse_events(test_client.get('/api/changes?since=0&timeout=0.3'))
+        response = test_client.get('/api/changes?since=0&timeout=0.3', headers={'Last-Event-ID': first['id']})
+        assert parse_events(response) == rest
+        assert [event['data']['treasure']['age'] for event in rest] == [2, 3]
+
+    @pytest.mark.it('Test if live changes reach every subscriber through one listener')
+    def test_fans_out_live_changes(self, test_client):
+        with ThreadPoolExecutor(2) as executor:
+            streams = [executor.submit(test_client.get, '/api/changes?timeout=1.5') for _ in range(2)]
+            deadline = time.monotonic() + 5
+            while test_client.get('/api/stats/changes').json()['change_feed']['subscribers'] < 2:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            treasure_id = test_client.post('/api/treasures', json=MAUVE_VASE).json()['treasure']['treasure_id']
+            test_client.patch('/api/treasures/1', json={'cost_at_auction': 99})
+            for stream in streams:
+                events = parse_events(stream.result())
+                assert [(event['event'], event['data']['treasure_id']) for event in events] == \
+                    [('insert', treasure_id), ('update', 1)]
+        stats = test_client.get('/api/stats/changes').json()['change_feed']
+        assert stats['listening'] and stats['subscribers'] == 0
+        assert stats['notifications'] >= 2
+
+    @pytest.mark.it('Test if an open write transaction blocks no writers and its change is still published first')
+    def test_open_transaction_holds_back_later_changes(self, test_client):
+        def change_feed_stats():
+            return test_client.get('/api/stats/changes').json()['change_feed']
+
+        conn = connect_to_db(Settings.load('test'))
+        try:
+            with ThreadPoolExecutor(1) as executor:
+                stream = executor.submit(test_client.get, '/api/changes?timeout=2')
+                deadline = time.monotonic() + 5
+                while change_feed_stats()['subscribers'] < 1:
+                    assert time.monotonic() < deadline
+                    time.sleep(0.01)
+                published = change_feed_stats()['published']
+                conn.run('START TRANSACTION')
+                conn.run('UPDATE treasures SET cost_at_auction = 1 WHERE treasure_id = 1')
+                # takes a higher change id and commits while the update is still open
+                response = test_client.post('/api/treasures', json=MAUVE_VASE)
+                assert response.status_code == 201
+                time.sleep(0.2)
+                assert change_feed_stats()['published'] == published
+                conn.run('COMMIT')
+                events = parse_events(stream.result())
+        finally:
+            conn.close()
+        assert [(event['event'], event['data']['treasure_id']) for event in events] == \
+            [('update', 1), ('insert', response.json()['treasure']['treasure_id'])]
+        assert int(events[0]['id']) < int(events[1]['id'])
+
+    @pytest.mark.it('Test if a bulk update publishes one change per treasure it changed')
+    def test_bulk_update_publishes_each_treasure(self, test_client):
+        updates = [{'treasure_id': treasure_id, 'cost_at_auction': 1} for treasure_id in [3, 1, 2]]
+        assert test_client.patch('/api/treasures/bulk', json={'updates': updates}).status_code == 200
+        events = parse_events(test_client.get('/api/changes?since=0&timeout=0.3'))
+        assert [(event['event'], event['data']['treasure_id']) for event in events] == \
+            [('update', 1), ('update', 2), ('update', 3)]
+
+    @pytest.mark.it('Test if resuming from a pruned change sends a reset event')
+    def test_reset_after_pruned_changes(self, test_client):
+        test_client.post('/api/treasures', json=MAUVE_VASE)
+        [event] = parse_events(test_client.get('/api/changes?since=0&timeout=0.3'))
+        test_client.post('/api/treasures', json={**MAUVE_VASE, 'age': 6})
+        conn = connect_to_db(Settings.load('test'))
+        try:
+            conn.run('DELETE FROM treasure_changes')
+        finally:
+            conn.close()
+        events = parse_events(test_client.get('/api/changes?timeout=0.3', headers={'Last-Event-ID': event['id']}))
+        assert [event['event'] for event in events] == ['reset']
+
+    @pytest.mark.it('Test if a failed replay ends the stream with an error instead of going live')
+    def test_failed_replay_is_not_hidden(self, test_client, monkeypatch):
+        test_client.post('/api/treasures', json=MAUVE_VASE)
+        monkeypatch.setattr('main.get_changes_query', lambda: 'SELECT * FROM no_such_table;')
+        # the response has started, so the error aborts the stream
+        with pytest.raises(RuntimeError) as error:
+            test_client.get('/api/changes?since=0&timeout=0.3')
+        assert error.value.__cause__.status_code == 500
+
+    @pytest.mark.it('Test if /api/changes returns 422 for a Last-Event-ID that is not a change id')
+    def test_422_bad_last_event_id(self, test_client):
+        response = test_client.get('/api/changes?timeout=0.1', headers={'Last-Event-ID': 'abc'})
+        assert response.status_code == 422
+
+
+class TestServerTiming:
+    @pytest.mark.it('Test if responses report their database time when SERVER_TIMING is on')
+    def test_server_timing_header(self, test_client):
+        app.state.server_timing = True
+        try:
+            response = test_client.get('/api/treasures?colour=gold')
+            cached = test_client.get('/api/treasures?colour=gold')
+        finally:
+            app.state.server_timing = False
+        timings = parse_server_timing(response.headers['server-timing'])
+        assert timings['db'] > 0
+        assert timings['app'] >= timings['db']
+        assert parse_server_timing(cached.headers['server-timing'])['db'] == 0
+
+    @pytest.mark.it('Test if the Server-Timing header breaks the request into phases')
+    def test_server_timing_phases(self, test_client):
+        app.state.server_timing = True
+        try:
+            response = test_client.get('/api/treasures?sort_by=treasure_name')
+        finally:
+            app.state.server_timing = False
+        timings = parse_server_timing(response.headers['server-timing'])
+        for phase in ['connect', 'execute', 'fetch', 'format', 'serialize']:
+            assert phase in timings
+        assert timings['db'] >= timings['execute']
+
+    @pytest.mark.it('Test if there is no Server-Timing header by default')
+    def test_no_server_timing_header(self, test_client):
+        assert 'server-timing' not in test_client.get('/api/treasures').headers
+
+
+class TestMetrics:
+    @pytest.mark.it('Test if /metrics exports phase histograms labelled by route and query shape')
+    def test_200_metrics(self, test_client):
+        test_client.get('/api/treasures?colour=gold&sort_by=cost_at_auction&order=desc')
+        test_client.patch('/api/treasures/1', json={'cost_at_auction': 5})
+        response = test_client.get('/metrics')
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/plain')
+        assert '# TYPE http_request_phase_seconds histogram' in response.text
+        assert 'http_request_phase_seconds_count{route="/api/treasures",' \
+               'shape="treasures:cost_at_auction:DESC:colour:first_page",phase="execute"}' in response.text
+        assert 'http_request_phase_seconds_count{route="/api/treasures/{treasure_id}",' \
+               'shape="update",phase="execute"}' in response.text
+        assert 'http_request_duration_seconds_bucket{route="/api/treasures",method="GET",status="200",le="+Inf"}' \
+               in response.text
+
+    @pytest.mark.it('Test if statements slower than SLOW_QUERY_MS are logged with their route and shape')
+    def test_slow_query_log(self, test_client, monkeypatch, caplog):
+        monkeypatch.setattr(db.settings, '_settings', replace(get_settings(), slow_query_ms=1e-6))
+        with caplog.at_level('WARNING', logger='cats_rare_treasures.slow_queries'):
+            test_client.get('/api/shops')
+        [record] = [record for record in caplog.records if record.name == 'cats_rare_treasures.slow_queries']
+        assert 'route=/api/shops shape=shops' in record.getMessage()
+        assert 'FROM shops' in record.getMessage()
+
+
+class TestPreparedStatements:
+    @pytest.mark.it('Test if later pages of a listing reuse the statement prepared for the first')
+    def test_pages_reuse_prepared_statement(self, test_client):
+        test_client.get('/api/treasures?sort_by=cost_at_auction&limit=3')
+        before = test_client.get('/api/stats/statements').json()['statements']
+        for page in [2, 3, 4]:
+            assert test_client.get(f'/api/treasures?sort_by=cost_at_auction&limit=3&page={page}').status_code == 200
+        after = test_client.get('/api/stats/statements').json()['statements']
+        # page 1 has no OFFSET, so pages 2-4 share one new statement
+        assert after['misses'] - before['misses'] == 1
+        assert after['hits'] - before['hits'] == 2
@@ -0,0 +1,41 @@
+from db.changes import ChangeFeed, Subscription, format_event
+from db.connection import connect_to_db
+from db.settings import Settings
+from db.seed import restore_db
+import pytest
+
+
+@pytest.fixture
+def db():
+    restore_db('test')
+    conn = connect_to_db(Settings.load('test'))
+    yield conn
+    conn.close()
+
+
+def test_format_event():
+    assert format_event((7, 'update', '{"treasure_id": 1}')) == \
+        b'id: 7\nevent: update\ndata: {"treasure_id": 1}\n\n'
+
+
+def test_slow_subscriber_is_dropped():
+    feed = ChangeFeed()
+    slow, fast = Subscription(1, 0), Subscription(10, 0)
+    feed.subscriptions = {slow, fast}
+    for change_id in [1, 2]:
+        feed._publish((change_id, 'insert', '{}'))
+    assert feed.position == 2 and feed.dropped == 1
+    assert slow.closed and slow.queue.qsize() == 1
+    assert not fast.closed and fast.queue.qsize() == 2
+    assert feed.subscriptions == {fast}
+
+
+def test_statements_publish_one_change_per_row(db):
+    [[in_shop]] = db.run('SELECT COUNT(*) FROM treasures WHERE shop_id = 1')
+    db.run('UPDATE treasures SET age = age + 1 WHERE shop_id = 1')
+    # leaves every row as it was
+    db.run('UPDATE treasures SET age = age WHERE shop_id = 2')
+    db.run('DELETE FROM treasures WHERE treasure_id = 1')
+    changes = db.run('SELECT operation, treasure_id FROM treasure_changes ORDER BY change_id')
+    assert [operation for operation, _ in changes] == ['update'] * in_shop + ['delete']
+    assert changes[-1] == ['delete', 1]
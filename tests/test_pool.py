@@ -0,0 +1,126 @@
+from db.pool import ConnectionPool, PoolTimeout
+import pytest
+import threading
+import time
+
+
+class FakeConnection:
+    def __init__(self):
+        self._usock = object()
+        self._transaction_status = b'I'
+        self.queries = []
+        self.broken = False
+
+    def run(self, query_str, **params):
+        self.queries.append(query_str)
+        if self.broken:
+            raise OSError('connection reset')
+        return [[1]]
+
+    def close(self):
+        self._usock = None
+
+
+@pytest.fixture
+def make_pool():
+    def make(**kwargs):
+        created = []
+        def connect():
+            conn = FakeConnection()
+            created.append(conn)
+            return conn
+        pool = ConnectionPool(connect, **kwargs).open()
+        pool.created = created
+        return pool
+    return make
+
+
+def test_pool_opens_min_size_connections(make_pool):
+    pool = make_pool(min_size=2, max_size=4)
+    assert len(pool.created) == 2
+    assert pool.stats()['idle'] == 2
+    assert pool.stats()['in_use'] == 0
+
+
+def test_pool_reuses_released_connection(make_pool):
+    pool = make_pool(min_size=1, max_size=4)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert pool.stats()['in_use'] == 1
+    assert first is second
+    assert len(pool.created) == 1
+
+
+def test_pool_raises_pool_timeout_when_exhausted(make_pool):
+    pool = make_pool(min_size=0, max_size=1, checkout_timeout=0.05)
+    conn = pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    assert pool.stats()['timeouts'] == 1
+    pool.release(conn)
+    assert pool.acquire() is conn
+
+
+def test_pool_waiting_checkout_gets_released_connection(make_pool):
+    pool = make_pool(min_size=0, max_size=1, checkout_timeout=2)
+    conn = pool.acquire()
+    threading.Timer(0.05, pool.release, args=[conn]).start()
+    assert pool.acquire() is conn
+    assert pool.stats()['max_wait_ms'] > 0
+
+
+def test_pool_drops_connection_failing_health_check(make_pool):
+    pool = make_pool(min_size=1, max_size=2, health_check_after=0)
+    pool.created[0].broken = True
+    with pool.connection() as conn:
+        assert conn is pool.created[1]
+    assert pool.created[0]._usock is None
+    assert pool.stats()['discarded'] == 1
+
+
+def test_pool_closes_connections_idle_past_timeout(make_pool):
+    pool = make_pool(min_size=1, max_size=3, idle_timeout=0.01)
+    first, second = pool.acquire(), pool.acquire()
+    pool.release(first)
+    pool.release(second)
+    time.sleep(0.02)
+    with pool.connection():
+        pass
+    assert pool.stats()['size'] == 1
+
+
+def test_pool_discards_connection_after_socket_error(make_pool):
+    pool = make_pool(min_size=1, max_size=2)
+    with pytest.raises(OSError):
+        with pool.connection() as conn:
+            conn.broken = True
+            conn.run('SELECT 1')
+    assert pool.stats()['size'] == 0
+    assert conn._usock is None
+
+
+def test_pool_releases_connection_of_generator_closed_early(make_pool):
+    pool = make_pool(min_size=0, max_size=2, checkout_timeout=0.05)
+
+    def rows():
+        with pool.connection() as conn:
+            while True:
+                yield conn.run('SELECT 1')
+
+    for _ in range(3):
+        chunks = rows()
+        next(chunks)
+        chunks.close()
+    assert pool.stats()['in_use'] == 0
+    with pool.connection():
+        pass
+
+
+def test_pool_releases_connection_on_keyboard_interrupt(make_pool):
+    pool = make_pool(min_size=1, max_size=1)
+    with pytest.raises(KeyboardInterrupt):
+        with pool.connection():
+            raise KeyboardInterrupt
+    assert pool.stats()['in_use'] == 0
+    assert pool.stats()['size'] == 1
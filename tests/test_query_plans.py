@@ -0,0 +1,111 @@
+'''This module checks that every query shape `get_treasures` can build is
+served from an index once the `treasures` table is large.'''
+
+from db.connection import connect_to_db
+from db.settings import Settings
+from db.seed import restore_db
+from db.utils import get_treasures_filters, get_keyset_conditions, build_treasures_query, get_shops_query,\
+                     get_treasures_by_ids_query, get_count_treasures_query, get_estimate_treasures_query,\
+                     parse_row_estimate
+from itertools import product
+import pytest
+import os
+
+# test data has 26 treasures, so this gives the planner ~100k rows
+QUERY_PLAN_SCALE = int(os.getenv('QUERY_PLAN_SCALE', 4000))
+
+FILTERS = {'colour': 'gold', 'max_age': 500, 'min_age': 1}
+CURSOR_VALUES = {'age': 50, 'cost_at_auction': 20.0, 'treasure_name': 'treasure-m', 'treasure_id': None,
+                 'relevance': 1.5}
+# each matches a few dozen of the scaled copies, named like `treasure-q #1234`
+SEARCHES = {'prefix': 'treasure-q #123', 'substring': 'q #123', 'fuzzy': 'treasure-q #1234'}
+
+
+def generate_query_shapes():
+    for sort_by, order in product(['age', 'cost_at_auction', 'treasure_name', 'treasure_id'], ['ASC', 'DESC']):
+        for filter_names in product(*[[None, name] for name in FILTERS]):
+            filters = {name: FILTERS[name] for name in filter_names if name}
+            for paging in ['page', 'deep_page', 'cursor', 'cursor_from_null']:
+                shape_id = '-'.join([sort_by, order, '+'.join(filters) or 'unfiltered', paging])
+                yield pytest.param(sort_by, order, filters, paging, id=shape_id)
+
+
+def build_query(sort_by, order, filters, paging):
+    conditions, params = get_treasures_filters(**filters)
+    keyset_conditions = None
+    offset = {'page': None, 'deep_page': 5000}.get(paging)
+    if paging.startswith('cursor'):
+        last_value = None if paging == 'cursor_from_null' else CURSOR_VALUES[sort_by]
+        keyset_conditions = get_keyset_conditions(sort_by, order, last_value)
+        params['cursor_id'] = 1000
+        if last_value is not None:
+            params['cursor_value'] = last_value
+    params['limit'] = 5
+    if offset:
+        params['offset'] = offset
+    if sort_by == 'relevance':
+        params['q'] = filters['q']
+    query_str = build_treasures_query(conditions, sort_by, order, 5, offset, keyset_conditions,
+                                      check_colour='colour' in filters)
+    return query_str, params
+
+
+def generate_search_shapes():
+    for match, sort_by, colour, paging in product(SEARCHES, ['relevance', 'age'], [None, 'gold'], ['page', 'cursor']):
+        filters = {'q': SEARCHES[match], 'match': match, **({'colour': colour} if colour else {})}
+        order = 'DESC' if sort_by == 'relevance' else 'ASC'
+        shape_id = '-'.join([match, sort_by, colour or 'any', paging])
+        yield pytest.param(sort_by, order, filters, paging, id=shape_id)
+
+
+def find_seq_scans(plan):
+    scans = []
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Relation Name') == 'treasures':
+        scans.append(plan)
+    for child in plan.get('Plans', []):
+        scans += find_seq_scans(child)
+    return scans
+
+
+@pytest.fixture(scope='module')
+def large_db():
+    restore_db('test', scale=QUERY_PLAN_SCALE)
+    conn = connect_to_db(Settings.load('test'))
+    yield conn
+    conn.close()
+    restore_db('test')
+
+
+@pytest.mark.parametrize('sort_by, order, filters, paging', list(generate_query_shapes()))
+def test_treasures_query_shape_uses_index(large_db, sort_by, order, filters, paging):
+    query_str, params = build_query(sort_by, order, filters, paging)
+    [[[plan]]] = large_db.run('EXPLAIN (FORMAT JSON) ' + query_str.rstrip(';'), **params)
+    assert not find_seq_scans(plan['Plan']), f'Sequential scan on treasures for:\n{query_str}'
+
+
+@pytest.mark.parametrize('sort_by, order, filters, paging', list(generate_search_shapes()))
+def test_search_query_shape_uses_index(large_db, sort_by, order, filters, paging):
+    query_str, params = build_query(sort_by, order, filters, paging)
+    [[[plan]]] = large_db.run('EXPLAIN (FORMAT JSON) ' + query_str.rstrip(';'), **params)
+    assert not find_seq_scans(plan['Plan']), f'Sequential scan on treasures for:\n{query_str}'
+
+
+def test_treasures_by_ids_query_uses_index(large_db):
+    [[[plan]]] = large_db.run('EXPLAIN (FORMAT JSON) ' + get_treasures_by_ids_query().rstrip(';'),
+                              ids=[5, 5000, 50000])
+    assert not find_seq_scans(plan['Plan'])
+
+
+@pytest.mark.parametrize('filters', [{}, {'colour': 'gold'}, {'min_age': 10}, {'colour': 'gold', 'max_age': 500}])
+def test_row_estimate_is_close_to_count(large_db, filters):
+    conditions, params = get_treasures_filters(**filters)
+    [[plan]] = large_db.run(get_estimate_treasures_query(conditions).rstrip(';'), **params)
+    [[total]] = large_db.run(get_count_treasures_query(conditions).rstrip(';'), **params)
+    assert total / 2 <= parse_row_estimate(plan) <= total * 2
+
+
+def test_shops_query_reads_summary_not_treasures(large_db):
+    [[[plan]]] = large_db.run('EXPLAIN (FORMAT JSON) ' + get_shops_query().strip().rstrip(';'))
+    def relations(node):
+        return [node.get('Relation Name')] + [name for child in node.get('Plans', []) for name in relations(child)]
+    assert 'treasures' not in relations(plan['Plan'])
@@ -0,0 +1,161 @@
+'''This module tests how reads are spread across read replicas.
+
+The API tests need a streaming replica of the test database, given as
+PG_TEST_REPLICA (default localhost:5433), and are skipped without one.
+'''
+
+from main import app, reset_caches
+from db.routing import ReplicaRouter, is_unavailable, parse_lsn
+from db.connection import connect_to_db
+from db.settings import Settings
+from db.utils import get_wal_position_query
+from db.seed import restore_db
+from fastapi.testclient import TestClient
+from dataclasses import replace
+from pg8000 import DatabaseError
+import db.routing
+import pytest
+import os
+
+
+PG_TEST_REPLICA = os.getenv('PG_TEST_REPLICA', 'localhost:5433')
+
+
+def test_round_robin_takes_turns():
+    router = ReplicaRouter([('a', 1), ('b', 1), ('c', 1)])
+    firsts = [router.candidates()[0].host for _ in range(6)]
+    assert firsts == ['a', 'b', 'c', 'a', 'b', 'c']
+
+
+def test_least_connections_prefers_idle_replica():
+    router = ReplicaRouter([('a', 1), ('b', 1)], strategy='least_connections')
+    busy = router.replicas[0]
+    with router.reading_from(busy):
+        assert [router.candidates()[0].host for _ in range(4)] == ['b'] * 4
+    assert busy.in_flight == 0
+
+
+def test_unhealthy_replica_is_left_out_until_retry():
+    router = ReplicaRouter([('a', 1), ('b', 1)], retry_after=60)
+    router.mark_down(router.replicas[0], OSError('connection refused'))
+    assert [endpoint.host for endpoint in router.candidates()] == ['b']
+    router.replicas[0].down_until = 0
+    assert len(router.candidates()) == 2
+
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        ReplicaRouter([], strategy='random')
+
+
+def test_parse_lsn_orders_wal_positions():
+    assert parse_lsn('0/4F000060') < parse_lsn('0/4F000061') < parse_lsn('1/0')
+    assert parse_lsn('not-a-token') is None
+    assert parse_lsn(None) is None
+
+
+def test_is_unavailable_separates_server_errors_from_query_errors():
+    assert is_unavailable(ConnectionRefusedError())
+    assert is_unavailable(DatabaseError({'C': '57P03', 'M': 'the database system is starting up'}))
+    assert is_unavailable(DatabaseError({'C': '40001', 'M': 'canceling statement due to conflict with recovery'}))
+    assert not is_unavailable(DatabaseError({'C': '42P01', 'M': 'relation does not exist'}))
+
+
+def test_replica_addresses_default_to_pg_port():
+    settings = Settings(pg_port=5432, pg_replicas='replica-1:5433, replica-2')
+    assert settings.replica_addresses() == [('replica-1', 5433), ('replica-2', 5432)]
+    with pytest.raises(ValueError):
+        Settings(pg_replicas='replica-1:abc').replica_addresses()
+
+
+@pytest.fixture(scope='module')
+def replica_address():
+    settings = replace(Settings.load('test'), pg_replicas=PG_TEST_REPLICA)
+    host, port = settings.replica_addresses()[0]
+    try:
+        conn = connect_to_db(replace(settings, pg_host=host, pg_port=port))
+    except Exception:
+        pytest.skip(f'No replica at {PG_TEST_REPLICA}')
+    try:
+        [[in_recovery]] = conn.run('SELECT pg_is_in_recovery()')
+    finally:
+        conn.close()
+    if not in_recovery:
+        pytest.skip(f'{PG_TEST_REPLICA} is not a replica')
+    return host, port
+
+
+def primary_wal_position():
+    conn = connect_to_db(Settings.load('test'))
+    try:
+        [[lsn]] = conn.run(get_wal_position_query())
+    finally:
+        conn.close()
+    return lsn
+
+
+@pytest.fixture(params=['async', 'sync'])
+def make_client(request, replica_address, monkeypatch):
+    restore_db('test')
+    reset_caches()
+    app.state.db_mode = request.param
+    clients = []
+
+    def make(replicas=(replica_address,), **kwargs):
+        monkeypatch.setattr(db.routing, '_router', ReplicaRouter(list(replicas), **kwargs))
+        client = TestClient(app).__enter__()
+        # the seed ran on the primary, so wait for the replica to replay it
+        client.headers['X-Session-Token'] = primary_wal_position()
+        clients.append(client)
+        return client
+
+    yield make
+    for client in clients:
+        client.__exit__(None, None, None)
+
+
+def routing_stats(client):
+    return client.get('/api/stats/replicas').json()['routing']
+
+
+class TestReadReplicas:
+    def test_reads_go_to_replica(self, make_client):
+        client = make_client(wait_timeout=5)
+        assert client.get('/api/treasures?limit=26').status_code == 200
+        assert client.get('/api/shops').status_code == 200
+        assert client.get('/api/treasures?limit=3&stream=true').status_code == 200
+        stats = routing_stats(client)
+        assert stats['replicas'][0]['reads'] >= 3
+        assert stats['primary_reads'] == 0
+
+    def test_read_your_writes_with_session_token(self, make_client):
+        client = make_client(wait_timeout=5)
+        input_data = {"treasure_name": "Mauve Vase", "colour": "mauve", "age": 5, "cost_at_auction": 10.0, "shop_id": 2}
+        # the replica is read-only, so this only succeeds on the primary
+        response = client.post('/api/treasures', json=input_data)
+        assert response.status_code == 201
+        token = response.headers['X-Session-Token']
+        reads = routing_stats(client)['replicas'][0]['reads']
+        response = client.get('/api/treasures?colour=mauve', headers={'X-Session-Token': token})
+        assert response.status_code == 200
+        assert response.json()['treasures']['treasure_name'] == 'Mauve Vase'
+        assert routing_stats(client)['replicas'][0]['reads'] == reads + 1
+
+    def test_lagging_replica_falls_back_to_primary(self, make_client):
+        client = make_client(wait_timeout=0.01)
+        response = client.get('/api/treasures?limit=26', headers={'X-Session-Token': 'FFFFFFFF/0'})
+        assert response.status_code == 200
+        assert len(response.json()['treasures']) == 26
+        assert routing_stats(client)['primary_reads'] == 1
+
+    def test_unreachable_replica_falls_out(self, make_client, replica_address):
+        client = make_client(replicas=[('localhost', 1), replica_address], retry_after=60, wait_timeout=5)
+        for _ in range(4):
+            assert client.get('/api/treasures?limit=26').status_code == 200
+            assert client.get('/api/treasures?limit=2&stream=true').status_code == 200
+        stats = routing_stats(client)
+        unreachable, replica = stats['replicas']
+        assert not unreachable['healthy']
+        assert unreachable['failures'] == 1
+        assert replica['healthy'] and replica['failures'] == 0
+        assert stats['primary_reads'] == 0
@@ -0,0 +1,76 @@
+from db.settings import Settings, reload_settings, on_reload, watch_settings_file
+from db.cache import apply_cache_settings, response_cache
+from dataclasses import replace
+import db.settings
+import pytest
+import time
+
+
+@pytest.fixture
+def settings_dir(tmp_path, monkeypatch):
+    # a private env file, settings and listener list so nothing leaks into the app
+    monkeypatch.chdir(tmp_path)
+    for name in ['PG_DATABASE', 'PG_PORT', 'PG_POOL_MAX_SIZE', 'SERVER_TIMING', 'RESPONSE_CACHE_TTL']:
+        monkeypatch.delenv(name, raising=False)
+    (tmp_path / '.env.test').write_text('PG_DATABASE=treasures\nPG_PORT=5433\nPG_POOL_MAX_SIZE=4\nSERVER_TIMING=yes\n')
+    monkeypatch.setattr(db.settings, '_settings', Settings.load('test'))
+    monkeypatch.setattr(db.settings, '_listeners', [])
+    return tmp_path
+
+
+def test_load_reads_typed_values(settings_dir):
+    settings = Settings.load('test')
+    assert settings.pg_database == 'treasures'
+    assert settings.pg_port == 5433
+    assert settings.pool_max_size == 4
+    assert settings.server_timing is True
+    assert settings.response_cache_ttl == 30.0
+
+
+def test_environment_overrides_file(settings_dir, monkeypatch):
+    monkeypatch.setenv('PG_PORT', '6543')
+    assert Settings.load('test').pg_port == 6543
+
+
+def test_load_rejects_badly_typed_values(settings_dir, monkeypatch):
+    monkeypatch.setenv('PG_POOL_MAX_SIZE', 'ten')
+    with pytest.raises(ValueError, match='PG_POOL_MAX_SIZE must be int'):
+        Settings.load('test')
+
+
+def test_reload_notifies_listeners_of_changes(settings_dir):
+    changes = []
+    on_reload(lambda new, old: changes.append((old.pg_port, new.pg_port, new.connection_changed(old))))
+    assert reload_settings().pg_port == 5433
+    assert changes == []
+    (settings_dir / '.env.test').write_text('PG_DATABASE=treasures\nPG_PORT=5434\n')
+    assert reload_settings().pg_port == 5434
+    assert changes == [(5433, 5434, True)]
+
+
+def test_reload_keeps_settings_when_file_is_invalid(settings_dir):
+    (settings_dir / '.env.test').write_text('PG_PORT=not-a-port\n')
+    assert reload_settings().pg_port == 5433
+    assert db.settings.get_settings().pg_port == 5433
+
+
+def test_watcher_reloads_on_file_change(settings_dir):
+    stop = watch_settings_file(interval=0.02)
+    try:
+        time.sleep(0.05)
+        (settings_dir / '.env.test').write_text('PG_DATABASE=treasures\nPG_PORT=5433\nRESPONSE_CACHE_TTL=5\n')
+        deadline = time.monotonic() + 2
+        while db.settings.get_settings().response_cache_ttl != 5.0 and time.monotonic() < deadline:
+            time.sleep(0.02)
+    finally:
+        stop.set()
+    assert db.settings.get_settings().response_cache_ttl == 5.0
+
+
+def test_cache_settings_apply_without_restart(monkeypatch):
+    monkeypatch.setattr(response_cache, 'ttl', response_cache.ttl)
+    monkeypatch.setattr(response_cache, 'max_entries', response_cache.max_entries)
+    old = Settings()
+    apply_cache_settings(replace(old, response_cache_ttl=1.5, response_cache_max_entries=8), old)
+    assert response_cache.ttl == 1.5
+    assert response_cache.max_entries == 8
@@ -0,0 +1,78 @@
+from main import app, reset_caches
+from db.connection import connect_to_db
+from db.settings import Settings
+from db.shop_summary import check_shop_summary, rebuild_shop_summary
+from db.seed import restore_db
+from fastapi.testclient import TestClient
+import pytest
+
+
+@pytest.fixture
+def db():
+    restore_db('test')
+    reset_caches()
+    conn = connect_to_db(Settings.load('test'))
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def test_client():
+    with TestClient(app) as client:
+        yield client
+
+
+def test_summary_matches_live_aggregate_after_seeding(db):
+    assert check_shop_summary(db) == []
+
+
+def test_summary_follows_writes(db, test_client):
+    new_treasure = {"treasure_name": "Summary Vase", "colour": "gold", "age": 5, "cost_at_auction": 10.5, "shop_id": 2}
+    treasure_id = test_client.post('/api/treasures', json=new_treasure).json()['treasure']['treasure_id']
+    test_client.patch(f'/api/treasures/{treasure_id}', json={"cost_at_auction": 99})
+    test_client.post('/api/treasures', json={**new_treasure, "cost_at_auction": None, "shop_id": 11})
+    test_client.delete('/api/treasures/1')
+    test_client.post('/api/treasures/bulk', json=[{**new_treasure, "shop_id": shop_id} for shop_id in [1, 1, 3]])
+    # statements that touch several shops at once, including moving stock between shops
+    db.run('UPDATE treasures SET shop_id = 4 WHERE shop_id = 3')
+    db.run('DELETE FROM treasures WHERE shop_id = 5')
+    assert check_shop_summary(db) == []
+
+    shops = {shop['shop_id']: shop for shop in test_client.get('/api/shops').json()['shops']}
+    live = {row[0]: row[1:] for row in db.run('''SELECT shop_id, SUM(cost_at_auction), COUNT(treasure_id)
+                                                 FROM treasures GROUP BY shop_id''')}
+    for shop_id, shop in shops.items():
+        stock_value, treasure_count = live.get(shop_id, (None, None))
+        assert shop['treasure_count'] == treasure_count
+        assert shop['stock_value'] == pytest.approx(stock_value)
+
+
+def test_summary_follows_bulk_changes(db, test_client):
+    updates = [{"treasure_id": treasure_id, "cost_at_auction": treasure_id * 1.5} for treasure_id in range(1, 20)]
+    updates.append({"treasure_id": 20, "cost_at_auction": None})
+    assert test_client.patch('/api/treasures/bulk?batch_size=7', json={"updates": updates}).status_code == 200
+    response = test_client.request('DELETE', '/api/treasures/bulk?batch_size=3', json={"ids": [2, 4, 6, 8, 10]})
+    assert response.status_code == 200
+    assert check_shop_summary(db) == []
+
+
+def test_restore_undoes_writes(db):
+    seeded = db.run('SELECT * FROM treasures ORDER BY treasure_id')
+    db.run("INSERT INTO treasures (treasure_name, colour, age, cost_at_auction, shop_id) VALUES ('Extra', 'gold', 1, 2.0, 1)")
+    db.run('UPDATE treasures SET cost_at_auction = 1 WHERE shop_id = 2')
+    db.run('DELETE FROM treasures WHERE shop_id = 3')
+    restore_db('test')
+    assert db.run('SELECT * FROM treasures ORDER BY treasure_id') == seeded
+    assert check_shop_summary(db) == []
+    # the next treasure gets the id after the seeded ones, as after a fresh seed
+    [[treasure_id]] = db.run("INSERT INTO treasures (treasure_name, colour, age, cost_at_auction, shop_id) "
+                             "VALUES ('Extra', 'gold', 1, 2.0, 1) RETURNING treasure_id")
+    assert treasure_id == len(seeded) + 1
+
+
+def test_check_reports_drift_and_rebuild_repairs_it(db):
+    db.run('UPDATE shop_stock_summary SET treasure_count = treasure_count + 1 WHERE shop_id = 2')
+    db.run('DELETE FROM shop_stock_summary WHERE shop_id = 3')
+    assert [mismatch['shop_id'] for mismatch in check_shop_summary(db)] == [2, 3]
+    rebuild_shop_summary(db)
+    assert check_shop_summary(db) == []
@@ -0,0 +1,35 @@
+from db.statements import StatementCache, StatementStats
+
+
+def test_cache_counts_hits_and_misses():
+    stats = StatementStats()
+    cache = StatementCache(max_size=2, stats=stats)
+    assert cache.lookup('SELECT 1') is None
+    cache.add('SELECT 1', 'statement 1')
+    assert cache.lookup('SELECT 1') == 'statement 1'
+    assert stats.stats()['hits'] == 1
+    assert stats.stats()['misses'] == 1
+    assert stats.stats()['hit_ratio'] == 0.5
+
+
+def test_cache_evicts_least_recently_used():
+    stats = StatementStats()
+    cache = StatementCache(max_size=2, stats=stats)
+    cache.add('SELECT 1', 'statement 1')
+    cache.add('SELECT 2', 'statement 2')
+    cache.lookup('SELECT 1')
+    assert cache.add('SELECT 3', 'statement 3') == ['statement 2']
+    assert len(cache) == 2
+    assert cache.lookup('SELECT 2') is None
+    assert cache.lookup('SELECT 1') == 'statement 1'
+    assert stats.stats()['evictions'] == 1
+
+
+def test_cache_discards_invalidated_statements():
+    stats = StatementStats()
+    cache = StatementCache(max_size=2, stats=stats)
+    cache.add('SELECT 1', 'statement 1')
+    assert cache.discard('SELECT 1') == 'statement 1'
+    assert cache.discard('SELECT 1') is None
+    assert cache.lookup('SELECT 1') is None
+    assert stats.stats()['invalidations'] == 1
@@ -1,8 +1,9 @@
 from main import get_treasures
 from fastapi import HTTPException
 import pytest
+import asyncio
 
 def test_get_treasure_raise_HTTPException():
     with pytest.raises(HTTPException):
-        get_treasures(colour='noncolour')
+        asyncio.run(get_treasures(colour='noncolour'))
 
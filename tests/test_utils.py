@@ -1,6 +1,10 @@
-from db.utils import format_data_list_to_dict, get_params_from_new_treasure
+from db.utils import format_data_list_to_dict, get_params_from_new_treasure, format_rows_as_csv, format_rows,\
+	format_facets, check_treasure_values
+from db.serialization import Rows, dumps
+import json
 from pydantic import BaseModel
 from main import NewTreasure
+from db.timing import parse_server_timing
 
 def test_format_data_list_to_dict():
     input_list = [[1, 'Luck Lust Liquor & Burn', 1, 'Mexican', 'http://lucklustliquorburn.com/']]
@@ -38,3 +42,56 @@ def test_get_params_from_new_treasure():
 	assert get_params_from_new_treasure(new_treasure) == excepted
 
 
+
+
+def test_format_rows_as_csv():
+	rows = [('Golden "Chalice"', 'gold', 500, 100000.0, None), ('', None, None, 19.99, 3)]
+	expected = '"Golden ""Chalice""","gold",500,100000.0,\n"",,,19.99,3\n'
+	assert format_rows_as_csv(rows) == expected
+
+
+def test_iter_json_array_streams_items(tmp_path, monkeypatch):
+	import db.seed
+	monkeypatch.setattr(db.seed, 'CHUNK_SIZE', 7)
+	path = tmp_path / 'treasures.json'
+	path.write_text('{\n  "treasures": [\n    {"treasure_name": "a, [b]", "age": 1},\n    {"treasure_name": "c"}\n  ]\n}')
+	assert list(db.seed.iter_json_array(path, 'treasures')) == [{"treasure_name": "a, [b]", "age": 1}, {"treasure_name": "c"}]
+
+
+def test_parse_server_timing():
+	assert parse_server_timing('db;dur=1.5, app;desc="total";dur=12') == {'db': 1.5, 'app': 12.0}
+	assert parse_server_timing(None) == {}
+
+
+def test_format_rows_matches_format_data_list_to_dict():
+	key_list = ['id', 'name']
+	for rows in [[(1, 'a')], [(1, 'a'), (2, 'b')]]:
+		expected = format_data_list_to_dict(rows, 'items', key_list)
+		assert json.loads(dumps(format_rows(rows, 'items', key_list))) == expected
+	assert isinstance(format_rows([(1, 'a'), (2, 'b')], 'items', key_list)['items'], Rows)
+
+
+def test_format_rows_columnar():
+	result = format_rows([(1, 'a')], 'items', ['id', 'name'], columnar=True)
+	assert json.loads(dumps(result)) == {'items': {'columns': ['id', 'name'], 'rows': [[1, 'a']]}}
+
+
+def test_format_facets_puts_unknown_values_last():
+	columns = ['facet', 'colour', 'age_bucket', 'count', 'min_cost', 'avg_cost', 'max_cost', 'priced']
+	rows = [(3, None, None, 6, 1.0, 2.5, 4.0, 4), (2, None, 20, 1, None, None, None, 0), (2, None, None, 2, None, None, None, 0),
+		(2, None, 0, 3, None, None, None, 0), (1, None, None, 3, None, None, None, 0), (1, 'gold', None, 2, None, None, None, 0),
+		(1, 'azure', None, 1, None, None, None, 0)]
+	facets = format_facets(columns, rows, 10)
+	assert facets['total'] == 6
+	assert facets['cost_at_auction'] == {'min': 1.0, 'avg': 2.5, 'max': 4.0, 'priced': 4}
+	assert facets['colours'] == [{'colour': 'gold', 'count': 2}, {'colour': 'azure', 'count': 1}, {'colour': None, 'count': 3}]
+	assert facets['ages'] == [{'min_age': 0, 'max_age': 9, 'count': 3}, {'min_age': 20, 'max_age': 29, 'count': 1},
+		{'min_age': None, 'max_age': None, 'count': 2}]
+
+
+def test_check_treasure_values_follows_the_column_limits():
+	assert check_treasure_values(treasure_name='n' * 256, colour=None, age=2 ** 31 - 1, cost_at_auction=3.4e38) == []
+	assert check_treasure_values(cost_at_auction=0.0) == []
+	problems = check_treasure_values(treasure_name='n' * 257, colour='c' * 43, age=-2 ** 31 - 1, cost_at_auction=float('nan'))
+	assert [problem.split()[0] for problem in problems] == ['treasure_name', 'colour', 'age', 'cost_at_auction']
+	assert check_treasure_values(cost_at_auction=1e-50) and check_treasure_values(cost_at_auction=1e39)